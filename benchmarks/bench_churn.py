@@ -0,0 +1,106 @@
+"""Compare per-line git log -S churn detection with the range index
+
+Usage: python benchmarks/bench_churn.py [num_commits]
+
+Builds a synthetic branch (50 commits by default) and runs the churn
+check over every commit in it twice: once the old way, with one
+git log -S process per changed line, and once through _ChurnIndex,
+which reads the whole range's diffs a single time through _RangeContext.
+"""
+import subprocess
+import sys
+import time
+
+import synthetic
+
+
+def legacy_parse_diff(gitbot, commit_sha1):
+    """The per-commit diff parsing the legacy check used
+
+    Returns:
+        A set of the added and removed lines of the commit's diff,
+        each with its '+' or '-' prefix.
+    """
+    diff_output = gitbot.git_objects.commit_diff(commit_sha1)
+    return set(
+        line_type + line
+        for _, line_type, line, _ in gitbot._parse_diff_output(diff_output))
+
+
+def legacy_check_diff_add_delete(gitbot, commit_sha1, head_sha1):
+    """The per-line git log -S implementation the index replaced"""
+    marked = set()
+    branch_sha1s = subprocess.check_output([
+        'git', 'log', '--format=%H', '{0}..{1}'.format(
+            commit_sha1, head_sha1)]).split()
+    if not branch_sha1s:
+        return marked, branch_sha1s
+
+    for diff_line in legacy_parse_diff(gitbot, commit_sha1):
+        if diff_line[1:] == '':
+            continue
+        output = subprocess.check_output([
+            'git', 'log', '--format=%H', '-S' + diff_line[1:],
+            '{0}..{1}'.format(commit_sha1, head_sha1)])
+        for sha1_s in output.split():
+            marked.add(sha1_s)
+            if sha1_s in branch_sha1s:
+                branch_sha1s.remove(sha1_s)
+            if not branch_sha1s:
+                return marked, branch_sha1s
+    return marked, branch_sha1s
+
+
+def run_checks(check, sha1s):
+    marked = set()
+    check_churn = True
+    start = time.time()
+    for sha1 in sha1s:
+        if not check_churn:
+            break
+        commit_marked, remaining = check(sha1)
+        marked.update(commit_marked)
+        check_churn = bool(remaining)
+    return time.time() - start, marked
+
+
+def main():
+    num_commits = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    workdir = synthetic.make_workdir()
+    try:
+        base, tip = synthetic.make_branch(num_commits)
+        gitbot = synthetic.import_gitbot()
+        sha1s = subprocess.check_output([
+            'git', 'log', '--reverse', '--format=%H',
+            '{0}..{1}'.format(base, tip)]).split()
+
+        legacy_time, legacy_marked = run_checks(
+            lambda sha1: legacy_check_diff_add_delete(gitbot, sha1, tip),
+            sha1s)
+
+        def indexed_check(sha1):
+            commit_info, remaining = gitbot._check_diff_add_delete(
+                sha1, range_context)
+            return set(commit_info), remaining
+
+        start = time.time()
+        range_context = gitbot._RangeContext(base, tip)
+        range_context.churn_index
+        build_time = time.time() - start
+        indexed_time, indexed_marked = run_checks(indexed_check, sha1s)
+        indexed_time += build_time
+
+        print 'commits:           {0}'.format(len(sha1s))
+        print 'git log -S:        {0:8.3f}s ({1} commits marked)'.format(
+            legacy_time, len(legacy_marked))
+        print 'churn index:       {0:8.3f}s ({1} commits marked, '\
+            '{2:.3f}s building the index)'.format(
+                indexed_time, len(indexed_marked), build_time)
+        print 'speedup:           {0:8.1f}x'.format(
+            legacy_time / indexed_time)
+    finally:
+        synthetic.remove_workdir(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""Compare the in-process HTML diff renderer with vim's TOhtml
+
+Usage: python benchmarks/bench_render.py [--no-vim]
+
+Renders synthetic unified diffs of 1k, 10k and 100k lines with both
+backends of _generate_html_diff.  Pass --no-vim to only time the
+in-process renderer (vim takes a long time on the largest diff).
+"""
+import os
+import sys
+import time
+
+import synthetic
+
+
+def make_diff(num_lines):
+    """Build a unified diff of roughly num_lines lines"""
+    lines = []
+    file_number = 0
+    while len(lines) < num_lines:
+        lines.extend([
+            'diff --git a/file_{0}.py b/file_{0}.py'.format(file_number),
+            'index 83db48f..bf269f4 100644',
+            '--- a/file_{0}.py'.format(file_number),
+            '+++ b/file_{0}.py'.format(file_number),
+        ])
+        for hunk in range(10):
+            lines.append('@@ -{0},7 +{0},7 @@ def function_{1}():'.format(
+                hunk * 20 + 1, hunk))
+            for line in range(3):
+                lines.append('     context = lookup("{0}") < {1}'.format(
+                    hunk, line))
+            lines.append('-    value = compute(old, {0}) & mask'.format(hunk))
+            lines.append('+    value = compute(new, {0}) & mask'.format(hunk))
+            for line in range(3):
+                lines.append('     return context  # {0}'.format(line))
+        file_number += 1
+    return '\n'.join(lines[:num_lines]) + '\n'
+
+
+def time_backend(gitbot, backend, diff_output):
+    gitbot.RENDER_BACKEND = backend
+
+    # Keep vim's terminal output out of the results table
+    stdout = os.dup(1)
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    try:
+        start = time.time()
+        gitbot._generate_html_diff(diff_output, 'Benchmark')
+        return time.time() - start
+    finally:
+        os.dup2(stdout, 1)
+        os.close(stdout)
+        os.close(devnull)
+
+
+def main():
+    use_vim = '--no-vim' not in sys.argv[1:]
+    workdir = synthetic.make_workdir()
+    try:
+        gitbot = synthetic.import_gitbot()
+        print '{0:>8} {1:>10} {2:>10} {3:>9}'.format(
+            'lines', 'python', 'vim', 'speedup')
+        for num_lines in [1000, 10000, 100000]:
+            diff_output = make_diff(num_lines)
+            python_time = time_backend(gitbot, 'python', diff_output)
+            if use_vim:
+                vim_time = time_backend(gitbot, 'vim', diff_output)
+                print '{0:>8} {1:>9.3f}s {2:>9.3f}s {3:>8.1f}x'.format(
+                    num_lines, python_time, vim_time, vim_time / python_time)
+            else:
+                print '{0:>8} {1:>9.3f}s {2:>10} {3:>9}'.format(
+                    num_lines, python_time, '-', '-')
+    finally:
+        synthetic.remove_workdir(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+"""Helpers shared by the gitbot benchmarks
+
+gitbot reads gitbot.cfg from the working directory when it is imported,
+so each benchmark builds a throwaway repository with a minimal config,
+changes into it and only then imports gitbot.
+"""
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+
+GITBOT_CFG = '''\
+[gitbot]
+address = 127.0.0.1
+port = 5000
+
+[github]
+username = gitbot
+personal_access_token = unused
+endpoint = http://127.0.0.1:1
+hostname = github.invalid
+
+[commit]
+domains =
+    example.com
+commit_title_start_words =
+    Add
+    Fix
+    Move
+    Remove
+'''
+
+
+def _git(*args):
+    subprocess.check_call(('git',) + args, stdout=open(os.devnull, 'w'))
+
+
+def _write_lines(path, lines):
+    with open(path, 'w') as f:
+        f.write(''.join(line + '\n' for line in lines))
+
+
+def make_workdir():
+    """Create a temporary git repository with a gitbot.cfg and enter it"""
+    workdir = tempfile.mkdtemp(prefix='gitbot-bench-')
+    os.chdir(workdir)
+    with open('gitbot.cfg', 'w') as f:
+        f.write(GITBOT_CFG)
+    _git('init', '-q')
+    _git('config', 'user.name', 'Bench Mark')
+    _git('config', 'user.email', 'bench.mark@example.com')
+    return workdir
+
+
+def remove_workdir(workdir):
+    os.chdir('/')
+    shutil.rmtree(workdir)
+
+
+def make_branch(num_commits, num_files=10, file_lines=200, seed=0):
+    """Create a base commit plus a branch of num_commits on top of it
+
+    Each branch commit adds a block of new lines to one file, removes a
+    few lines added by earlier commits and moves a block of lines from
+    one file to another, so the churn and move checks have something to
+    find.
+
+    Returns:
+        A (base sha1, tip sha1) tuple.
+    """
+    rng = random.Random(seed)
+    files = {}
+    for file_number in range(num_files):
+        path = 'module_{0}.py'.format(file_number)
+        files[path] = [
+            'value_{0}_{1} = compute({0}, {1})'.format(file_number, line)
+            for line in range(file_lines)]
+        _write_lines(path, files[path])
+    _git('add', '-A')
+    _git('commit', '-q', '-m', 'Add base files')
+    base = subprocess.check_output(['git', 'rev-parse', 'HEAD']).strip()
+
+    paths = sorted(files)
+    for commit_number in range(num_commits):
+        path = rng.choice(paths)
+        position = rng.randrange(len(files[path]))
+        files[path][position:position] = [
+            'added_{0}_{1} = transform(value, {1})'.format(commit_number, line)
+            for line in range(40)]
+
+        # Remove a few lines added by an earlier commit
+        if commit_number and commit_number % 3 == 0:
+            victim = rng.choice(paths)
+            files[victim] = [
+                line for line in files[victim]
+                if not line.startswith(
+                    'added_{0}_1'.format(commit_number - 3))]
+
+        # Move a block of lines between files
+        if commit_number % 5 == 4:
+            source, target = rng.sample(paths, 2)
+            start = rng.randrange(max(1, len(files[source]) - 10))
+            block = files[source][start:start + 10]
+            del files[source][start:start + 10]
+            files[target][0:0] = block
+
+        for changed_path in paths:
+            _write_lines(changed_path, files[changed_path])
+        _git('commit', '-q', '-a', '-m', 'Add block {0}'.format(commit_number))
+
+    tip = subprocess.check_output(['git', 'rev-parse', 'HEAD']).strip()
+    return base, tip
+
+
+def import_gitbot():
+    """Import gitbot from the repository this benchmark lives in"""
+    sys.path.insert(
+        0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import gitbot
+    return gitbot
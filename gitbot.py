@@ -1,19 +1,35 @@
+import bisect
+import cgi
+import collections
 import ConfigParser
+import difflib
+import email.utils
+import functools
+import hashlib
+import hmac
 import json
+import multiprocessing
+import multiprocessing.pool
 import os
+import Queue
 import re
 import shlex
+import sqlite3
 import subprocess
+import sys
 import tempfile
 import textwrap
+import threading
 import time
+import traceback
+import uuid
 
 from bs4 import BeautifulSoup
 
 import flask
 from flask import request, Response
 
-import requests.api
+import requests.adapters
 import requests.auth
 
 # TODO
@@ -48,7 +64,235 @@ GITHUB_HOSTNAME = config.get('github', 'hostname')
 COMMIT_VALID_DOMAINS = config.get('commit', 'domains')
 COMMIT_TITLE_START_WORDS = config.get('commit', 'commit_title_start_words')
 
-def _generate_html_diff(diff_output):
+
+def _config_option(section, option, default):
+    """Read an optional gitbot.cfg setting
+
+    Args:
+        section: The config file section
+        option: The option name within that section
+        default: The value to use when the option is not set.  Its type
+            decides how the configured value is parsed.
+
+    Returns:
+        The configured value, or default if there is none.
+    """
+    if not config.has_option(section, option):
+        return default
+    if isinstance(default, bool):
+        return config.getboolean(section, option)
+    if isinstance(default, int):
+        return config.getint(section, option)
+    if isinstance(default, float):
+        return config.getfloat(section, option)
+    return config.get(section, option)
+
+
+# Either 'python' to render diffs in-process or 'vim' to use TOhtml
+RENDER_BACKEND = _config_option('render', 'backend', 'python')
+
+# Limits for the rendered diff page cache.  The directory defaults to one
+# in the temporary directory (not the repository gitbot runs in); leave it
+# empty to keep the cache in memory only.
+RENDER_CACHE_MEMORY_BYTES = _config_option(
+    'render', 'cache_memory_bytes', 64 * 1024 * 1024)
+RENDER_CACHE_DIRECTORY = _config_option(
+    'render', 'cache_directory',
+    os.path.join(tempfile.gettempdir(), 'gitbot-render-cache'))
+RENDER_CACHE_DISK_BYTES = _config_option(
+    'render', 'cache_disk_bytes', 1024 * 1024 * 1024)
+
+# How long (in seconds) a fetched base branch is used before it must be
+# fetched again, and after how long it is refreshed in the background
+BASE_FETCH_TTL = _config_option('fetch', 'base_ttl', 300)
+BASE_FETCH_REFRESH_AFTER = _config_option('fetch', 'base_refresh_after', 60)
+
+# How long (in seconds) a request to a long-running git process may take
+# before the process is killed
+GIT_TIMEOUT = _config_option('git', 'timeout', 60.0)
+
+# The directory holding a bare mirror repository for each org/repo.
+# Leave it empty to fetch every repo into the repository gitbot runs in.
+# Mirrors can borrow objects from the object directories listed in
+# alternates (one per line), e.g. that of the repository gitbot used to
+# fetch everything into.
+MIRRORS_ROOT = _config_option('mirrors', 'root', '')
+MIRRORS_ALTERNATES = _config_option('mirrors', 'alternates', '')
+
+# Number of workers validating the commits of a range, and whether they
+# are threads or processes.  With 1 worker commits are validated one at
+# a time as the log is read.  The processes are forked once, when gitbot
+# starts, and read each range's diffs themselves.
+VALIDATE_WORKERS = _config_option('validate', 'workers', 1)
+VALIDATE_POOL = _config_option('validate', 'pool', 'thread')
+
+# How many validated ranges are remembered so that a fast-forward push
+# only has to validate its new commits
+VALIDATE_REMEMBERED_RANGES = _config_option(
+    'validate', 'remembered_ranges', 256)
+
+# Where the verdicts of validated commits are kept, so a commit that is
+# rebased without changing its diff or message is not validated again,
+# and how many verdicts are kept.  Leave the path empty to keep the
+# verdicts in memory only.
+VALIDATE_VERDICT_STORE = _config_option(
+    'validate', 'verdict_store', 'verdicts.sqlite')
+VALIDATE_VERDICT_STORE_ENTRIES = _config_option(
+    'validate', 'verdict_store_entries', 100000)
+
+# Where the index of the rebase branches of each pull request is kept.
+# Leave it empty to keep the index in memory only; it is rebuilt from the
+# rebase branches whenever it is created.
+REBASE_SNAPSHOT_INDEX = _config_option(
+    'rebase', 'snapshot_index', 'rebase-snapshots.sqlite')
+
+# Number of background workers handling webhook events.  The events of
+# one pull request are always handled one at a time.
+WEBHOOK_WORKERS = _config_option('webhook', 'workers', 4)
+
+# Where queued webhook events are kept until they are handled, so they
+# survive restarts.  Leave it empty to keep the queue in memory only.
+WEBHOOK_QUEUE = _config_option('webhook', 'queue', 'webhook-queue.sqlite')
+
+# How long (in seconds) the validation of a pull request waits for more
+# pushes to the pull request before it starts
+WEBHOOK_DEBOUNCE = _config_option('webhook', 'debounce', 10.0)
+
+# How long (in seconds) the ids of accepted webhook deliveries are kept
+# in the webhook queue, so deliveries Github sends again are ignored, and
+# how many of them
+WEBHOOK_DELIVERY_TTL = _config_option('webhook', 'delivery_ttl', 86400)
+WEBHOOK_REMEMBERED_DELIVERIES = _config_option(
+    'webhook', 'remembered_deliveries', 100000)
+
+# The secret Github signs webhook deliveries with.  When it is set,
+# deliveries without a valid X-Hub-Signature-256 header are refused.
+# POSTs to /dead_letters/retry must always be signed with it, so retrying
+# the dead letters is disabled while it is empty.
+WEBHOOK_SECRET = _config_option('webhook', 'secret', '')
+
+# Connection pool size and request timeout (in seconds) for the Github API
+GITHUB_POOL_SIZE = _config_option('github', 'pool_size', 10)
+GITHUB_TIMEOUT = _config_option('github', 'timeout', 10.0)
+
+# How many commits' statuses (and their ETags) are remembered for
+# conditional status lookups
+GITHUB_REMEMBERED_ETAGS = _config_option('github', 'remembered_etags', 1000)
+
+# How to report commit check results: 'statuses' to set a commit status
+# per error, or 'checks' to post a single check run with annotations.  A
+# repo can override this with report_mode in a [repo <org>/<repo>] section.
+GITHUB_REPORT_MODE = _config_option('github', 'report_mode', 'statuses')
+
+# Where the Github writes waiting to be sent are kept, so they survive
+# restarts.  Leave it empty to keep them in memory only.
+GITHUB_OUTBOX = _config_option('github', 'outbox', 'github-outbox.sqlite')
+
+# Page skeleton shared by the in-process HTML renderers.  The classes
+# follow the highlight groups vim's TOhtml emits for the diff syntax
+# under the default colorscheme on a light background, and line numbers
+# are drawn from a data attribute so they are not copied with the code.
+_HTML_PAGE_TEMPLATE = '''<!DOCTYPE html>
+<html>
+<head>
+<meta charset="UTF-8">
+<title>{title}</title>
+<meta name="Generator" content="gitbot">
+<style>
+<!--
+pre {{ white-space: pre-wrap; font-family: monospace; color: #000000; \
+background-color: #ffffff; margin: 0; }}
+body {{ font-family: monospace; color: #000000; background-color: #ffffff; }}
+* {{ font-size: 1em; }}
+.LineNr {{ color: #a52a2a; user-select: none; }}
+[data-LineNr-content]::before {{ content: attr(data-LineNr-content); }}
+.Comment {{ color: #0000ff; }}
+.Constant {{ color: #ff00ff; }}
+.Identifier {{ color: #008b8b; }}
+.PreProc {{ color: #6a0dad; }}
+.Special {{ color: #6a5acd; }}
+.Statement {{ color: #a52a2a; font-weight: bold; }}
+.Type {{ color: #2e8b57; font-weight: bold; }}
+{extra_style}\
+-->
+</style>
+</head>
+<body>
+{body}
+</body>
+</html>
+'''
+
+# Prefixes of diff lines and the highlight group vim's diff syntax gives
+# them, checked in order
+_DIFF_LINE_CLASSES = (
+    ('diff ', 'Type'),
+    ('--- ', 'Type'),
+    ('+++ ', 'Type'),
+    ('+', 'Identifier'),
+    ('-', 'Special'),
+    ('Only in ', 'Constant'),
+    ('Binary files ', 'Constant'),
+    ('#', 'Comment'),
+)
+
+
+def _highlight_diff_line(line):
+    """Return the HTML for a single diff line with syntax highlighting
+
+    Args:
+        line: A line of unified diff output (without the newline)
+
+    Returns:
+        The escaped line wrapped in spans for its highlight groups.
+    """
+    if line.startswith('@@'):
+        end = line.find('@@', 2)
+        if end != -1:
+            end += 2
+            html_line = '<span class="Statement">{0}</span>'.format(
+                cgi.escape(line[:end], quote=True))
+            if line[end:]:
+                html_line += '<span class="PreProc">{0}</span>'.format(
+                    cgi.escape(line[end:], quote=True))
+            return html_line
+
+    for prefix, css_class in _DIFF_LINE_CLASSES:
+        if line.startswith(prefix):
+            return '<span class="{0}">{1}</span>'.format(
+                css_class, cgi.escape(line, quote=True))
+
+    return cgi.escape(line, quote=True)
+
+
+def _render_html_diff(diff_output, title):
+    """Render a diff string to syntax highlighted HTML in-process
+
+    Args:
+        diff_output: The diff as a string
+        title: The title of the generated page
+
+    Returns:
+        HTML output that corresponds to a syntax highlighted diff file,
+        with each line numbered and linkable through an L<number> id.
+    """
+    diff_lines = diff_output.splitlines()
+    number_width = len(str(len(diff_lines)))
+
+    html_lines = ["<pre id='vimCodeElement'>"]
+    for line_number, line in enumerate(diff_lines, 1):
+        html_lines.append(
+            '<span id="L{0}" class="LineNr" '
+            'data-LineNr-content="{0:>{1}} "></span>{2}'.format(
+                line_number, number_width, _highlight_diff_line(line)))
+    html_lines.append('</pre>')
+
+    return _HTML_PAGE_TEMPLATE.format(
+        title=cgi.escape(title, quote=True), extra_style='',
+        body='\n'.join(html_lines))
+
+
+def _generate_html_diff_vim(diff_output, title):
     """Take a diff string and convert it to syntax highligted HTML
 
     This takes a diff string and runs it through vim's TOhtml script to
@@ -56,6 +300,7 @@ def _generate_html_diff(diff_output):
 
     Args:
         diff_output: The diff as a string
+        title: The title of the generated page
 
     Returns:
         HTML output that corresponds to a syntax highlighted diff file.
@@ -86,28 +331,332 @@ def _generate_html_diff(diff_output):
     os.unlink(diff_output_file.name)
     os.unlink(diff_output_file.name + '.html')
 
-    return html_diff_output
+    html_parser = BeautifulSoup(html_diff_output, 'html.parser')
+    html_parser.title.string = title
 
+    return str(html_parser)
 
-def _generate_side_by_side_html_diff(
-        string1_output, string2_output, string3_output=None,
-        string4_output=None):
-    """Generate HTML rendering of a side-by-side diff
+
+def _generate_html_diff(diff_output, title='Diff'):
+    """Take a diff string and convert it to syntax highligted HTML
+
+    The diff is rendered in-process unless the render backend is set to
+    vim in gitbot.cfg, in which case vim's TOhtml script is used.
+
+    Args:
+        diff_output: The diff as a string
+        title: The title of the generated page
+
+    Returns:
+        HTML output that corresponds to a syntax highlighted diff file.
+    """
+    if RENDER_BACKEND == 'vim':
+        return _generate_html_diff_vim(diff_output, title)
+
+    return _render_html_diff(diff_output, title)
+
+
+def _longest_increasing_pairs(pairs):
+    """Return the longest run of pairs whose second items increase
+
+    Args:
+        pairs: A list of (a index, b index) tuples sorted by a index
+
+    Returns:
+        The longest subsequence of pairs that is also sorted by b index,
+        found with patience sorting.
+    """
+    tails = []
+    tail_indexes = []
+    predecessors = []
+    for index, (_, b_index) in enumerate(pairs):
+        pile = bisect.bisect_left(tails, b_index)
+        predecessors.append(tail_indexes[pile - 1] if pile else None)
+        if pile == len(tails):
+            tails.append(b_index)
+            tail_indexes.append(index)
+        else:
+            tails[pile] = b_index
+            tail_indexes[pile] = index
+
+    run = []
+    index = tail_indexes[-1] if tail_indexes else None
+    while index is not None:
+        run.append(pairs[index])
+        index = predecessors[index]
+    run.reverse()
+    return run
+
+
+def _patience_matches(a, b):
+    """Match up the equal lines of two lists with patience diff
+
+    Lines that occur exactly once on both sides of a region are matched
+    first, keeping the longest run of them that is in the same order on
+    both sides, and the gaps between those anchors are matched the same
+    way.  Regions without any unique common line fall back to difflib's
+    matching blocks.
+
+    Args:
+        a: The lines of the first text
+        b: The lines of the second text
+
+    Returns:
+        A sorted list of (a index, b index) tuples of matching lines.
+    """
+    matches = []
+    regions = [(0, len(a), 0, len(b))]
+    while regions:
+        a_lo, a_hi, b_lo, b_hi = regions.pop()
+
+        # Match the common prefix and suffix of the region directly
+        while a_lo < a_hi and b_lo < b_hi and a[a_lo] == b[b_lo]:
+            matches.append((a_lo, b_lo))
+            a_lo += 1
+            b_lo += 1
+        while a_lo < a_hi and b_lo < b_hi and a[a_hi - 1] == b[b_hi - 1]:
+            a_hi -= 1
+            b_hi -= 1
+            matches.append((a_hi, b_hi))
+        if a_lo == a_hi or b_lo == b_hi:
+            continue
+
+        a_unique = {}
+        for a_index in range(a_lo, a_hi):
+            a_unique[a[a_index]] = (
+                None if a[a_index] in a_unique else a_index)
+        b_unique = {}
+        for b_index in range(b_lo, b_hi):
+            b_unique[b[b_index]] = (
+                None if b[b_index] in b_unique else b_index)
+
+        anchors = _longest_increasing_pairs(sorted(
+            (a_index, b_unique[line])
+            for line, a_index in a_unique.items()
+            if a_index is not None and b_unique.get(line) is not None))
+
+        if not anchors:
+            matcher = difflib.SequenceMatcher(
+                None, a[a_lo:a_hi], b[b_lo:b_hi], autojunk=False)
+            for a_index, b_index, size in matcher.get_matching_blocks():
+                for offset in range(size):
+                    matches.append(
+                        (a_lo + a_index + offset, b_lo + b_index + offset))
+            continue
+
+        previous_a, previous_b = a_lo - 1, b_lo - 1
+        for a_index, b_index in anchors:
+            matches.append((a_index, b_index))
+            regions.append(
+                (previous_a + 1, a_index, previous_b + 1, b_index))
+            previous_a, previous_b = a_index, b_index
+        regions.append((previous_a + 1, a_hi, previous_b + 1, b_hi))
+
+    matches.sort()
+    return matches
+
+
+def _align_panes(panes):
+    """Align the lines of two to four texts for a side-by-side view
+
+    Every pane is aligned against the first one with _patience_matches.
+    Lines of the first pane that another pane lacks are paired with the
+    other pane's unmatched lines as changed lines where possible, and the
+    remaining lines of the other pane become insertions.
+
+    Args:
+        panes: A list of texts, each a list of lines
+
+    Returns:
+        A list of rows, where each row has one (line index, kind) tuple
+        per pane.  kind is 'equal', 'change' or 'add', or 'filler' (with
+        a line index of None) when the pane has no line in that row.
+    """
+    first = panes[0]
+    pairs = []
+    inserts = []
+    for other in panes[1:]:
+        pane_pairs = [None] * len(first)
+        pane_inserts = [[] for _ in range(len(first) + 1)]
+        previous_a, previous_b = -1, -1
+        for a_index, b_index in _patience_matches(first, other) + [
+                (len(first), len(other))]:
+            gap_a = range(previous_a + 1, a_index)
+            gap_b = range(previous_b + 1, b_index)
+            for changed_a, changed_b in zip(gap_a, gap_b):
+                pane_pairs[changed_a] = (changed_b, 'change')
+            pane_inserts[a_index].extend(gap_b[len(gap_a):])
+            if a_index < len(first):
+                pane_pairs[a_index] = (b_index, 'equal')
+            previous_a, previous_b = a_index, b_index
+        pairs.append(pane_pairs)
+        inserts.append(pane_inserts)
+
+    filler = (None, 'filler')
+    rows = []
+    for a_index in range(len(first) + 1):
+        gap = max([len(pane_inserts[a_index]) for pane_inserts in inserts])
+        for offset in range(gap):
+            row = [filler]
+            for pane_inserts in inserts:
+                inserted = pane_inserts[a_index]
+                row.append(
+                    (inserted[offset], 'add') if offset < len(inserted)
+                    else filler)
+            rows.append(row)
+
+        if a_index == len(first):
+            break
+
+        row = [None]
+        for pane_pairs in pairs:
+            pair = pane_pairs[a_index]
+            row.append(pair if pair is not None else filler)
+        kinds = set(kind for _, kind in row[1:])
+        if 'change' in kinds:
+            row[0] = (a_index, 'change')
+        elif 'filler' in kinds:
+            row[0] = (a_index, 'add')
+        else:
+            row[0] = (a_index, 'equal')
+        rows.append(row)
+
+    return rows
+
+
+def _highlight_changed_line(line, other_line):
+    """Return the HTML for a changed line of a side-by-side diff
+
+    The part of the line between the first and last characters that
+    differ from other_line is marked as DiffText, the same way vim
+    highlights changes within a line.
+    """
+    prefix = 0
+    limit = min(len(line), len(other_line))
+    while prefix < limit and line[prefix] == other_line[prefix]:
+        prefix += 1
+    suffix = 0
+    while (
+            suffix < limit - prefix and
+            line[-1 - suffix] == other_line[-1 - suffix]):
+        suffix += 1
+
+    return (
+        '<span class="DiffChange">{0}<span class="DiffText">{1}</span>'
+        '{2}</span>'.format(
+            cgi.escape(line[:prefix], quote=True),
+            cgi.escape(line[prefix:len(line) - suffix], quote=True),
+            cgi.escape(line[len(line) - suffix:], quote=True)))
+
+
+# Extra CSS for the side-by-side table, following vim's TOhtml output
+# for diff mode with the default colorscheme on a light background
+_SIDE_BY_SIDE_STYLE = '''\
+table {{ table-layout: fixed; }}
+html, body, table, tbody {{ width: 100%; margin: 0; padding: 0; }}
+table, td, th {{ border: 1px solid; }}
+td {{ vertical-align: top; }}
+th, td {{ width: {width:.1f}%; }}
+td div {{ overflow: auto; }}
+td pre {{ white-space: pre; }}
+.DiffAdd {{ background-color: #add8e6; }}
+.DiffChange {{ background-color: #ffe0ff; }}
+.DiffDelete {{ color: #0000ff; background-color: #e0ffff; font-weight: bold; }}
+.DiffText {{ background-color: #ff8080; font-weight: bold; }}
+'''
+
+# Width of the filler lines drawn where a pane has no line
+_SIDE_BY_SIDE_FILLER = '-' * 40
+
+
+def _render_side_by_side_html_diff(string_outputs, titles, page_title):
+    """Render an aligned side-by-side view of two to four texts
+
+    Args:
+        string_outputs: The texts to show, from left to right
+        titles: The column header for each text
+        page_title: The title of the generated page
+
+    Returns:
+        A string containing the HTML rendering of the side-by-side diff.
+    """
+    panes = [string_output.splitlines() for string_output in string_outputs]
+    rows = _align_panes(panes)
+
+    columns = []
+    for pane_number, lines in enumerate(panes):
+        number_width = len(str(len(lines)))
+        blank_number = ' ' * (number_width + 1)
+        html_lines = []
+        for row in rows:
+            line_index, kind = row[pane_number]
+            if kind == 'filler':
+                html_lines.append(
+                    '<span class="LineNr" data-LineNr-content="{0}"></span>'
+                    '<span class="DiffDelete">{1}</span>'.format(
+                        blank_number, _SIDE_BY_SIDE_FILLER))
+                continue
+
+            line = lines[line_index]
+            if kind == 'equal':
+                html_line = _highlight_diff_line(line)
+            elif kind == 'add':
+                html_line = '<span class="DiffAdd">{0}</span>'.format(
+                    _highlight_diff_line(line))
+            else:
+                # Compare with the first pane, or from the first pane
+                # with the first other pane that changed this line
+                if pane_number:
+                    other_index = row[0][0]
+                    other_lines = panes[0]
+                else:
+                    other_pane = [
+                        pane_kind for _, pane_kind in row].index('change', 1)
+                    other_index = row[other_pane][0]
+                    other_lines = panes[other_pane]
+                html_line = _highlight_changed_line(
+                    line, other_lines[other_index])
+
+            html_lines.append(
+                '<span id="W{0}L{1}" class="LineNr" '
+                'data-LineNr-content="{1:>{2}} "></span>{3}'.format(
+                    pane_number + 1, line_index + 1, number_width,
+                    html_line))
+
+        columns.append(
+            '<td><div>\n<pre>\n{0}\n</pre>\n</div></td>'.format(
+                '\n'.join(html_lines)))
+
+    body = (
+        "<table id='vimCodeElement'>\n"
+        "<tr>\n{headers}\n</tr><tr>\n{columns}\n</tr>\n"
+        "</table>".format(
+            headers='\n'.join(
+                '<th>{0}</th>'.format(cgi.escape(title, quote=True))
+                for title in titles),
+            columns='\n'.join(columns)))
+
+    return _HTML_PAGE_TEMPLATE.format(
+        title=cgi.escape(page_title, quote=True),
+        extra_style=_SIDE_BY_SIDE_STYLE.format(width=100.0 / len(panes)),
+        body=body)
+
+
+def _generate_side_by_side_html_diff_vim(
+        string_outputs, titles, page_title):
+    """Generate HTML rendering of a side-by-side diff with vim
 
     This takes two to four strings and writes them to temporary files.
     Then it runs vim to open all the files with a vertical split, uses the
     TOhtml vim script to convert that into an html file which is then
     written to another temp file.  The content of that file is read into
-    a variable.  Then all temp files are deleted and the string is
-    returned to the caller.
+    a variable.  Then all temp files are deleted, the column headers and
+    page title are filled in and the string is returned to the caller.
 
     Args:
-        string1_output: The string on the left side of the side-by-side
-            diff.
-        string2_output: The string on the right side of the side-by-side
-            diff.
-        string3_output: If provided, the third window in a series diff
-        string3_output: If provided, the fourth window in a series diff
+        string_outputs: The strings to show, from left to right
+        titles: The column header for each string
+        page_title: The title of the generated page
 
     Returns:
         A string containing the HTML rendering of the side-by-side diff,
@@ -115,16 +664,12 @@ def _generate_side_by_side_html_diff(
         diff.
     """
     string_output_files = []
-    for string_output in [
-            string1_output, string2_output, string3_output,
-            string4_output]:
-        if not string_output:
-            break
+    for string_output in string_outputs:
         temp_file = tempfile.NamedTemporaryFile(delete=False)
         with open(temp_file.name, 'w') as t:
             t.write(string_output)
         string_output_files.append(temp_file.name)
-    
+
     side_by_side_html_output_file = tempfile.NamedTemporaryFile(delete=False)
     vim_side_by_side_cmd = shlex.split(
         'vim -O '
@@ -141,18 +686,1277 @@ def _generate_side_by_side_html_diff(
         '-- {string_output_files}'.format(
             side_by_side_html_output_file=side_by_side_html_output_file.name,
             string_output_files=' '.join(string_output_files)))
- 
+
     subprocess.call(vim_side_by_side_cmd)
- 
+
     with open(side_by_side_html_output_file.name) as t:
         side_by_side_html_output = t.read()
- 
+
     # Remove temp files
     os.unlink(side_by_side_html_output_file.name)
     for string_output_file in string_output_files:
         os.unlink(string_output_file)
 
-    return side_by_side_html_output
+    # Replace the file names vim uses as table headers and page title
+    html_parser = BeautifulSoup(side_by_side_html_output, 'html.parser')
+    for title, th_element in zip(titles, html_parser.find_all('th')):
+        th_element.string = title
+    html_parser.title.string = page_title
+
+    return str(html_parser)
+
+
+def _generate_side_by_side_html_diff(string_outputs, titles, page_title):
+    """Generate HTML rendering of a side-by-side diff
+
+    The strings are aligned and rendered in-process unless the render
+    backend is set to vim in gitbot.cfg, in which case vim's diff mode
+    and TOhtml script are used.
+
+    Args:
+        string_outputs: The two to four strings to show, from left to
+            right.  More than two strings make a series diff.
+        titles: The column header for each string
+        page_title: The title of the generated page
+
+    Returns:
+        A string containing the HTML rendering of the side-by-side diff,
+        or if more than two strings are provided, a series side-by-side
+        diff.
+    """
+    if RENDER_BACKEND == 'vim':
+        return _generate_side_by_side_html_diff_vim(
+            string_outputs, titles, page_title)
+
+    return _render_side_by_side_html_diff(string_outputs, titles, page_title)
+
+
+class _RenderCache(object):
+    """Content-addressed cache of rendered diff pages
+
+    Rendered pages are a pure function of the commits they show and the
+    request parameters, so they are stored under a key derived from
+    those.  Pages are kept in a bounded in-memory LRU tier in front of
+    an on-disk tier whose oldest files are evicted once it grows past
+    its size limit.  Concurrent requests for a key that is being
+    rendered wait for that render instead of starting their own.
+    stats are only updated with the lock held, and current_stats returns
+    a consistent copy of them for the /stats endpoint.
+    """
+
+    def __init__(self, memory_bytes, directory, disk_bytes):
+        self.memory_bytes = memory_bytes
+        self.directory = directory
+        self.disk_bytes = disk_bytes
+        self.lock = threading.Lock()
+        self.pages = collections.OrderedDict()
+        self.pages_size = 0
+        self.rendering = {}
+        self.stats = collections.defaultdict(int)
+
+        self.disk_size = 0
+        if self.directory:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            for file_name in os.listdir(self.directory):
+                self.disk_size += os.path.getsize(
+                    os.path.join(self.directory, file_name))
+
+    def get_or_render(self, key, render):
+        """Return the page cached under key, rendering it if needed
+
+        Args:
+            key: The cache key, as returned by _render_cache_key
+            render: A function that takes no arguments and returns the
+                page, called at most once per key at a time
+
+        Returns:
+            The rendered page.
+        """
+        with self.lock:
+            page = self.pages.get(key)
+            if page is not None:
+                self.pages[key] = self.pages.pop(key)
+                self.stats['memory_hits'] += 1
+                return page
+
+            rendered = self.rendering.get(key)
+            if rendered is None:
+                rendered = self.rendering[key] = threading.Event()
+                owner = True
+            else:
+                self.stats['coalesced'] += 1
+                owner = False
+
+        # Wait for the request that is already rendering this page.  If
+        # it failed, the page won't be there and we try again ourselves.
+        if not owner:
+            rendered.wait()
+            return self.get_or_render(key, render)
+
+        try:
+            page = self._read_disk(key)
+            with self.lock:
+                self.stats['misses' if page is None else 'disk_hits'] += 1
+            if page is None:
+                page = render()
+                self._write_disk(key, page)
+            self._remember(key, page)
+        finally:
+            with self.lock:
+                del self.rendering[key]
+            rendered.set()
+
+        return page
+
+    def current_stats(self):
+        """Return a copy of stats, with the size of each tier"""
+        with self.lock:
+            stats = dict(self.stats)
+            stats['memory_bytes'] = self.pages_size
+            stats['disk_bytes'] = self.disk_size
+        return stats
+
+    def _remember(self, key, page):
+        """Add a page to the memory tier, evicting the least recent"""
+        if len(page) > self.memory_bytes:
+            return
+
+        with self.lock:
+            if key in self.pages:
+                return
+            self.pages[key] = page
+            self.pages_size += len(page)
+            while self.pages_size > self.memory_bytes:
+                _, evicted_page = self.pages.popitem(last=False)
+                self.pages_size -= len(evicted_page)
+
+    def _read_disk(self, key):
+        """Return the page stored on disk under key, or None"""
+        if not self.directory:
+            return None
+
+        page_path = os.path.join(self.directory, key)
+        try:
+            with open(page_path) as page_file:
+                page = page_file.read()
+        except IOError:
+            return None
+
+        # Mark the file as recently used for eviction
+        os.utime(page_path, None)
+        return page
+
+    def _write_disk(self, key, page):
+        """Store a page on disk and evict the oldest pages over the limit"""
+        if not self.directory or len(page) > self.disk_bytes:
+            return
+
+        page_file = tempfile.NamedTemporaryFile(
+            dir=self.directory, prefix='.', delete=False)
+        with page_file:
+            page_file.write(page)
+        os.rename(page_file.name, os.path.join(self.directory, key))
+
+        with self.lock:
+            self.disk_size += len(page)
+            if self.disk_size <= self.disk_bytes:
+                return
+
+            page_files = []
+            self.disk_size = 0
+            for file_name in os.listdir(self.directory):
+                try:
+                    page_stat = os.stat(
+                        os.path.join(self.directory, file_name))
+                except OSError:
+                    continue
+                page_files.append(
+                    (page_stat.st_mtime, page_stat.st_size, file_name))
+                self.disk_size += page_stat.st_size
+
+            page_files.sort()
+            for _, size, file_name in page_files:
+                if self.disk_size <= self.disk_bytes:
+                    break
+                try:
+                    os.unlink(os.path.join(self.directory, file_name))
+                except OSError:
+                    continue
+                self.disk_size -= size
+
+
+def _render_cache_key(endpoint, args, sha1s):
+    """Return the render cache key for a request
+
+    Args:
+        endpoint: The name of the endpoint serving the request
+        args: The request's query parameters
+        sha1s: The commits the refs named in the request resolve to
+
+    Returns:
+        A hex digest identifying the rendered page.
+    """
+    key_data = json.dumps(
+        [endpoint, RENDER_BACKEND, sorted(args.items()), sha1s])
+    return hashlib.sha1(key_data).hexdigest()
+
+
+class _GitCoprocess(object):
+    """A long-running git command that answers requests on its stdin
+
+    Commands like git cat-file --batch and git diff-tree --stdin read
+    object names from stdin and write their output for each one, so a
+    single process can serve any number of requests instead of starting
+    a new git for each of them.  Requests are serialized over the one
+    process.  If it exits it is restarted and the request is retried
+    once, and if a request takes longer than the timeout the process is
+    killed and the request fails.
+    """
+
+    def __init__(self, args, git_dir=None, timeout=GIT_TIMEOUT):
+        self.args = args
+        self.git_dir = git_dir
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.process = None
+        self.stats = collections.defaultdict(int)
+
+    def _start(self):
+        self.stats['starts'] += 1
+        self.process = subprocess.Popen(
+            self.args, cwd=self.git_dir, stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE, close_fds=True)
+
+    def _kill(self, process, timed_out):
+        timed_out.append(True)
+        try:
+            process.kill()
+        except OSError:
+            pass
+
+    def request(self, request, read_response):
+        """Send a request to the process and read its response
+
+        Args:
+            request: The text to write to the process's stdin
+            read_response: A function that takes the process's stdout,
+                reads one response from it and returns it.  It raises
+                EOFError if the output ends before the response does.
+
+        Returns:
+            The value returned by read_response.
+        """
+        with self.lock:
+            self.stats['requests'] += 1
+            for attempt in xrange(2):
+                if self.process is None or self.process.poll() is not None:
+                    self._start()
+                process = self.process
+
+                timed_out = []
+                timer = threading.Timer(
+                    self.timeout, self._kill, (process, timed_out))
+                timer.start()
+                try:
+                    process.stdin.write(request)
+                    process.stdin.flush()
+                    return read_response(process.stdout)
+                except (EOFError, IOError):
+                    # The process died (or was killed) so don't reuse it
+                    self._kill(process, [])
+                    process.wait()
+                    self.process = None
+                    if timed_out:
+                        self.stats['timeouts'] += 1
+                        break
+                    self.stats['restarts'] += 1
+                finally:
+                    timer.cancel()
+
+            raise subprocess.CalledProcessError(
+                process.returncode, ' '.join(self.args))
+
+
+class _GitObjects(object):
+    """Object and diff access to a repository through long-running gits
+
+    A git cat-file --batch and a git diff-tree --stdin -p process are
+    kept running for the repository.  diff-tree's output for a commit has
+    no terminator, so each commit is followed by a line that isn't an
+    object name, which diff-tree echoes back once it is done with the
+    commit.
+    """
+
+    SENTINEL = 'gitbot-end-of-output'
+
+    def __init__(self, git_dir=None):
+        self.cat_file = _GitCoprocess(
+            ['git', 'cat-file', '--batch'], git_dir)
+        self.diff_tree = _GitCoprocess(
+            ['git', 'diff-tree', '--stdin', '--always', '--root', '-M', '-p',
+             '--no-color', '--no-ext-diff'],
+            git_dir)
+
+    @staticmethod
+    def _read_object(stdout):
+        header = stdout.readline()
+        if not header.endswith('\n'):
+            raise EOFError
+        fields = header.split()
+        if len(fields) != 3:
+            # <name> missing (or ambiguous)
+            return None
+
+        sha1, object_type, size = fields
+        content = stdout.read(int(size) + 1)
+        if len(content) != int(size) + 1:
+            raise EOFError
+        return sha1, object_type, content[:-1]
+
+    def read_object(self, name):
+        """Read an object from the repository
+
+        Args:
+            name: Anything git cat-file --batch accepts as an object name
+                (a sha1, a ref, <ref>^{commit}, ...)
+
+        Returns:
+            A (sha1, object type, content) tuple, or None if there is no
+            such object.
+        """
+        return self.cat_file.request(
+            '{name}\n'.format(name=name), self._read_object)
+
+    def _read_until_sentinel(self, stdout):
+        lines = []
+        while True:
+            line = stdout.readline()
+            if not line.endswith('\n'):
+                raise EOFError
+            if line == self.SENTINEL + '\n':
+                return ''.join(lines)
+            lines.append(line)
+
+    def commit_diff(self, commit_sha1):
+        """Return the patch a commit makes to its (first) parent"""
+        output = self.diff_tree.request(
+            '{commit_sha1}\n{sentinel}\n'.format(
+                commit_sha1=commit_sha1, sentinel=self.SENTINEL),
+            self._read_until_sentinel)
+
+        # Drop the commit sha1 line diff-tree starts its output with
+        return output.partition('\n')[2]
+
+
+git_objects = _GitObjects()
+
+
+# The organization, user and repository names Github allows
+_REPO_NAME_RE = re.compile(r'[A-Za-z0-9._-]+\Z')
+
+
+class _MissingMirror(Exception):
+    """Raised by _RepoMirrors.git_dir for a repo that has no mirror yet"""
+
+
+class _RepoMirrors(object):
+    """One bare mirror repository per org/repo
+
+    Every org/repo is fetched into its own bare repository under root
+    (<root>/<org>/<repo>.git), created by the first fetch from the repo,
+    so the history searches and ref listings for a repo only see its own
+    objects and refs.  Each mirror borrows objects from the alternates
+    object directories.  With no root every repo is fetched into the
+    repository gitbot runs in, and git_dir is None.
+
+    Every git command for a repo runs in the repo's git_dir, and objects
+    returns the _GitObjects of a git_dir.
+    """
+
+    def __init__(self, root, alternates):
+        self.root = root
+        self.alternates = alternates
+        self.lock = threading.Lock()
+        self.git_objects = {None: git_objects}
+
+    def git_dir(self, org_name, repo_name, create=False):
+        """Return the mirror of a repo
+
+        Args:
+            org_name: The organization of the repo
+            repo_name: The name of the repo
+            create: Whether to create the mirror if it is missing.  Only
+                fetches create mirrors.
+
+        Raises:
+            ValueError: org_name or repo_name is not a name Github allows
+            _MissingMirror: The repo has no mirror and create is False
+        """
+        for name in [org_name, repo_name]:
+            if not _REPO_NAME_RE.match(name) or name in ['.', '..']:
+                raise ValueError(
+                    'Invalid repository name {name!r}'.format(name=name))
+        if not self.root:
+            return None
+
+        git_dir = os.path.abspath(os.path.join(
+            self.root, org_name, '{repo}.git'.format(repo=repo_name)))
+        with self.lock:
+            if not os.path.isdir(git_dir):
+                if not create:
+                    raise _MissingMirror(git_dir)
+                self._create(git_dir)
+        return git_dir
+
+    def git_dirs(self):
+        """Return the git_dir of every mirror there is"""
+        if not self.root:
+            return [None]
+        if not os.path.isdir(self.root):
+            return []
+        return [
+            os.path.abspath(os.path.join(self.root, org_name, repo))
+            for org_name in sorted(os.listdir(self.root))
+            if os.path.isdir(os.path.join(self.root, org_name))
+            for repo in sorted(os.listdir(os.path.join(self.root, org_name)))
+            if repo.endswith('.git')]
+
+    def _create(self, git_dir):
+        # Create the mirror next to where it goes and move it into place,
+        # so a half-created mirror is never used
+        parent = os.path.dirname(git_dir)
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        temp_dir = tempfile.mkdtemp(dir=parent)
+        subprocess.check_call(['git', 'init', '-q', '--bare', temp_dir])
+        alternates = [
+            os.path.abspath(alternate)
+            for alternate in self.alternates.splitlines() if alternate]
+        if alternates:
+            with open(os.path.join(
+                    temp_dir, 'objects', 'info', 'alternates'), 'w') as f:
+                f.write(''.join(
+                    alternate + '\n' for alternate in alternates))
+        os.rename(temp_dir, git_dir)
+
+    def objects(self, git_dir):
+        """Return the _GitObjects of a git_dir"""
+        with self.lock:
+            objects = self.git_objects.get(git_dir)
+            if objects is None:
+                objects = self.git_objects[git_dir] = _GitObjects(git_dir)
+            return objects
+
+
+mirrors = _RepoMirrors(MIRRORS_ROOT, MIRRORS_ALTERNATES)
+
+
+def _fetch_command(org_name, repo_name, url, refspec):
+    """Return the git fetch command for one refspec of a repo
+
+    The fetch uses protocol v2, skips tags and leaves FETCH_HEAD alone,
+    and only offers the repo's own fetched base branches and pull
+    request heads as the commits it already has, however many other
+    refs the repository holds.
+    """
+    return [
+        'git', '-c', 'protocol.version=2', 'fetch', '--no-tags',
+        '--no-write-fetch-head',
+        '--negotiation-tip=refs/gitbot/remotes/{org}/{repo}/*'.format(
+            org=org_name, repo=repo_name),
+        '--negotiation-tip=refs/gitbot/pulls/{org}/{repo}/*'.format(
+            org=org_name, repo=repo_name),
+        url, refspec]
+
+
+def _resolve_refs(refs, git_dir=None):
+    """Resolve refs to the commit sha1s they currently point to
+
+    Args:
+        refs: A list of ref names (or anything else git rev-parse
+            accepts)
+        git_dir: The repository (see _RepoMirrors)
+
+    Returns:
+        A list with the full commit sha1 of each ref.
+    """
+    objects = mirrors.objects(git_dir)
+    sha1s = []
+    for ref in refs:
+        commit = objects.read_object('{0}^{{commit}}'.format(ref))
+        if commit is None:
+            raise subprocess.CalledProcessError(
+                128, 'git cat-file --batch {0}'.format(ref))
+        sha1s.append(commit[0])
+    return sha1s
+
+
+class _BaseRefCache(object):
+    """Freshness tracking for the local copies of PR base branches
+
+    Each org/repo/base branch is fetched into its own local ref under
+    refs/gitbot/remotes/ and the time of the fetch and the sha1 it
+    resolved to are recorded.  Requests within the TTL are served from
+    that ref without touching the network; once an entry is older than
+    the refresh threshold it is fetched again in the background.
+    Concurrent fetches of the same branch are coalesced into one.
+    stats are only updated with the lock held, and current_stats returns
+    a consistent copy of them for the /stats endpoint.
+    """
+
+    def __init__(self, ttl, refresh_after):
+        self.ttl = ttl
+        self.refresh_after = refresh_after
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.fetching = {}
+        self.stats = collections.defaultdict(int)
+
+    def resolve(self, org, repo, base_branch):
+        """Return the sha1 of a base branch, fetching it if it is stale
+
+        Args:
+            org: The Github organization (or user) owning the repo
+            repo: The repository name
+            base_branch: The name of the base branch
+
+        Returns:
+            The sha1 the base branch points to.
+        """
+        key = org, repo, base_branch
+        with self.lock:
+            entry = self.entries.get(key)
+            age = None
+            if entry is not None:
+                age = time.time() - entry[0]
+            hit = age is not None and age < self.ttl
+            self.stats['hits' if hit else 'misses'] += 1
+
+        if not hit:
+            return self._fetch(key)
+        if age >= self.refresh_after:
+            self._fetch_in_background(key)
+        return entry[1]
+
+    def current_stats(self):
+        """Return a copy of stats, with the number of branches kept"""
+        with self.lock:
+            stats = dict(self.stats)
+            stats['branches'] = len(self.entries)
+        return stats
+
+    def invalidate(self, org, repo, base_branch):
+        """Forget a base branch so that the next request fetches it"""
+        with self.lock:
+            self.entries.pop((org, repo, base_branch), None)
+
+    def _fetch_in_background(self, key):
+        with self.lock:
+            if key in self.fetching:
+                return
+        fetch_thread = threading.Thread(target=self._fetch, args=(key, ))
+        fetch_thread.daemon = True
+        fetch_thread.start()
+
+    def _fetch(self, key):
+        """Fetch a base branch, or wait for the fetch already running"""
+        with self.lock:
+            fetched = self.fetching.get(key)
+            if fetched is None:
+                fetched = self.fetching[key] = threading.Event()
+                owner = True
+            else:
+                self.stats['coalesced'] += 1
+                owner = False
+
+        if not owner:
+            fetched.wait()
+            with self.lock:
+                entry = self.entries.get(key)
+            if entry is not None:
+                return entry[1]
+            return self._fetch(key)
+
+        org, repo, base_branch = key
+        local_ref = 'refs/gitbot/remotes/{org}/{repo}/{base_branch}'.format(
+            org=org, repo=repo, base_branch=base_branch)
+        try:
+            # Fetch into our own ref (and leave FETCH_HEAD alone) so this
+            # can run alongside other fetches
+            git_dir = mirrors.git_dir(org, repo, create=True)
+            fetch_cmd = _fetch_command(
+                org, repo,
+                'git@{github_hostname}:{org}/{repo}.git'.format(
+                    github_hostname=GITHUB_HOSTNAME, org=org, repo=repo),
+                '+refs/heads/{base_branch}:{local_ref}'.format(
+                    base_branch=base_branch, local_ref=local_ref))
+            with self.lock:
+                self.stats['fetches'] += 1
+            fetch_failed = subprocess.call(fetch_cmd, cwd=git_dir)
+
+            # If the fetch failed we can still serve the copy we have,
+            # but we'll try fetching again on the next request
+            sha1, = _resolve_refs([local_ref], git_dir)
+            if not fetch_failed:
+                with self.lock:
+                    self.entries[key] = time.time(), sha1
+            return sha1
+        finally:
+            with self.lock:
+                del self.fetching[key]
+            fetched.set()
+
+
+render_cache = _RenderCache(
+    RENDER_CACHE_MEMORY_BYTES, RENDER_CACHE_DIRECTORY,
+    RENDER_CACHE_DISK_BYTES)
+base_refs = _BaseRefCache(BASE_FETCH_TTL, BASE_FETCH_REFRESH_AFTER)
+
+# One lock per pull request head ref, so only one thread fetches into it
+# at a time.  Other processes are kept out by git's own ref lock.
+_pull_request_fetch_locks = collections.defaultdict(threading.Lock)
+_pull_request_fetch_locks_lock = threading.Lock()
+
+
+def _fetch_pull_request_head(
+        org_name, repo_name, pr_number, url, expected_sha1=None):
+    """Fetch the head of a pull request into its own ref
+
+    The head is fetched into refs/gitbot/pulls/<org>/<repo>/<PR-number>
+    rather than FETCH_HEAD, so requests for other pull requests (or other
+    repos) can fetch at the same time.
+
+    Args:
+        org_name: The organization of the repo
+        repo_name: The name of the repo
+        pr_number: The number of the pull request
+        url: The URL of the repo to fetch from
+        expected_sha1: The head the webhook event announced, if any
+
+    Returns:
+        The sha1 of the fetched head.
+
+    Raises:
+        subprocess.CalledProcessError: The fetch failed, or Github's pull
+            request ref doesn't have the expected head yet (so the
+            webhook job is retried).
+    """
+    local_ref = 'refs/gitbot/pulls/{org}/{repo}/{pr_number}'.format(
+        org=org_name, repo=repo_name, pr_number=pr_number)
+    with _pull_request_fetch_locks_lock:
+        lock = _pull_request_fetch_locks[local_ref]
+
+    with lock:
+        git_dir = mirrors.git_dir(org_name, repo_name, create=True)
+        fetch_cmd = _fetch_command(
+            org_name, repo_name, url,
+            '+refs/pull/{pr_number}/head:{local_ref}'.format(
+                pr_number=pr_number, local_ref=local_ref))
+        subprocess.check_call(fetch_cmd, cwd=git_dir)
+        sha1, = _resolve_refs([local_ref], git_dir)
+
+    # A later push may already have moved the head past the expected one,
+    # but then the expected commit was fetched before
+    if expected_sha1 is not None and sha1 != expected_sha1:
+        _resolve_refs([expected_sha1], git_dir)
+    return sha1
+
+
+class _GitHubClient(object):
+    """A shared, keep-alive client for the Github API
+
+    All calls go through one pooled requests session so connections (and
+    their TLS handshakes) are reused across webhook events.  Commit status
+    lookups are made conditional on the ETag of the previous response for
+    the same commit; a 304 is answered from the cached body and does not
+    count against the API rate limit.  Only the max_etags most recently
+    used commits are remembered.
+
+    stats holds the status lookup cache hits and misses and latency the
+    number of calls and the total and maximum latency of each endpoint.
+    Both are only updated with the lock held, and current_stats returns a
+    consistent copy of them for the /stats endpoint.
+    """
+
+    MAX_ANNOTATIONS = 50
+    CHECKS_HEADERS = {'Accept': 'application/vnd.github+json'}
+
+    def __init__(
+            self, endpoint, username, token, pool_size, timeout, max_etags):
+        self.endpoint = endpoint
+        self.timeout = timeout
+        self.max_etags = max_etags
+        self.session = requests.Session()
+        self.session.auth = requests.auth.HTTPBasicAuth(username, token)
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.lock = threading.Lock()
+        self.etags = collections.OrderedDict()
+        self.stats = collections.defaultdict(int)
+        self.latency = collections.defaultdict(
+            lambda: {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+        self.rate_limit_remaining = None
+        self.rate_limit_reset = None
+
+    def _request(self, name, method, path, **kwargs):
+        """Make a Github API call and record its latency under name"""
+        url = '{endpoint}{path}'.format(endpoint=self.endpoint, path=path)
+        start = time.time()
+        try:
+            response = self.session.request(
+                method, url, timeout=self.timeout, **kwargs)
+        finally:
+            elapsed = time.time() - start
+            with self.lock:
+                latency = self.latency[name]
+                latency['calls'] += 1
+                latency['seconds'] += elapsed
+                latency['max_seconds'] = max(latency['max_seconds'], elapsed)
+
+        remaining = response.headers.get('X-RateLimit-Remaining')
+        reset = response.headers.get('X-RateLimit-Reset')
+        if remaining is not None and reset is not None:
+            with self.lock:
+                self.rate_limit_remaining = int(remaining)
+                self.rate_limit_reset = int(reset)
+        return response
+
+    def rate_limit_wait(self):
+        """Return how long to wait (in seconds) for the rate limit to reset
+
+        This is 0 unless the last response said the rate limit has been
+        used up.
+        """
+        with self.lock:
+            if self.rate_limit_remaining != 0:
+                return 0
+            return max(0, self.rate_limit_reset - time.time())
+
+    def current_stats(self):
+        """Return a copy of stats, with the latency of each endpoint"""
+        with self.lock:
+            stats = dict(self.stats)
+            stats['latency'] = dict(
+                (name, dict(latency))
+                for name, latency in self.latency.items())
+        return stats
+
+    def get_statuses(self, org, repo, sha1):
+        """Return the list of statuses set on a commit"""
+        path = '/repos/{org}/{repo}/commits/{sha1}/statuses'.format(
+            org=org, repo=repo, sha1=sha1)
+        with self.lock:
+            cached = self.etags.pop(path, None)
+            if cached is not None:
+                self.etags[path] = cached
+
+        headers = {}
+        if cached is not None:
+            headers['If-None-Match'] = cached[0]
+        response = self._request(
+            'GET statuses', 'GET', path, headers=headers)
+
+        if response.status_code == 304 and cached is not None:
+            with self.lock:
+                self.stats['status_cache_hits'] += 1
+            return cached[1]
+
+        with self.lock:
+            self.stats['status_cache_misses'] += 1
+        response.raise_for_status()
+        statuses = response.json()
+        etag = response.headers.get('ETag')
+        if etag:
+            with self.lock:
+                self.etags.pop(path, None)
+                self.etags[path] = etag, statuses
+                while len(self.etags) > self.max_etags:
+                    self.etags.popitem(last=False)
+        return statuses
+
+    def post_status(self, org, repo, sha1, state, context, description):
+        """Set a status on a commit"""
+        path = '/repos/{org}/{repo}/commits/{sha1}/statuses'.format(
+            org=org, repo=repo, sha1=sha1)
+        post_body = {
+            'state': state,
+            'context': context,
+            'description': description,
+        }
+
+        # The cached statuses of this commit are out of date now
+        with self.lock:
+            self.etags.pop(path, None)
+        return self._request('POST status', 'POST', path, json=post_body)
+
+    def post_comment(self, org, repo, pr_number, body):
+        """Post a comment on a pull request"""
+        path = '/repos/{org}/{repo}/issues/{pr_number}/comments'.format(
+            org=org, repo=repo, pr_number=pr_number)
+        return self._request(
+            'POST comment', 'POST', path, json={'body': body})
+
+    def post_check_run(
+            self, org, repo, head_sha1, name, conclusion, output,
+            annotations, progress=None):
+        """Create a completed check run on a commit
+
+        The Checks API takes at most MAX_ANNOTATIONS annotations per
+        request, so the first batch is sent with the check run and the
+        rest are added to it by updating the run.  The id of the run and
+        the number of batches sent are kept in progress, so calling this
+        again with the same progress after a request failed carries on
+        from that request instead of creating another run.
+
+        Args:
+            org: The Github organization (or user) owning the repo
+            repo: The repository name
+            head_sha1: The sha1 of the commit to create the run on
+            name: The name of the check run
+            conclusion: The check run conclusion (e.g. 'failure')
+            output: A dict with the title and summary of the run
+            annotations: A list of annotation dicts
+            progress: A dict recording how far an earlier call got, or
+                None
+
+        Returns:
+            The response of the last request that was made.
+        """
+        if progress is None:
+            progress = {}
+        path = '/repos/{org}/{repo}/check-runs'.format(org=org, repo=repo)
+        batches = [
+            annotations[i:i + self.MAX_ANNOTATIONS]
+            for i in xrange(0, len(annotations), self.MAX_ANNOTATIONS)]
+        if not batches:
+            batches = [[]]
+
+        if 'run_id' not in progress:
+            post_body = {
+                'name': name,
+                'head_sha': head_sha1,
+                'status': 'completed',
+                'conclusion': conclusion,
+                'output': dict(output, annotations=batches[0]),
+            }
+            response = self._request(
+                'POST check run', 'POST', path, json=post_body,
+                headers=self.CHECKS_HEADERS)
+            if not response.ok:
+                return response
+            progress['run_id'] = response.json()['id']
+            progress['batches_sent'] = 1
+
+        run_path = '{path}/{run_id}'.format(
+            path=path, run_id=progress['run_id'])
+        for batch in batches[progress['batches_sent']:]:
+            response = self._request(
+                'PATCH check run', 'PATCH', run_path,
+                json={'output': dict(output, annotations=batch)},
+                headers=self.CHECKS_HEADERS)
+            if not response.ok:
+                return response
+            progress['batches_sent'] += 1
+        return response
+
+
+github = _GitHubClient(
+    GITHUB_API_ENDPOINT, USERNAME, PERSONAL_ACCESS_TOKEN, GITHUB_POOL_SIZE,
+    GITHUB_TIMEOUT, GITHUB_REMEMBERED_ETAGS)
+
+
+class _GitHubOutbox(object):
+    """A write-behind queue for Github status, check run and comment writes
+
+    Writes are queued and sent by a background thread, so webhook requests
+    don't wait on them.  The thread sends as fast as the rate limit
+    headers of the responses allow: when the rate limit is used up it
+    waits for it to reset.  Writes that hit a secondary rate limit (429,
+    or a 403 with a Retry-After or an X-RateLimit-Remaining: 0 header) or
+    a server error are retried after the Retry-After delay (in seconds or
+    as an HTTP date, and at most MAX_RETRY_AFTER seconds), or with
+    exponential backoff if there is none.  Any other 403 (e.g. missing
+    permissions) would fail every time, so it is not retried.
+
+    A status (or check run) queued for a commit and context that already
+    has one waiting to be sent replaces it, since only the latest one
+    matters.
+
+    Every write is stored in a sqlite table before it is queued and
+    deleted once it is sent (or dropped), and recover queues the writes
+    the last run left there, so writes waiting when gitbot stopped are
+    still sent.  A check run that was partly sent carries on from the
+    batch that was being sent.
+
+    stats are only updated with the condition held, and current_stats
+    returns a consistent copy of them for the /stats endpoint.
+    """
+
+    MAX_ATTEMPTS = 6
+    MAX_RETRY_AFTER = 300
+    RETRY_STATUS_CODES = frozenset([429, 500, 502, 503, 504])
+
+    def __init__(self, client, path):
+        self.client = client
+        self.path = path or ':memory:'
+        self.condition = threading.Condition()
+        self.pending = collections.OrderedDict()
+        self.thread = None
+        self.stats = collections.defaultdict(int)
+        self.db_lock = threading.Lock()
+        self._db = None
+
+    def _connect(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            with self._db:
+                self._db.execute(
+                    'CREATE TABLE IF NOT EXISTS writes ('
+                    'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                    'key TEXT UNIQUE NOT NULL, write TEXT NOT NULL, '
+                    'args TEXT NOT NULL)')
+        return self._db
+
+    def _execute(self, statement, parameters=()):
+        with self.db_lock:
+            db = self._connect()
+            with db:
+                return db.execute(statement, parameters).lastrowid
+
+    def post_status(self, org, repo, sha1, state, context, description):
+        """Queue a status to set on a commit"""
+        self._enqueue(
+            ('status', org, repo, sha1, context), 'post_status',
+            (org, repo, sha1, state, context, description))
+
+    def post_comment(self, org, repo, pr_number, body):
+        """Queue a comment to post on a pull request"""
+        self._enqueue(
+            ('comment', uuid.uuid4().hex), 'post_comment',
+            (org, repo, pr_number, body))
+
+    def post_check_run(
+            self, org, repo, head_sha1, name, conclusion, output,
+            annotations):
+        """Queue a check run to create on a commit
+
+        Retries of the write share its progress, so a retry after an
+        annotation batch failed only resends that batch and the ones
+        after it.
+        """
+        self._enqueue(
+            ('check run', org, repo, head_sha1, name), 'post_check_run',
+            (org, repo, head_sha1, name, conclusion, output, annotations,
+             {}))
+
+    def current_stats(self):
+        """Return a copy of stats"""
+        with self.condition:
+            return dict(self.stats)
+
+    def recover(self):
+        """Queue the writes the last run left in the outbox"""
+        with self.db_lock:
+            rows = self._connect().execute(
+                'SELECT id, key, write, args FROM writes '
+                'ORDER BY id').fetchall()
+        with self.condition:
+            for write_id, key, write, args in rows:
+                self.pending[tuple(json.loads(key))] = (
+                    write_id, str(write), json.loads(args))
+                self.stats['recovered'] += 1
+            self._start()
+
+    def _enqueue(self, key, write, args):
+        with self.condition:
+            # Stored with the condition held, so the stored write of a key
+            # is always the one waiting in pending
+            write_id = self._execute(
+                'INSERT OR REPLACE INTO writes (key, write, args) '
+                'VALUES (?, ?, ?)',
+                (json.dumps(key), write, json.dumps(args)))
+            if key in self.pending:
+                self.stats['coalesced'] += 1
+                del self.pending[key]
+            self.pending[key] = write_id, write, args
+            self.stats['queued'] += 1
+            self._start()
+
+    def _start(self):
+        # Called with the condition held, once writes have been queued
+        self.stats['depth'] = len(self.pending)
+        if not self.pending:
+            return
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._drain)
+            self.thread.daemon = True
+            self.thread.start()
+        self.condition.notify()
+
+    def _drain(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                key, (write_id, write, args) = self.pending.popitem(
+                    last=False)
+                self.stats['depth'] = len(self.pending)
+
+            try:
+                self._write(key, write_id, write, args)
+            except Exception as e:
+                # Never let one bad write stop the thread
+                with self.condition:
+                    self.stats['dropped'] += 1
+                print 'Github write {key} failed: {error}'.format(
+                    key=key, error=e)
+            self._execute('DELETE FROM writes WHERE id = ?', (write_id,))
+
+    def _should_retry(self, response):
+        """Check whether a failed write may succeed if it is sent again"""
+        if response.status_code == 403:
+            return (
+                'Retry-After' in response.headers or
+                response.headers.get('X-RateLimit-Remaining') == '0')
+        return response.status_code in self.RETRY_STATUS_CODES
+
+    def _retry_after(self, response):
+        """Return the seconds a response asks to wait before a retry
+
+        Returns:
+            The delay of the response's Retry-After header (given either
+            in seconds or as an HTTP date), at most MAX_RETRY_AFTER, or
+            None if it has no header that can be parsed.
+        """
+        retry_after = response.headers.get('Retry-After')
+        if retry_after is None:
+            return None
+        try:
+            delay = int(retry_after)
+        except ValueError:
+            date = email.utils.parsedate_tz(retry_after)
+            if date is None:
+                return None
+            delay = email.utils.mktime_tz(date) - time.time()
+        return min(max(delay, 0), self.MAX_RETRY_AFTER)
+
+    def _write(self, key, write_id, write, args):
+        for attempt in xrange(self.MAX_ATTEMPTS):
+            time.sleep(self.client.rate_limit_wait())
+
+            try:
+                response = getattr(self.client, write)(*args)
+            except requests.RequestException as e:
+                response, error = None, e
+            else:
+                if not self._should_retry(response):
+                    response.raise_for_status()
+                    with self.condition:
+                        self.stats['written'] += 1
+                    return
+                error = response.status_code
+
+            # A newer write for the same key replaces this one
+            with self.condition:
+                if key in self.pending:
+                    self.stats['superseded'] += 1
+                    return
+                self.stats['retries'] += 1
+
+                # Store how far a check run got
+                self._execute(
+                    'UPDATE writes SET args = ? WHERE id = ?',
+                    (json.dumps(args), write_id))
+
+            retry_after = None
+            if response is not None:
+                retry_after = self._retry_after(response)
+            if retry_after is not None:
+                time.sleep(retry_after)
+            elif not self.client.rate_limit_wait():
+                time.sleep(2 ** attempt)
+
+        raise RuntimeError(
+            'gave up after {attempts} attempts ({error})'.format(
+                attempts=self.MAX_ATTEMPTS, error=error))
+
+
+outbox = _GitHubOutbox(github, GITHUB_OUTBOX)
+
+
+def _has_failure_status(statuses):
+    """Check whether gitbot has already failed a commit
+
+    Args:
+        statuses: The statuses of a commit, as returned by the Github API
+
+    Returns:
+        True if one of the statuses is a gitbot failure.
+    """
+    for status in statuses:
+        if (
+                status['context'].startswith('gitbot') and
+                status['state'] == 'failure'):
+            return True
+    return False
+
+
+def _set_commit_statuses(
+        org_name, repo_name, commit_info, head_sha1,
+        previous_commit_info=None):
+    """Mark the commits of a PR branch that failed their checks
+
+    Each failing commit gets a failure status per error, unless gitbot has
+    already failed it.  The statuses are queued on the outbox rather than
+    set before returning.  If any commit in the branch has failed, the head
+    commit is failed as well so that Github won't consider the branch to
+    be in a good state.
+
+    Commits whose errors are the same as in previous_commit_info were
+    already failed by the run that found them, so their statuses aren't
+    looked up again.
+
+    Args:
+        org_name: The Github organization (or user) owning the repo
+        repo_name: The repository name
+        commit_info: A dict of commit sha1 to a list of (context,
+            description, location) errors, as returned by
+            _parse_commit_log
+        head_sha1: The sha1 of the head commit of the branch
+        previous_commit_info: The commit_info of an earlier run over the
+            branch that this one extends, if any
+    """
+    if previous_commit_info is None:
+        previous_commit_info = {}
+
+    branch_status_set = False
+    for sha1, errors in commit_info.items():
+        # If there are no issues with the commit, then skip it
+        if errors == []:
+            continue
+
+        branch_status_set = True
+
+        # If the errors haven't changed, their statuses are already set
+        if previous_commit_info.get(sha1) == errors:
+            continue
+
+        # If status is already set, we don't need to set it again
+        if _has_failure_status(github.get_statuses(org_name, repo_name, sha1)):
+            continue
+
+        # If there are a number of issues with the commit, then it's best
+        # to post a separate status for each of them.  If the description
+        # line gets too long, then the status doesn't get set like it
+        # should.
+        for error in errors:
+            outbox.post_status(
+                org_name, repo_name, sha1, 'failure',
+                'gitbot-{context}'.format(context=error[0]), error[1])
+
+    # Even if one or more commits are marked as failed in a branch that's
+    # pull requested, Github will still consider the branch to be in a good
+    # state if the head commit is not marked as failed.  To get around
+    # this, if any of the commits in the branch are marked as failed, we
+    # mark the head commit the same way (even if there's nothing else wrong
+    # with it).
+    if not branch_status_set:
+        return
+
+    # If status is already set, then we don't need to set it again
+    if not _has_failure_status(
+            github.get_statuses(org_name, repo_name, head_sha1)):
+        outbox.post_status(
+            org_name, repo_name, head_sha1, 'failure', 'gitbot-branch-check',
+            'Branch contains commits in failure state')
+
+
+def _report_mode(org_name, repo_name):
+    """Return how commit check results are reported for a repo"""
+    section = 'repo {org}/{repo}'.format(org=org_name, repo=repo_name)
+    return _config_option(section, 'report_mode', GITHUB_REPORT_MODE)
+
+
+def _post_check_run(org_name, repo_name, commit_info, head_sha1):
+    """Report the checks of a PR branch as a single check run
+
+    The check run is created on the head commit and has one annotation
+    per error found in a commit's diff, on the line of the file the error
+    is about (the post-image line for added lines, the pre-image line for
+    removed ones).  Errors in commit messages are not about any file, so
+    they are listed in the summary of the run instead.
+
+    Args:
+        org_name: The Github organization (or user) owning the repo
+        repo_name: The repository name
+        commit_info: A dict of commit sha1 to a list of (context,
+            description, location) errors, as returned by
+            _parse_commit_log
+        head_sha1: The sha1 of the head commit of the branch
+    """
+    failed_sha1s = sorted(
+        sha1 for sha1, errors in commit_info.items() if errors)
+
+    annotations = []
+    unattached_errors = []
+    for sha1 in failed_sha1s:
+        for context, description, location in commit_info[sha1]:
+            title = 'gitbot-{context}'.format(context=context)
+            message = '{sha1:.12}: {description}'.format(
+                sha1=sha1, description=description)
+            if location is None:
+                unattached_errors.append('* {title}: {message}'.format(
+                    title=title, message=message))
+                continue
+            path, line_number = location
+            annotations.append({
+                'path': path,
+                'start_line': line_number,
+                'end_line': line_number,
+                'annotation_level': 'failure',
+                'title': title,
+                'message': message,
+            })
+
+    if failed_sha1s:
+        conclusion = 'failure'
+        summary = 'Branch contains commits in failure state'
+        if unattached_errors:
+            summary += (
+                '\n\nProblems in commit messages:\n\n' +
+                '\n'.join(unattached_errors))
+        output = {
+            'title': '{count} problem(s) in {commits} commit(s)'.format(
+                count=len(annotations) + len(unattached_errors),
+                commits=len(failed_sha1s)),
+            'summary': summary,
+        }
+    else:
+        conclusion = 'success'
+        output = {
+            'title': 'All commits passed',
+            'summary': 'No problems found in {commits} commit(s)'.format(
+                commits=len(commit_info)),
+        }
+
+    outbox.post_check_run(
+        org_name, repo_name, head_sha1, 'gitbot', conclusion, output,
+        annotations)
+
+
+def _report_commit_checks(
+        org_name, repo_name, commit_info, head_sha1,
+        previous_commit_info=None):
+    """Report the checks of a PR branch in the repo's report mode"""
+    if _report_mode(org_name, repo_name) == 'checks':
+        _post_check_run(org_name, repo_name, commit_info, head_sha1)
+    else:
+        _set_commit_statuses(
+            org_name, repo_name, commit_info, head_sha1,
+            previous_commit_info)
 
 
 def _generate_github_rebase_comment(
@@ -491,223 +2295,448 @@ def _generate_github_rebase_comment(
     return comment_block
 
 
-def _validate_email(email_addr, addr_type):
-    """Check the Committer and Author values of a commit
+_HUNK_HEADER_RE = re.compile(
+    r'^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@')
 
-    Check whether the Committer and Author values are using their first
-    and last name as the display name and a valid domain in their email
-    address.
 
-    If the values do not pass the checks, then return a list of strings
-    that explain each error.
+def _parse_diff_output(diff_output):
+    """Parse unified diff text into its added and removed lines
+
+    Walk the file headers and hunks of a diff (as printed by git show,
+    git diff-tree -p or git log -p) and collect every added and removed
+    line.  Hunk lengths are taken from the @@ header so that content
+    lines which happen to look like diff headers are not misread, and
+    extended headers (new file mode, rename from, ...) are skipped.
+    Combined diffs of merge commits (@@@ headers) contribute no lines.
 
     Args:
-        email_addr: Address corresponding to the commit
-        addr_type: either 'Author' or 'Committer'
+        diff_output: The diff as a string
 
     Returns:
-        A list of strings corresponding to each error
+        A list of (path, line_type, line, line_number) tuples in diff
+        order, where path is the post-image path of the file (or the
+        pre-image path for deleted files), line_type is '+' or '-', line
+        is the content without its prefix and line_number is the line's
+        position in the post-image (for added lines) or the pre-image
+        (for removed lines).
     """
-    errors = []
-    display_name, email_address = email_addr.rsplit(' ', 1)
-    email_address = email_address.strip('<>')
+    diff_lines = []
+    path = None
+    old_path = None
+    old_line_number = 0
+    new_line_number = 0
+    old_remaining = 0
+    new_remaining = 0
+    for line in diff_output.splitlines():
+        if old_remaining > 0 or new_remaining > 0:
+            line_type = line[:1]
+            if line_type == '+':
+                diff_lines.append(
+                    (path, line_type, line[1:], new_line_number))
+                new_line_number += 1
+                new_remaining -= 1
+            elif line_type == '-':
+                diff_lines.append(
+                    (path, line_type, line[1:], old_line_number))
+                old_line_number += 1
+                old_remaining -= 1
+            elif line_type == ' ' or line == '':
+                old_line_number += 1
+                new_line_number += 1
+                old_remaining -= 1
+                new_remaining -= 1
+            continue
 
-    if display_name == 'root':
-        errors.append((
-            '{addr_type}-root-check'.format(addr_type=addr_type.lower()),
-            '{addr_type} is root instead of real name'.format(
-                addr_type=addr_type)))
+        if line.startswith('--- '):
+            old_path = line[4:].split('/', 1)[-1]
+            continue
 
-    if ' ' not in display_name:
-        errors.append((
-            '{addr_type}-real-name-check'.format(addr_type=addr_type.lower()),
-            '{addr_type} does not contain first and last name'.format(
-                addr_type=addr_type)))
+        if line.startswith('+++ '):
+            path = line[4:].split('/', 1)[-1]
+            if line[4:] == '/dev/null':
+                path = old_path
+            continue
 
-    email_local, email_domain = email_address.rsplit('@', 1)
+        hunk_header = _HUNK_HEADER_RE.match(line)
+        if hunk_header:
+            old_start, old_length, new_start, new_length = (
+                hunk_header.groups())
+            old_line_number = int(old_start)
+            new_line_number = int(new_start)
+            old_remaining = 1 if old_length is None else int(old_length)
+            new_remaining = 1 if new_length is None else int(new_length)
 
-    github_domain_list = filter(lambda x: x, COMMIT_VALID_DOMAINS.splitlines())
-    if email_domain not in github_domain_list:
-        errors.append((
-            '{addr_type}-valid-domain-check'.format(addr_type=addr_type.lower()),
-            '{addr_type} email address domain must be in {domains}'.format(
-                addr_type=addr_type, domains=github_domain_list)))
+    return diff_lines
 
-    return errors
 
+def _line_fingerprint(line):
+    """Return the fingerprint used to match a diff line across commits
+
+    Leading and trailing whitespace is ignored so that re-indented
+    lines still match.  Lines that are blank once stripped have no
+    fingerprint.
+    """
+    line = line.strip()
+    if not line:
+        return None
+    return hashlib.sha1(line).digest()
+
+
+class _RangeContext(object):
+    """The commits of a range and their diffs, shared by all the checks
+
+    A range context is built once per validation run.  It lists the
+    commits of the range in order (oldest first) and reads and parses
+    each commit's diff the first time a check asks for it.  The churn
+    and move indexes, the whitespace check results and the patch ids
+    (which are computed from the same diffs) are also built on first
+    use.  diff_reads counts how many times each commit's diff was read
+    from git, which is never more than once.
+    git_dir is the repository holding the commits (see _RepoMirrors).
+
+    When the range only adds commits to the range of previous (the
+    _RangeVerdicts of an earlier run over the same base), new_sha1s holds
+    the added commits, and only they are checked for whitespace errors.
+    """
 
-def _parse_diff(commit_sha1):
-    """Parse the diff associated with a commit
+    def __init__(self, base_commit, tip_commit, git_dir=None, previous=None):
+        self.base_commit = base_commit
+        self.tip_commit = tip_commit
+        self.git_dir = git_dir
+
+        rev_list_cmd = shlex.split(
+            'git rev-list --reverse {base_commit}..{tip_commit}'.format(
+                base_commit=base_commit, tip_commit=tip_commit))
+        self.sha1s = subprocess.check_output(
+            rev_list_cmd, cwd=git_dir).split()
+        self.positions = dict(
+            (commit_sha1, position)
+            for position, commit_sha1 in enumerate(self.sha1s))
+
+        # The commits added since an earlier run over the same base, when
+        # the range is checked incrementally.  Only commits after
+        # whitespace_base are checked for whitespace errors (and have
+        # their patch ids read).
+        self.new_sha1s = None
+        self.whitespace_base = base_commit
+        if previous is not None:
+            previous_sha1s = [result[0] for result in previous.results]
+            if (
+                    previous_sha1s and
+                    self.sha1s[:len(previous_sha1s)] == previous_sha1s):
+                self.new_sha1s = frozenset(self.sha1s[len(previous_sha1s):])
+                self.whitespace_base = previous.tip_sha1
+
+        self.diff_reads = collections.Counter()
+        self._diffs = {}
+        self._diff_lines = {}
+        self._churn_index = None
+        self._move_index = None
+        self._whitespace_errors = None
+        self._patch_ids = None
+
+    def sha1s_after(self, commit_sha1):
+        """Return the commits that come after commit_sha1 in the range"""
+        return self.sha1s[self.positions[commit_sha1] + 1:]
+
+    def diff(self, commit_sha1):
+        """Return the diff of a commit (see _GitObjects.commit_diff)"""
+        diff = self._diffs.get(commit_sha1)
+        if diff is None:
+            self.diff_reads[commit_sha1] += 1
+            diff = self._diffs[commit_sha1] = mirrors.objects(
+                self.git_dir).commit_diff(commit_sha1)
+        return diff
+
+    def diff_lines(self, commit_sha1):
+        """Return the parsed diff of a commit (see _parse_diff_output)"""
+        diff_lines = self._diff_lines.get(commit_sha1)
+        if diff_lines is None:
+            diff_lines = self._diff_lines[commit_sha1] = _parse_diff_output(
+                self.diff(commit_sha1))
+        return diff_lines
+
+    @property
+    def churn_index(self):
+        if self._churn_index is None:
+            self._churn_index = _ChurnIndex(self)
+        return self._churn_index
+
+    @property
+    def move_index(self):
+        if self._move_index is None:
+            self._move_index = _MoveIndex(self)
+        return self._move_index
+
+    @property
+    def whitespace_errors(self):
+        if self._whitespace_errors is None:
+            self._whitespace_errors = _read_range_whitespace_errors(
+                self.whitespace_base, self.tip_commit, self.git_dir)
+        return self._whitespace_errors
+
+    @property
+    def patch_ids(self):
+        if self._patch_ids is None:
+            sha1s = self.sha1s
+            if self.whitespace_base in self.positions:
+                sha1s = self.sha1s_after(self.whitespace_base)
+            self._patch_ids = _compute_patch_ids(
+                [(commit_sha1, self.diff(commit_sha1))
+                 for commit_sha1 in sha1s],
+                self.git_dir)
+        return self._patch_ids
+
+    def verdict_key(self, commit):
+        """Return the key of a commit's verdict in the verdict store
+
+        The key is made of the commit's patch id, a hash of everything
+        the commit message rules look at and the ruleset version, so it
+        is the same for a commit that is rebased without changing its
+        diff or message.  Commits without a diff (merges and empty
+        commits) have an empty patch id.
+        """
+        message_hash = hashlib.sha1(repr((
+            commit.author, commit.committer, len(commit.parents),
+            commit.title, commit.separator, commit.body))).hexdigest()
+        return '{0} {1} {2}'.format(
+            self.patch_ids.get(commit.sha1, ''), message_hash,
+            _RULESET_VERSION)
+
+
+class _ChurnIndex(object):
+    """Line fingerprint index over the diffs of a commit range
+
+    The index is built from the range context's diffs and maps
+    the fingerprint of every added or removed line to the positions of
+    the commits that change how many times that line appears in a file.
+    Lines are matched whole (ignoring leading and trailing whitespace),
+    unlike git log -S, which also matches a line that is only part of
+    the changed text, such as a substring of a longer line.  Lines that
+    a commit only moves around within a file leave the count unchanged
+    and are left to the move check.  The first line (in diff order) of
+    each commit that changes a fingerprint's count is kept as the
+    location of that change.
+    """
 
-    The diff associated with commit is normally the difference between
-    the state of the tree in that commit and the state of the tree in
-    one or more of its parent commits.  This method will parse that diff
-    and return a list of lines that correspond to added and/or deleted
-    lines of code.
+    def __init__(self, range_context):
+        self.range_context = range_context
+        self.fingerprints = collections.defaultdict(list)
+        self.locations = {}
+
+        for position, commit_sha1 in enumerate(range_context.sha1s):
+            line_counts = collections.OrderedDict()
+            line_numbers = {}
+            for path, line_type, line, line_number in (
+                    range_context.diff_lines(commit_sha1)):
+                fingerprint = _line_fingerprint(line)
+                if fingerprint is None:
+                    continue
+                line_counts[path, fingerprint] = (
+                    line_counts.get((path, fingerprint), 0) +
+                    (1 if line_type == '+' else -1))
+                line_numbers.setdefault((path, fingerprint), line_number)
+
+            for (path, fingerprint), count in line_counts.items():
+                if count and (position, fingerprint) not in self.locations:
+                    self.fingerprints[fingerprint].append(position)
+                    self.locations[position, fingerprint] = (
+                        path, line_numbers[path, fingerprint])
+
+    def sha1s_changing(self, fingerprint, commit_sha1):
+        """Return the later commits that add or remove a fingerprint"""
+        positions = self.fingerprints.get(fingerprint, [])
+        start = bisect.bisect_right(
+            positions, self.range_context.positions[commit_sha1])
+        return [
+            self.range_context.sha1s[position]
+            for position in positions[start:]]
+
+    def location(self, fingerprint, commit_sha1):
+        """Return the (path, line number) where a commit changes a line"""
+        return self.locations[
+            self.range_context.positions[commit_sha1], fingerprint]
+
+
+def _diff_blocks(diff_lines):
+    """Group diff lines into blocks of adjacent lines of the same type
+
+    A block is a run of added (or removed) lines that sit next to each
+    other in the same file.  Blank lines are dropped before grouping so
+    that a moved block still matches when blank lines around it change.
 
     Args:
-        commit_sha1: The commit to check
+        diff_lines: The output of _parse_diff_output
 
     Returns:
-        A set of strings where each string is either an added or
-        removed line (including the corresponding '+' or '-' prefix).
-    """
-    class DiffState(object):
-        START = 0
-        DIFF_BLOCK_LINE = 1
-        INDEX_LINE = 2
-        A_LINE = 3
-        B_LINE = 4
-        AT_LINE = 5
-        DIFF_LINES = 6
-
-    diff_cmd = shlex.split('git show {commit_sha1}'.format(
-        commit_sha1=commit_sha1))
-    diff_output = subprocess.check_output(diff_cmd)
-
-    diff_lines = set()
-    state = DiffState.START
-    for line in diff_output.splitlines():
-        if state in [DiffState.START, DiffState.DIFF_LINES] and line.startswith('diff '):
-            state = DiffState.DIFF_BLOCK_LINE
-            continue
-
-        if state == DiffState.DIFF_BLOCK_LINE and line.startswith('index '):
-            state = DiffState.INDEX_LINE
-            continue
-
-        if state == DiffState.INDEX_LINE and line.startswith('--- '):
-            state = DiffState.A_LINE
-            continue
-
-        if state == DiffState.A_LINE and line.startswith('+++ '):
-            state = DiffState.B_LINE
-            continue
+        A list of (line_type, lines, locations) tuples, where lines is the
+        list of the block's non-blank lines and locations holds the
+        (path, line number) of each of them.
+    """
+    blocks = []
+    previous = None
+    for path, line_type, line, line_number in diff_lines:
+        if (
+                previous is None or
+                previous != (path, line_type, line_number - 1)):
+            blocks.append((line_type, [], []))
+        previous = path, line_type, line_number
 
-        if state in [DiffState.B_LINE, DiffState.DIFF_LINES] and line.startswith('@@ '):
-            state = DiffState.AT_LINE
-            continue
+        if line.strip():
+            blocks[-1][1].append(line)
+            blocks[-1][2].append((path, line_number))
 
-        if state in [DiffState.AT_LINE, DiffState.DIFF_LINES] and (
-                line.startswith(('+', '-', ' '))):
-            state = DiffState.DIFF_LINES
+    return [block for block in blocks if block[1]]
 
-            if line.startswith(' '):
-                continue
-            diff_lines.add(line)
-            continue
 
-        state = DiffState.START
-    return diff_lines
+class _MoveIndex(object):
+    """Block index over the diffs of a commit range
 
+    Every non-blank added or removed line of the range is indexed by
+    its type and exact content, along with the block it belongs to and
+    its offset in that block.  A block of one commit is matched against
+    the blocks of later commits by extending runs of consecutive
+    matching lines, the same way git diff --color-moved finds moved
+    blocks, so the cost is linear in the number of matching lines
+    rather than lines times commits.
+    """
 
-def _check_diff_add_delete(commit_sha1, head_sha1):
+    # Matched runs with fewer alphanumeric characters than this are
+    # ignored, just like git's --color-moved (COLOR_MOVED_MIN_ALNUM_COUNT)
+    MIN_ALNUM_COUNT = 20
+
+    def __init__(self, range_context):
+        self.range_context = range_context
+        self.blocks = {}
+        self.added_lines = {}
+        self.lines = collections.defaultdict(list)
+
+        for position, commit_sha1 in enumerate(range_context.sha1s):
+            blocks = _diff_blocks(range_context.diff_lines(commit_sha1))
+            self.blocks[commit_sha1] = blocks
+            self.added_lines[commit_sha1] = set(
+                line
+                for line_type, lines, _ in blocks if line_type == '+'
+                for line in lines)
+
+            for block_number, (line_type, lines, _) in enumerate(blocks):
+                for offset, line in enumerate(lines):
+                    self.lines[line_type, line].append(
+                        (position, block_number, offset))
+
+    def matching_runs(self, commit_sha1, line_type, lines):
+        """Find the runs of a block that later commits also contain
+
+        Args:
+            commit_sha1: The commit the block belongs to
+            line_type: The type of the lines ('+' or '-') to look for
+                in later commits
+            lines: The block's lines
+
+        Returns:
+            A list of (commit sha1, start, end, location) tuples, one for
+            each run of lines[start:end] that appears as consecutive lines
+            of a block of type line_type in a later commit, where location
+            is the (path, line number) of the run's first line in the
+            later commit.
+        """
+        sha1s = self.range_context.sha1s
+        position = self.range_context.positions[commit_sha1]
+        runs = []
+        active = {}
+
+        def end_runs(end):
+            for (later_position, block_number, offset), run_start in (
+                    active.items()):
+                later_sha1 = sha1s[later_position]
+                location = self.blocks[later_sha1][block_number][2][
+                    offset - (end - 1 - run_start)]
+                runs.append((later_sha1, run_start, end, location))
+
+        for index, line in enumerate(lines):
+            occurrences = self.lines.get((line_type, line), [])
+            start = bisect.bisect_left(occurrences, (position + 1, ))
+
+            continued = {}
+            for later_position, block_number, offset in occurrences[start:]:
+                continued[later_position, block_number, offset] = active.pop(
+                    (later_position, block_number, offset - 1), index)
+
+            end_runs(index)
+            active = continued
+
+        end_runs(len(lines))
+        return runs
+
+
+def _later_sha1s(commit_sha1, range_context, later_sha1s=None):
+    """Return the commits after commit_sha1 that a check should look at"""
+    branch_sha1s = range_context.sha1s_after(commit_sha1)
+    if later_sha1s is None:
+        return branch_sha1s
+    return [sha1 for sha1 in branch_sha1s if sha1 in later_sha1s]
+
+
+def _check_diff_add_delete(commit_sha1, range_context, later_sha1s=None):
     """Check added code is not removed and vice versa
 
     We want to determine whether later commits in the same branch remove
     or duplicate code that was added by an earlier commit in the branch
     or if removed code is re-added or removed in another location.  This
-    can be done by passing a line of the commit's associated diff to the
-    -S parameter of git-log.
+    is answered from a fingerprint index of every line added or removed
+    in the branch, which is built once for the whole commit range.
 
     Args:
         commit_sha1: The commit whose diff we want to check
-        head_sha1: The commit that's the current head of the branch
+        range_context: The _RangeContext of the branch's commit range
+        later_sha1s: If set, only these later commits are checked
 
     Returns:
         A tuple consisting of a dict mapping commit sha1 to an error
         message (which is a tuple of the context and description used
-        in the Github status API). and a list of commits that weren't
-        marked.
+        in the Github status API, and the (path, line number) of the
+        line in that commit's diff the error is about). and a list of
+        commits that weren't marked.
     """
     commit_info = {}
-    branch_sha1s = []
-
-    # Get list of commits between this one and the branch head
-    git_log_cmd = shlex.split(
-        'git log --oneline --no-abbrev --reverse '
-        '{commit_sha1}..{head_sha1}'.format(
-            commit_sha1=commit_sha1, head_sha1=head_sha1))
-    git_log_output = subprocess.check_output(git_log_cmd)
-
-    for git_log_line in git_log_output.splitlines():
-        if git_log_line == '':
-            continue
-
-        branch_sha1, _ = git_log_line.split(' ', 1)
-        branch_sha1s.append(branch_sha1)
 
-    # If there are no commits to check then just return an empty dict
-    # and empty list tuple
+    # Get list of commits between this one and the branch head.  If
+    # there are no commits to check then just return an empty dict and
+    # empty list tuple
+    branch_sha1s = _later_sha1s(commit_sha1, range_context, later_sha1s)
     if branch_sha1s == []:
         return commit_info, branch_sha1s
 
-    diff_lines = _parse_diff(commit_sha1)
-
+    churn_index = range_context.churn_index
     context = 'diff-add-delete-check'
-    for diff_line in diff_lines:
-        line_type, line = diff_line[0], diff_line[1:]
-
-        # Skip blank lines
-        if line == '':
+    checked_lines = set()
+    for _, line_type, line, _ in range_context.diff_lines(commit_sha1):
+        # Skip blank lines and lines we've already looked up
+        fingerprint = _line_fingerprint(line)
+        if fingerprint is None or (line_type, fingerprint) in checked_lines:
             continue
+        checked_lines.add((line_type, fingerprint))
 
-        # Use the -S parameter of git log to check whether an added line
-        # was removed or duplicated in a later commit, or whether a
-        # removed line was re-added or also removed elsewhere in a later
-        # commit
-
-        # Escape double-quotes
-        line = re.sub(r'"', r'\\\"', line)
-        git_log_s_str = (
-            'git log --oneline --no-abbrev --reverse -S"{line}" '
-            '{commit_sha1}..{head_sha1}'.format(
-                line=line, commit_sha1=commit_sha1, head_sha1=head_sha1))
-        try:
-            git_log_s_cmd = shlex.split(git_log_s_str)
-            print 'Running git log -S"{line}"'.format(line=line)
-            print 'git_log_s_cmd: {git_log_s_cmd}'.format(
-                git_log_s_cmd=git_log_s_cmd)
-
-            git_log_s_output = subprocess.check_output(git_log_s_cmd)
-            print 'git_log_s_output: {git_log_s_output}'.format(
-                git_log_s_output=git_log_s_output)
-        except (subprocess.CalledProcessError, ValueError) as e:
-            print 'Exception when running git log -S"{line}"'.format(line=line)
-            print 'Exception was {e}'.format(e=e)
-            try:
-                print 'git_log_s_cmd: {git_log_s_cmd}'.format(
-                    git_log_s_cmd=git_log_s_cmd)
-            except Exception as ex:
-                print 'git_log_s_cmd not defined: {ex}'.format(ex=ex)
-                print (
-                    'Failed to run shlex.split on {git_log_s_str}'.format(
-                        git_log_s_str=git_log_s_str))
-            git_log_s_output = ''
-            pass
-
-        for git_log_s_line in git_log_s_output.splitlines():
-            sha1_s, _ = git_log_s_line.split(' ', 1)
+        # Check whether an added line was removed or duplicated in a
+        # later commit, or whether a removed line was re-added or also
+        # removed elsewhere in a later commit
+        for sha1_s in churn_index.sha1s_changing(fingerprint, commit_sha1):
+            if later_sha1s is not None and sha1_s not in later_sha1s:
+                continue
 
-            if sha1_s not in commit_info.keys():
-                message = None
+            if sha1_s not in commit_info:
                 if line_type == '+':
                     description = (
                         'Adds or removes lines matching a line added in '
                         '{commit_sha1}'.format(commit_sha1=commit_sha1))
-                    message = context, description
-                elif line_type == '-':
+                else:
                     description = (
                         'Adds or removes lines matching a line removed in '
                         '{commit_sha1}'.format(commit_sha1=commit_sha1))
-                    message = context, description
-                else:
-                    print (
-                        'Got line_type "{line_type}" instead of '
-                        '"-" or "+" in _check_diff_add_delete'.format(
-                            line_type=line_type))
 
-                commit_info[sha1_s] = [message]
+                commit_info[sha1_s] = [(
+                    context, description,
+                    churn_index.location(fingerprint, sha1_s))]
 
             # Remove this sha1 from branch_sha1s
             if sha1_s in branch_sha1s:
@@ -721,128 +2750,90 @@ def _check_diff_add_delete(commit_sha1, head_sha1):
     return commit_info, branch_sha1s
 
 
-def _check_diff_move(commit_sha1, head_sha1):
+def _check_diff_move(commit_sha1, range_context, later_sha1s=None):
     """Check added or changed code has not been moved
 
     We want to determine whether later commits in the same branch move
     code that was updated in an earlier commit.
 
-    For example, if a commit adds a line:
+    For example, if a commit adds a block of lines:
 
         Add this line
+        And this one
 
-    then this method would detect whether that line is
+    then this method would detect whether that block is
     moved elsewhere in the same file or to a different file in a later
     commit in the same branch.
 
-    If a commit removes a line like:
+    If a commit removes a block like:
 
         Remove this line
+        And this one
 
     in a commit, and a subsequent commit in the branch adds that same
-    line, then this method would also detect it.
+    block, then this method would also detect it.
 
-    This can be done by passing a line of the commit's associated diff
-    to the -G parameter of git-log (after backslash escaping any regular
-    expression meta-characters).
+    This is done by matching the commit's blocks of added and removed
+    lines against the blocks of later commits in the move index, which
+    is built once for the whole commit range.  Matches with too little
+    alphanumeric content (closing braces, blank lines) are ignored.
 
     Args:
         commit_sha1: The commit whose diff we want to check
-        head_sha1: The commit that's the current head of the branch
+        range_context: The _RangeContext of the branch's commit range
+        later_sha1s: If set, only these later commits are checked
 
     Returns:
         A tuple consisting of a dict mapping commit sha1 to an error
         message (which is a tuple of the context and description used
-        in the Github status API). and a list of commits that weren't
-        marked.
+        in the Github status API, and the (path, line number) of the
+        line in that commit's diff the error is about). and a list of
+        commits that weren't marked.
     """
     commit_info = {}
-    branch_sha1s = []
-
-    # Get list of commits between this one and the branch head
-    git_log_cmd = shlex.split(
-        'git log --oneline --no-abbrev --reverse '
-        '{commit_sha1}..{head_sha1}'.format(
-            commit_sha1=commit_sha1, head_sha1=head_sha1))
-
-    git_log_output = subprocess.check_output(git_log_cmd)
-
-    for git_log_line in git_log_output.splitlines():
-        if git_log_line == '':
-            continue
-
-        branch_sha1, _ = git_log_line.split(' ', 1)
-        branch_sha1s.append(branch_sha1)
 
-    # If there are no commits to check then just return an empty dict
-    # and empty list tuple
+    # Get list of commits between this one and the branch head.  If
+    # there are no commits to check then just return an empty dict and
+    # empty list tuple
+    branch_sha1s = _later_sha1s(commit_sha1, range_context, later_sha1s)
     if branch_sha1s == []:
         return commit_info, branch_sha1s
 
-    diff_lines = _parse_diff(commit_sha1)
-
+    move_index = range_context.move_index
     context = 'diff-move-check'
-    for diff_line in diff_lines:
-        line_type, line = diff_line[0], diff_line[1:]
-
-        # Skip blank lines
-        if line == '':
-            continue
-
-        # Use the -G parameter of git log to check whether an added or
-        # deleted line was moved in a later commit
-
-        # Escape regex meta-characters
-        line = re.sub(r'([].^$*+?{}\\[|()"])', r'\\\1', line)
-
-        git_log_g_str = (
-            'git log --oneline --no-abbrev --reverse -G"^{line}$" '
-            '{commit_sha1}..{head_sha1}'.format(
-                line=line, commit_sha1=commit_sha1, head_sha1=head_sha1))
-        try:
-            git_log_g_cmd = shlex.split(git_log_g_str)
-            print 'Running git log -G"^{line}$"'.format(line=line)
-            print 'git_log_g_cmd: {git_log_g_cmd}'.format(
-                git_log_g_cmd=git_log_g_cmd)
-            git_log_g_output = subprocess.check_output(git_log_g_cmd)
-            print 'git_log_g_output: {git_log_g_output}'.format(
-                git_log_g_output=git_log_g_output)
-
-        except (subprocess.CalledProcessError, ValueError) as e:
-            print 'Exception when running git log -G"^{line}$"'.format(line=line)
-            print 'Exception was {e}'.format(e=e)
-            try:
-                print 'git_log_g_cmd: {git_log_g_cmd}'.format(
-                    git_log_g_cmd=git_log_g_cmd)
-            except Exception as ex:
-                print 'git_log_g_cmd not defined: {ex}'.format(ex=ex)
-                print (
-                    'Failed to run shlex.split on {git_log_g_str}'.format(
-                        git_log_g_str=git_log_g_str))
-            git_log_g_output = ''
-            pass
+    for line_type, lines, _ in move_index.blocks[commit_sha1]:
+        # Lines added here are moved if a later commit removes them and
+        # adds them back somewhere else.  Lines removed here are moved if
+        # a later commit adds them back.
+        if line_type == '+':
+            runs = move_index.matching_runs(commit_sha1, '-', lines)
+        else:
+            runs = move_index.matching_runs(commit_sha1, '+', lines)
+
+        for sha1_g, start, end, location in runs:
+            if sha1_g in commit_info:
+                continue
+            if later_sha1s is not None and sha1_g not in later_sha1s:
+                continue
 
-        for git_log_g_line in git_log_g_output.splitlines():
-            sha1_g, _ = git_log_g_line.split(' ', 1)
+            run_lines = lines[start:end]
+            alnum_count = sum(
+                1 for line in run_lines for c in line if c.isalnum())
+            if alnum_count < move_index.MIN_ALNUM_COUNT:
+                continue
 
-            if sha1_g not in commit_info.keys():
-                message = None
-                if line_type == '+':
-                    description = (
-                        'Removes a line matching a line added in '
-                        '{commit_sha1}'.format(commit_sha1=commit_sha1))
-                    message = context, description
-                elif line_type == '-':
-                    description = (
-                        'Re-adds a line matching a line removed in '
-                        '{commit_sha1}'.format(commit_sha1=commit_sha1))
-                    message = context, description
-                else:
-                    print (
-                        'Got line_type "{line_type}" instead of '
-                        '"-" or "+" in _check_diff_move'.format(line_type=line_type))
+            if line_type == '+':
+                if not move_index.added_lines[sha1_g].issuperset(run_lines):
+                    continue
+                description = (
+                    'Removes a line matching a line added in '
+                    '{commit_sha1}'.format(commit_sha1=commit_sha1))
+            else:
+                description = (
+                    'Re-adds a line matching a line removed in '
+                    '{commit_sha1}'.format(commit_sha1=commit_sha1))
 
-                commit_info[sha1_g] = [message]
+            commit_info[sha1_g] = [(context, description, location)]
 
             # Remove this sha1 from branch_sha1s
             if sha1_g in branch_sha1s:
@@ -856,12 +2847,323 @@ def _check_diff_move(commit_sha1, head_sha1):
     return commit_info, branch_sha1s
 
 
-def _validate_commit(
-        commit_sha1, merge, author, committer, title, separator, body):
+class _CommitRecord(object):
+    """The parts of a commit that are validated
+
+    Attributes:
+        sha1: The full sha1 of the commit
+        parents: A list of the sha1s of the commit's parents
+        author: The author of the commit ("Name <email>")
+        committer: The committer of the commit ("Name <email>")
+        title: The first line of the commit message
+        separator: The line separating the title and the body of the
+            commit message, or None if the message is a single line
+        body: The body of the commit message (a list of strings where
+            each element corresponds to a line in the body)
+    """
+
+    __slots__ = (
+        'sha1', 'parents', 'author', 'committer', 'title', 'separator',
+        'body')
+
+    def __init__(self, sha1, parents, author, committer, message):
+        self.sha1 = sha1
+        self.parents = parents.split()
+        self.author = author
+        self.committer = committer
+
+        message_lines = message.rstrip('\n').split('\n')
+        self.title = message_lines[0]
+        self.separator = None
+        if len(message_lines) > 1:
+            self.separator = message_lines[1]
+        self.body = message_lines[2:]
+
+
+# Fields of each commit in the git log output read by _read_commit_log
+_COMMIT_LOG_FORMAT = '%H%x00%P%x00%an <%ae>%x00%cn <%ce>%x00%B'
+_COMMIT_LOG_FIELDS = 5
+
+
+def _read_commit_log(base_commit, tip_commit, git_dir=None):
+    """Read the commits of a range, oldest first
+
+    The log is read as it is produced instead of all at once.  Fields are
+    separated by NUL bytes (and so are commits, because of -z), so
+    commit messages can contain anything.
+
+    Args:
+        base_commit: commit that, along with its ancestors, is excluded
+            from the range
+        tip_commit: commit that, along with its ancestors, is included
+            in the range
+        git_dir: The repository holding the range (see _RepoMirrors)
+
+    Yields:
+        A _CommitRecord for each commit in the range.
+    """
+    git_log_cmd = shlex.split(
+        "git log -z --reverse --format='{log_format}' "
+        "{base_commit}..{tip_commit}".format(
+            log_format=_COMMIT_LOG_FORMAT, base_commit=base_commit,
+            tip_commit=tip_commit))
+    git_log = subprocess.Popen(
+        git_log_cmd, cwd=git_dir, stdout=subprocess.PIPE)
+
+    try:
+        fields = []
+        partial_field = ''
+        for chunk in iter(lambda: git_log.stdout.read(64 * 1024), ''):
+            chunk_fields = (partial_field + chunk).split('\0')
+            partial_field = chunk_fields.pop()
+            fields.extend(chunk_fields)
+
+            while len(fields) >= _COMMIT_LOG_FIELDS:
+                yield _CommitRecord(*fields[:_COMMIT_LOG_FIELDS])
+                del fields[:_COMMIT_LOG_FIELDS]
+
+        # The last commit isn't followed by a NUL
+        if partial_field:
+            fields.append(partial_field)
+        if len(fields) == _COMMIT_LOG_FIELDS:
+            yield _CommitRecord(*fields)
+
+        if git_log.wait():
+            raise subprocess.CalledProcessError(
+                git_log.returncode, ' '.join(git_log_cmd))
+    finally:
+        # Don't leave git running if the caller stops reading early
+        if git_log.poll() is None:
+            git_log.kill()
+            git_log.wait()
+
+
+class _CommitRule(object):
+    """A check of a commit that reports under its own status context
+
+    Attributes:
+        context: The status context of the rule (without the gitbot-
+            prefix)
+        description: The status description used when a commit breaks
+            the rule
+        check: A function that takes a _CommitRecord and returns True if
+            the commit breaks the rule
+        calls: How many commits the rule has checked
+        seconds: The total time spent checking them
+    """
+
+    __slots__ = ('context', 'description', 'check', 'calls', 'seconds')
+
+    def __init__(self, context, description, check):
+        self.context = context
+        self.description = description
+        self.check = check
+        self.calls = 0
+        self.seconds = 0.0
+
+
+class _CommitRuleEngine(object):
+    """The registry of commit message rules
+
+    Rules are registered once, when the module is loaded, and are run in
+    the order they were registered.  Each rule counts its calls and the
+    time spent in them.  Commits are checked by several threads at once,
+    so the counts are only updated with the lock held.  The counts of
+    rules run in forked validation workers stay in the workers.
+    """
+
+    def __init__(self):
+        self.rules = []
+        self.lock = threading.Lock()
+
+    def rule(self, context, description):
+        """Register the decorated function as a rule"""
+        def register(check):
+            self.add(context, description, check)
+            return check
+        return register
+
+    def add(self, context, description, check):
+        """Register a rule"""
+        self.rules.append(_CommitRule(context, description, check))
+
+    def check(self, commit):
+        """Run every rule over a commit
+
+        Args:
+            commit: The _CommitRecord of the commit
+
+        Returns:
+            A list of (context, description, None) tuples for the rules
+            the commit breaks.  Message rules have no location in a file.
+        """
+        errors = []
+        timings = []
+        for rule in self.rules:
+            start = time.time()
+            broken = rule.check(commit)
+            timings.append(time.time() - start)
+            if broken:
+                errors.append((rule.context, rule.description, None))
+
+        with self.lock:
+            for rule, seconds in zip(self.rules, timings):
+                rule.calls += 1
+                rule.seconds += seconds
+        return errors
+
+    def run(self, commits):
+        """Run every rule over a batch of commits
+
+        Yields:
+            A (commit sha1, errors) tuple for each commit, where errors
+            is the result of check.
+        """
+        for commit in commits:
+            yield commit.sha1, self.check(commit)
+
+    def current_stats(self):
+        """Return the call count and total time of each rule, by context"""
+        with self.lock:
+            return dict(
+                (rule.context, {'calls': rule.calls, 'seconds': rule.seconds})
+                for rule in self.rules)
+
+
+commit_rules = _CommitRuleEngine()
+
+# Words a commit title can start with and domains author and committer
+# email addresses can use
+_COMMIT_TITLE_START_WORDS = frozenset(
+    word for word in COMMIT_TITLE_START_WORDS.splitlines() if word)
+_COMMIT_VALID_DOMAIN_LIST = [
+    domain for domain in COMMIT_VALID_DOMAINS.splitlines() if domain]
+_COMMIT_VALID_DOMAINS = frozenset(_COMMIT_VALID_DOMAIN_LIST)
+
+_TITLE_IMPERATIVE_TENSE_RE = re.compile(r'(ed|ing|s)$')
+_TITLE_CAPITALIZATION_RE = re.compile(r'^[^A-Z]')
+_TITLE_FIXUP_RE = re.compile(r'^fixup!')
+_TITLE_SQUASH_RE = re.compile(r'^squash!')
+_TITLE_END_RE = re.compile(r'[\s\W]$')
+
+
+def _split_identity(identity):
+    """Split "Name <email>" into the display name and the email domain"""
+    display_name, email_address = identity.rsplit(' ', 1)
+    _, email_domain = email_address.strip('<>').rsplit('@', 1)
+    return display_name, email_domain
+
+
+def _add_identity_rules(addr_type, get_identity):
+    """Register the rules checking the Author or Committer of a commit
+
+    The Committer and Author values have to use the person's first and
+    last name as the display name and a valid domain in their email
+    address.
+
+    Args:
+        addr_type: either 'Author' or 'Committer'
+        get_identity: A function returning that value of a commit
+    """
+    commit_rules.add(
+        '{addr_type}-root-check'.format(addr_type=addr_type.lower()),
+        '{addr_type} is root instead of real name'.format(
+            addr_type=addr_type),
+        lambda commit: _split_identity(get_identity(commit))[0] == 'root')
+    commit_rules.add(
+        '{addr_type}-real-name-check'.format(addr_type=addr_type.lower()),
+        '{addr_type} does not contain first and last name'.format(
+            addr_type=addr_type),
+        lambda commit: ' ' not in _split_identity(get_identity(commit))[0])
+    commit_rules.add(
+        '{addr_type}-valid-domain-check'.format(addr_type=addr_type.lower()),
+        '{addr_type} email address domain must be in {domains}'.format(
+            addr_type=addr_type, domains=_COMMIT_VALID_DOMAIN_LIST),
+        lambda commit: (
+            _split_identity(get_identity(commit))[1] not in
+            _COMMIT_VALID_DOMAINS))
+
+
+_add_identity_rules('Author', lambda commit: commit.author)
+_add_identity_rules('Committer', lambda commit: commit.committer)
+
+
+@commit_rules.rule(
+    'title-imperative-tense-check', 'Commit title is not in imperative tense')
+def _check_title_imperative_tense(commit):
+    return bool(_TITLE_IMPERATIVE_TENSE_RE.search(
+        commit.title.split(' ', 1)[0]))
+
+
+@commit_rules.rule(
+    'title-capitalization-check', 'Commit title is not capitalized')
+def _check_title_capitalization(commit):
+    return bool(_TITLE_CAPITALIZATION_RE.match(commit.title))
+
+
+@commit_rules.rule(
+    'title-verb-check', 'Commit title does not begin with a verb')
+def _check_title_verb(commit):
+    return commit.title.split(' ', 1)[0] not in _COMMIT_TITLE_START_WORDS
+
+
+@commit_rules.rule('title-fixup-check', 'Commit title starts with fixup! ')
+def _check_title_fixup(commit):
+    return bool(_TITLE_FIXUP_RE.match(commit.title))
+
+
+@commit_rules.rule('title-squash-check', 'Commit title starts with squash! ')
+def _check_title_squash(commit):
+    return bool(_TITLE_SQUASH_RE.match(commit.title))
+
+
+@commit_rules.rule(
+    'title-whitespace-punctuation-check',
+    'Commit title ends in whitespace or punctuation')
+def _check_title_end(commit):
+    title_words = commit.title.split(' ', 1)
+    return len(title_words) > 1 and bool(_TITLE_END_RE.search(title_words[1]))
+
+
+@commit_rules.rule(
+    'title-length-check', 'Commit title longer than 50 characters')
+def _check_title_length(commit):
+    return len(commit.title) > 50
+
+
+@commit_rules.rule(
+    'message-separator-check', 'Missing blank line between title and body')
+def _check_message_separator(commit):
+    return commit.separator is not None and commit.separator != ''
+
+
+@commit_rules.rule('body-check', 'Missing commit message body')
+def _check_body(commit):
+    return commit.body == []
+
+
+@commit_rules.rule(
+    'body-length-check', 'Commit message body line > 72 characters')
+def _check_body_length(commit):
+    return any(len(body_line) > 72 for body_line in commit.body)
+
+
+@commit_rules.rule('commit-merge-check', 'Commit is a merge commit')
+def _check_merge(commit):
+    return len(commit.parents) > 1
+
+
+# A problem reported by git log --check, e.g. "file.py:12: trailing
+# whitespace."
+_WHITESPACE_ERROR_RE = re.compile(r'^(.+?):(\d+): ', re.MULTILINE)
+
+
+def _validate_commit(commit, whitespace_errors):
     """Check the commit message and commit diff.
 
-    The commit message is checked for the following
+    The commit message is checked by the registered commit_rules:
 
+    * Author and Committer use a real name and a valid email domain
     * Title is 50 characters or less
     * Title is in imperative mood
     * Title begins with a capital letter
@@ -870,407 +3172,1541 @@ def _validate_commit(
     * There is a blank line separating the title and body
     * The commit message body lines do not exceed 72 characters
     * The commit title doesn't start with fixup! or squash!
+    * The commit is not a merge commit
 
     The commit diff is checked to verify that it doesn't introduce
     trailing whitespace or extra blank lines at the end of the file.
 
     Args:
-        commit_sha1: The full sha1 of the commit
-        author: The author value of the commit
-        merge: Set if the commit is a merge commit
-        committer: The committer value of the commit
-        separator: The line separating the title and the body of the
-            commit message
-        body: The body of the commit message (a list of strings where
-            each element corresponds to a line in the body)
+        commit: The _CommitRecord of the commit
+        whitespace_errors: The git log --check output for the commit, as
+            returned by _read_range_whitespace_errors
 
     Returns:
-        A dict where each value is a tuple of the context string and
-        corresponding description string (which can be used when
-        constructing the post body for the Github commit status
-        endpoint)
+        A list of tuples of the context string and corresponding
+        description string (which can be used when constructing the post
+        body for the Github commit status endpoint), and the (path, line
+        number) the error is about, or None for errors in the message
     """
-    errors = []
+    errors = commit_rules.check(commit)
+
+    # Check commit diff for whitespace errors.  The first error git
+    # reports ("<path>:<line>: <problem>") is where the issues start.
+    if whitespace_errors:
+        location = None
+        error_location = _WHITESPACE_ERROR_RE.search(whitespace_errors)
+        if error_location:
+            location = (
+                error_location.group(1), int(error_location.group(2)))
+        errors.append((
+            'diff-whitespace-check',
+            'Commit diff has whitespace issues', location))
 
-    # List of words a commit title can start with
-    commit_title_start_words = filter(
-        lambda x: x, COMMIT_TITLE_START_WORDS.splitlines())
+    return errors
 
-    author_errors = _validate_email(author, 'Author')
-    committer_errors = _validate_email(committer, 'Committer')
 
-    if author_errors:
-        errors.extend(author_errors)
-    if committer_errors:
-        errors.extend(committer_errors)
+# Bump this whenever a rule or _validate_commit changes what it reports
+# for a commit, including a change to the limits or patterns it uses, so
+# the verdict store never returns a verdict found by different rules
+_RULESET_REVISION = 2
 
-    title_words = title.split(' ', 1)
+# The version of the rules verdicts are stored under.  Besides the
+# revision it covers the configured title words and email domains.
+_RULESET_VERSION = hashlib.sha1(repr((
+    _RULESET_REVISION,
+    [(rule.context, rule.description) for rule in commit_rules.rules],
+    sorted(_COMMIT_TITLE_START_WORDS),
+    sorted(_COMMIT_VALID_DOMAINS)))).hexdigest()
 
-    # Check if in imperative tense
-    if re.search(r'(ed|ing|s)$', title_words[0]):
-        errors.append((
-            'title-imperative-tense-check',
-            'Commit title is not in imperative tense'))
 
-    # Check if first word is capitalized
-    if re.match(r'^[^A-Z]', title_words[0]):
-        errors.append((
-            'title-capitalization-check',
-            'Commit title is not capitalized'))
+class _VerdictStore(object):
+    """A size-bounded sqlite store of _validate_commit results
 
-    # Check if title begins with known start word
-    if title_words[0] not in commit_title_start_words:
-        errors.append((
-            'title-verb-check',
-            'Commit title does not begin with a verb'))
+    Verdicts are keyed by _RangeContext.verdict_key.  When the store holds
+    more than max_entries verdicts, the least recently used ones are
+    evicted.  The number of stored verdicts is counted once, when the
+    database is opened, and kept up to date from then on.  The database
+    is opened on first use, so forked validation workers never share a
+    connection with the main process.  stats counts lookups that found a
+    verdict (hits) or not (misses), and current_stats returns a copy of
+    them for the /stats endpoint.
+    """
 
-    # Check if this is a fixup! commit
-    if re.match(r'^fixup!', title_words[0]):
-        errors.append((
-            'title-fixup-check',
-            'Commit title starts with fixup! '))
+    def __init__(self, path, max_entries):
+        self.path = path or ':memory:'
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.stats = collections.defaultdict(int)
+        self._db = None
+        self._count = None
+
+    def _connect(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS verdicts ('
+                'key TEXT PRIMARY KEY, errors TEXT NOT NULL, '
+                'used REAL NOT NULL)')
+            self._db.execute(
+                'CREATE INDEX IF NOT EXISTS verdicts_used ON verdicts (used)')
+            self._count, = self._db.execute(
+                'SELECT COUNT(*) FROM verdicts').fetchone()
+        return self._db
+
+    def current_stats(self):
+        """Return a copy of stats, with the number of stored verdicts"""
+        with self.lock:
+            stats = dict(self.stats)
+            stats['entries'] = self._count
+        return stats
+
+    def get_many(self, keys):
+        """Look up the verdicts of several commits
+
+        Returns:
+            A dict of key to the list of (context, description,
+            location) error tuples for the keys that have a verdict.
+        """
+        keys = list(keys)
+        verdicts = {}
+        with self.lock:
+            db = self._connect()
+            for key in keys:
+                row = db.execute(
+                    'SELECT errors FROM verdicts WHERE key = ?',
+                    (key,)).fetchone()
+                if row is not None:
+                    verdicts[key] = [
+                        (str(context), str(description),
+                         location and (str(location[0]), location[1]))
+                        for context, description, location in json.loads(
+                            row[0])]
+            with db:
+                db.executemany(
+                    'UPDATE verdicts SET used = ? WHERE key = ?',
+                    [(time.time(), key) for key in verdicts])
+            self.stats['hits'] += len(verdicts)
+            self.stats['misses'] += len(keys) - len(verdicts)
+        return verdicts
+
+    def get(self, key):
+        """Look up the verdict of one commit, or return None"""
+        return self.get_many([key]).get(key)
+
+    def put_many(self, verdicts):
+        """Store the verdicts of several commits, given as a dict by key"""
+        if not verdicts:
+            return
+        with self.lock:
+            db = self._connect()
+            rows = [
+                (json.dumps(errors), time.time(), key)
+                for key, errors in verdicts.items()]
+            with db:
+                # Replace the verdicts already stored, then add the rest
+                # (counting them)
+                db.executemany(
+                    'UPDATE verdicts SET errors = ?, used = ? WHERE key = ?',
+                    rows)
+                count = self._count + db.executemany(
+                    'INSERT OR IGNORE INTO verdicts (errors, used, key) '
+                    'VALUES (?, ?, ?)', rows).rowcount
+                excess = count - self.max_entries
+                if excess > 0:
+                    db.execute(
+                        'DELETE FROM verdicts WHERE key IN ('
+                        'SELECT key FROM verdicts ORDER BY used LIMIT ?)',
+                        (excess,))
+                    count -= excess
+            self._count = count
+            if excess > 0:
+                self.stats['evictions'] += excess
+            self.stats['stored'] += len(verdicts)
+
+    def put(self, key, errors):
+        """Store the verdict of one commit"""
+        self.put_many({key: errors})
+
+
+verdict_store = _VerdictStore(
+    VALIDATE_VERDICT_STORE, VALIDATE_VERDICT_STORE_ENTRIES)
+
+
+def _validate_range_commit(range_context, commit):
+    """Validate a commit of a range, reusing a stored verdict if there is one
 
-    # Check if this is a squash! commit
-    if re.match(r'^squash!', title_words[0]):
-        errors.append((
-            'title-squash-check',
-            'Commit title starts with squash! '))
+    Returns:
+        The result of _validate_commit for the commit.
+    """
+    key = range_context.verdict_key(commit)
+    errors = verdict_store.get(key)
+    if errors is None:
+        errors = _validate_commit(
+            commit, range_context.whitespace_errors.get(commit.sha1))
+        verdict_store.put(key, errors)
+    return errors
 
-    # Check if the commit title ends in whitespace or punctuation
-    if len(title_words) > 1 and re.search(r'[\s\W]$', title_words[1]):
-        errors.append((
-            'title-whitespace-punctuation-check',
-            'Commit title ends in whitespace or punctuation'))
 
-    # Check if the title is greater than 50 characters in length
-    if len(title) > 50:
-        errors.append((
-            'title-length-check',
-            'Commit title longer than 50 characters'))
+def _compute_patch_ids(diffs, git_dir=None):
+    """Compute the patch ids of commits from their diffs
 
-    # Check if separator line (between title and body) is empty
-    if separator is not None and separator != '':
-        errors.append((
-            'message-separator-check',
-            'Missing blank line between title and body'))
+    The diffs are piped to a single git patch-id.  The patch ids are the
+    --stable kind, so they do not depend on the order of the files in a
+    diff, but keep whitespace (--verbatim, which implies --stable), since
+    a change that only fixes whitespace changes the result of the
+    whitespace check.
+
+    Args:
+        diffs: A list of (commit sha1, diff) tuples, where each diff is
+            as returned by _GitObjects.commit_diff
+        git_dir: The repository holding the commits (see _RepoMirrors)
+
+    Returns:
+        A dict of commit sha1 to patch id.  Commits without a diff are
+        left out.
+    """
+    patch_id_cmd = ['git', 'patch-id', '--verbatim']
+    patch_id = subprocess.Popen(
+        patch_id_cmd, cwd=git_dir, stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE)
+    patch_id_output, _ = patch_id.communicate(''.join(
+        'commit {commit_sha1}\n{diff}'.format(
+            commit_sha1=commit_sha1, diff=diff)
+        for commit_sha1, diff in diffs))
+    if patch_id.returncode:
+        raise subprocess.CalledProcessError(
+            patch_id.returncode, ' '.join(patch_id_cmd))
+
+    patch_ids = {}
+    for line in patch_id_output.splitlines():
+        commit_patch_id, commit_sha1 = line.split()
+        patch_ids[commit_sha1] = commit_patch_id
+    return patch_ids
+
+
+def _read_range_whitespace_errors(base_commit, tip_commit, git_dir=None):
+    """Check the diffs of every commit in a range for whitespace errors
+
+    Args:
+        base_commit: commit that, along with its ancestors, is excluded
+            from the range
+        tip_commit: commit that, along with its ancestors, is included
+            in the range
+        git_dir: The repository holding the range (see _RepoMirrors)
+
+    Returns:
+        A dict of commit sha1 to the git log --check output for that
+        commit.  Commits without whitespace errors are left out.
+    """
+    git_log_cmd = shlex.split(
+        'git log --check --no-color --format=%x00%H '
+        '{base_commit}..{tip_commit}'.format(
+            base_commit=base_commit, tip_commit=tip_commit))
+    git_log = subprocess.Popen(
+        git_log_cmd, cwd=git_dir, stdout=subprocess.PIPE)
+    git_log_output, _ = git_log.communicate()
+
+    # --check sets bit 2 of the exit status when it finds errors
+    if git_log.returncode not in [0, 2]:
+        raise subprocess.CalledProcessError(
+            git_log.returncode, ' '.join(git_log_cmd))
+
+    whitespace_errors = {}
+    for commit_output in git_log_output.split('\x00')[1:]:
+        commit_sha1, _, check_output = commit_output.partition('\n')
+        if check_output.strip():
+            whitespace_errors[commit_sha1] = check_output
+    return whitespace_errors
 
-    # Check if the commit message has a body
-    if body == []:
-        errors.append((
-            'body-check',
-            'Missing commit message body'))
 
-    # Check if any line in the body is greater than 72 characters in legnth
-    for body_line in body:
-        if len(body_line) <= 72:
+def _merge_commit_info(commit_info, new_commit_info):
+    """Add the errors found by a check to those found so far"""
+    for commit_sha1, errors in new_commit_info.items():
+        commit_info.setdefault(commit_sha1, []).extend(errors)
+
+
+def _check_range_commit(range_context, cancel, position, commit):
+    """Run every check for one commit of a range
+
+    The churn and move checks of a commit are skipped (cooperatively
+    cancelled) once an earlier commit's check has marked every commit
+    after it, since _parse_commit_log would ignore their results.
+
+    Args:
+        range_context: The _RangeContext of the range
+        cancel: A dict of check name ('churn' or 'move') to a shared
+            value holding the position of the earliest commit whose check
+            left no commits unmarked
+        position: The position of the commit in the range
+        commit: The _CommitRecord of the commit
+
+    Returns:
+        A (commit sha1, errors, churn result, move result) tuple, where
+        errors is the result of _validate_range_commit and the churn and move
+        results are those of _check_diff_add_delete and _check_diff_move
+        (or None if they were cancelled).
+    """
+    errors = _validate_range_commit(range_context, commit)
+    churn_result, move_result = _check_range_commit_pairs(
+        range_context, cancel, position, commit.sha1)
+    return commit.sha1, errors, churn_result, move_result
+
+
+def _check_range_commit_pairs(
+        range_context, cancel, position, commit_sha1, previous=None):
+    """Run the churn and move checks for one commit of a range
+
+    Args:
+        range_context: The _RangeContext of the range
+        cancel: The shared cancellation values (see _check_range_commit)
+        position: The position of the commit in the range
+        commit_sha1: The sha1 of the commit
+        previous: The commit's (churn result, move result) from an
+            earlier run over a range that ended before the commits in
+            range_context.new_sha1s.  Only those new commits are then
+            checked, and the results are added to the earlier ones.
+
+    Returns:
+        A (churn result, move result) tuple, where either result is None
+        if that check was cancelled.
+    """
+    if previous is None:
+        previous = None, None
+
+    results = []
+    for name, check, previous_result in [
+            ('churn', _check_diff_add_delete, previous[0]),
+            ('move', _check_diff_move, previous[1])]:
+        if position > cancel[name].value:
+            results.append(None)
             continue
-        errors.append((
-            'body-length-check',
-            'Commit message body line > 72 characters'))
-        break
 
-    # Check if commit is a merge commit
-    if merge is not None:
-        errors.append((
-            'commit-merge-check',
-            'Commit is a merge commit'))
+        if previous_result is None:
+            result = check(commit_sha1, range_context)
+        else:
+            previous_info, previous_sha1s = previous_result
+            new_info, new_sha1s = check(
+                commit_sha1, range_context, range_context.new_sha1s)
+            commit_info = dict(previous_info)
+            commit_info.update(new_info)
+            result = commit_info, previous_sha1s + new_sha1s
 
-    # Check commit diff for whitespace errors
-    git_diff_cmd = shlex.split(
-        'git show --check {commit_sha1}'.format(
-            commit_sha1=commit_sha1))
+        results.append(result)
+        if not result[1]:
+            with cancel[name].get_lock():
+                cancel[name].value = min(cancel[name].value, position)
 
-    has_whitespace_issue = None
-    f, _ = tempfile.mkstemp()
-    has_whitespace_issue = subprocess.call(git_diff_cmd,
-        stdout=f, stderr=f, close_fds=True)
-    os.close(f)
+    return tuple(results)
 
-    if has_whitespace_issue:
-        errors.append((
-            'diff-whitespace-check',
-            'Commit diff has whitespace issues'))
 
-    return errors
+def _check_range_commits_incrementally(range_context, cancel, previous):
+    """Check a range that adds commits to a range that was checked before
 
+    The message and whitespace errors of the earlier commits are taken
+    from the earlier run, and their churn and move checks only look at
+    the new commits (the pairs of earlier commits were checked then).
+    Only the new commits are validated in full.  The results are the same
+    as those of checking the whole range.
 
-def _parse_commit_log(base_commit, tip_commit):
-    """Parse the output of git log --format=full <commit_range>
+    Args:
+        range_context: The _RangeContext of the whole range
+        cancel: The shared cancellation values (see _check_range_commit)
+        previous: The _RangeVerdicts of the earlier range
+
+    Yields:
+        The results of _check_range_commit, in commit order.
+    """
+    for position, (commit_sha1, errors, churn_result, move_result) in (
+            enumerate(previous.results)):
+        churn_result, move_result = _check_range_commit_pairs(
+            range_context, cancel, position, commit_sha1,
+            (churn_result, move_result))
+        yield commit_sha1, errors, churn_result, move_result
+
+    new_commits = _read_commit_log(
+        previous.tip_sha1, range_context.tip_commit, range_context.git_dir)
+    for position, commit in enumerate(new_commits, len(previous.results)):
+        yield _check_range_commit(range_context, cancel, position, commit)
+
+
+class _RangeVerdicts(object):
+    """The results of validating a commit range
+
+    Attributes:
+        tip_sha1: The sha1 of the last commit of the range
+        results: The results of _check_range_commit for each commit, in
+            commit order
+        commit_info: The result of _parse_commit_log for the range
+    """
+
+    __slots__ = ('tip_sha1', 'results', 'commit_info')
+
+    def __init__(self, tip_sha1, results, commit_info):
+        self.tip_sha1 = tip_sha1
+        self.results = results
+        self.commit_info = commit_info
+
+
+class _RangeVerdictCache(object):
+    """The most recently validated commit ranges, by base and tip sha1"""
+
+    def __init__(self, max_ranges):
+        self.max_ranges = max_ranges
+        self.lock = threading.Lock()
+        self.ranges = collections.OrderedDict()
+        self.stats = collections.defaultdict(int)
+
+    def get(self, base_sha1, tip_sha1):
+        """Return the _RangeVerdicts of a range, or None"""
+        with self.lock:
+            verdicts = self.ranges.pop((base_sha1, tip_sha1), None)
+            if verdicts is None:
+                self.stats['misses'] += 1
+                return None
+            self.stats['hits'] += 1
+            self.ranges[base_sha1, tip_sha1] = verdicts
+            return verdicts
+
+    def current_stats(self):
+        """Return a copy of stats, with the number of ranges kept"""
+        with self.lock:
+            stats = dict(self.stats)
+            stats['ranges'] = len(self.ranges)
+        return stats
+
+    def put(self, base_sha1, verdicts):
+        """Remember the _RangeVerdicts of a range"""
+        with self.lock:
+            self.ranges.pop((base_sha1, verdicts.tip_sha1), None)
+            self.ranges[base_sha1, verdicts.tip_sha1] = verdicts
+            while len(self.ranges) > self.max_ranges:
+                self.ranges.popitem(last=False)
+
+
+range_verdicts = _RangeVerdictCache(VALIDATE_REMEMBERED_RANGES)
+
+
+# The cancellation values of a forked validation worker's pool (see
+# _ValidationPool), and the range contexts it has built, by slot
+_validation_cancels = None
+_validation_ranges = {}
+
+
+def _init_validation_worker(cancels):
+    """Set up a forked validation worker
+
+    The worker may be forked while other threads hold locks or talk to
+    long-running git processes, so it replaces the locks and git
+    processes it uses with its own.
+    """
+    global _validation_cancels
+    _validation_cancels = cancels
+    mirrors.lock = threading.Lock()
+    mirrors.git_objects = {None: _GitObjects()}
+    commit_rules.lock = threading.Lock()
 
-    This parses the output of git log --format-full <commit_range>,
-    extracts the commit sha1, author, committer, commit title, commit
-    separator, and commit message body values and passes them to other
-    methods to validate their format
+
+def _check_pooled_range_commit(
+        range_context, cancel, position, commit, errors, whitespace_errors):
+    """Run every check for one commit of a range in a pool worker
+
+    Like _check_range_commit, except that the verdict store is not used:
+    errors is the commit's stored verdict (or None if there is none),
+    and new verdicts are stored by the caller of the pool.
+    """
+    if errors is None:
+        errors = _validate_commit(commit, whitespace_errors)
+    churn_result, move_result = _check_range_commit_pairs(
+        range_context, cancel, position, commit.sha1)
+    return commit.sha1, errors, churn_result, move_result
+
+
+def _check_threaded_range_commit(task):
+    return _check_pooled_range_commit(*task)
+
+
+def _check_forked_range_commit(task):
+    # The range's context is built in the worker the first time one of
+    # its commits comes in, and kept until its slot is used for another
+    # range
+    slot, range_key, position, commit, errors, whitespace_errors = task
+    cached_key, range_context = _validation_ranges.get(slot, (None, None))
+    if cached_key != range_key:
+        git_dir, base_sha1, tip_sha1 = range_key
+        range_context = _RangeContext(base_sha1, tip_sha1, git_dir)
+        _validation_ranges[slot] = range_key, range_context
+    return _check_pooled_range_commit(
+        range_context, _validation_cancels[slot], position, commit, errors,
+        whitespace_errors)
+
+
+class _ValidationPool(object):
+    """A pool of threads or forked processes validating commit ranges
+
+    Each commit of a range is checked by a worker, and the results are
+    returned in commit order.  Workers get everything a commit's checks
+    need through the task's arguments, except for the range's context:
+    thread workers share the caller's, while process workers build their
+    own from the range's git_dir and sha1s and keep it for the range's
+    other commits.  The processes are forked when the pool is created,
+    so the pool is created once the module is loaded and before gitbot
+    starts any threads.
+
+    Up to max_ranges ranges are validated at once, each in a slot with
+    its own pair of cancellation values (see _check_range_commit), which
+    the process workers inherit.  A range waits for a free slot.
+    """
+
+    def __init__(self, kind, num_workers, max_ranges):
+        self.kind = kind
+        self.slots = Queue.Queue()
+        self.cancels = []
+        for slot in xrange(max_ranges):
+            self.slots.put(slot)
+            self.cancels.append({
+                'churn': multiprocessing.Value('l', sys.maxint),
+                'move': multiprocessing.Value('l', sys.maxint),
+            })
+
+        if kind == 'thread':
+            self.pool = multiprocessing.pool.ThreadPool(num_workers)
+        else:
+            self.pool = multiprocessing.Pool(
+                num_workers, _init_validation_worker, (self.cancels,))
+
+    def check(self, range_context, commits, cancelled=None):
+        """Check the commits of a range
+
+        Args:
+            range_context: The _RangeContext of the range
+            commits: The _CommitRecords of the range
+            cancelled: A function called as the shared indexes are built and
+                as the result of each commit comes in.  If it returns True
+                the remaining commits skip their churn and move checks and
+                _ValidationCancelled is raised once they are done.
+
+        Returns:
+            The results of _check_range_commit, in the order of commits.
+        """
+        def check_cancelled():
+            if cancelled is not None and cancelled():
+                raise _ValidationCancelled()
+
+        # Thread workers share the range's indexes, so build them up front
+        # and the workers only read them
+        if self.kind == 'thread':
+            range_context.churn_index
+            check_cancelled()
+            range_context.move_index
+            check_cancelled()
+
+        # The whitespace check is only needed for commits without a
+        # stored verdict
+        keys = [range_context.verdict_key(commit) for commit in commits]
+        verdicts = verdict_store.get_many(keys)
+        whitespace_errors = {}
+        if len(verdicts) < len(set(keys)):
+            whitespace_errors = range_context.whitespace_errors
+        check_cancelled()
+
+        slot = self.slots.get()
+        cancel = self.cancels[slot]
+        for value in cancel.values():
+            value.value = sys.maxint
+
+        if self.kind == 'thread':
+            check = _check_threaded_range_commit
+            tasks = [
+                (range_context, cancel, position, commit, verdicts.get(key),
+                 whitespace_errors.get(commit.sha1))
+                for position, (commit, key) in enumerate(zip(commits, keys))]
+        else:
+            check = _check_forked_range_commit
+            range_key = (
+                range_context.git_dir, range_context.base_commit,
+                range_context.tip_commit)
+            tasks = [
+                (slot, range_key, position, commit, verdicts.get(key),
+                 whitespace_errors.get(commit.sha1))
+                for position, (commit, key) in enumerate(zip(commits, keys))]
+
+        results = []
+        pending = self.pool.imap(check, tasks)
+        try:
+            for result in pending:
+                results.append(result)
+                check_cancelled()
+        finally:
+            # Let the commits still being checked finish (without their
+            # churn and move checks) before the slot is used again
+            if len(results) < len(tasks):
+                for value in cancel.values():
+                    value.value = -1
+                while True:
+                    try:
+                        next(pending)
+                    except StopIteration:
+                        break
+                    except Exception:
+                        pass
+            self.slots.put(slot)
+
+        verdict_store.put_many(dict(
+            (key, errors)
+            for key, (_, errors, _, _) in zip(keys, results)
+            if key not in verdicts))
+        return results
+
+
+# The pool commits are validated with, if there is more than one worker.
+# It is created at the end of the module (see _ValidationPool).
+validation_pool = None
+
+
+def _parse_commit_log(
+        base_commit, tip_commit, previous=None, cancelled=None,
+        git_dir=None):
+    """Validate the commits in a range
+
+    Each commit's message and diff is validated, and the diffs of the
+    whole range are checked for lines that are added and then removed
+    (or the other way around) and for code that is moved from one commit
+    to another.  The results are remembered in range_verdicts.
 
     Args:
         base_commit: commit sha1 value that it, along with its ancestors
             should be excluded from the git log output
         tip_commit: commit sha1 value that it, along with its ancestors
             should be included in the git log output
+        previous: The _RangeVerdicts of an earlier range from the same
+            base commit.  If the range only adds commits to it (a fast
+            forward), just the new commits are validated.
+        cancelled: A function called as the results of each commit come
+            in.  If it returns True the validation stops and
+            _ValidationCancelled is raised.
+        git_dir: The repository holding the range (see _RepoMirrors)
 
     Returns:
         A dict indexed by commit sha1 values where each value is a list of
         strings that describe any issues found for that commit
     """
-
-    class LogState(object):
-        SEPARATOR_LINE = 0
-        COMMIT_SHA1_LINE = 1
-        MERGE_LINE = 2
-        AUTHOR_LINE = 3
-        COMMITTER_LINE = 4
-        MIDDLE_SEPARATOR_LINE = 5
-        TITLE_LINE = 6
-        BLANK_LINE = 7
-        BODY_LINES = 8
-
     commit_info = {}
     check_churn = True
     check_move = True
 
-    git_log_cmd = shlex.split(
-        'git log --format=full --reverse {base_commit}..{tip_commit}'.format(
-            base_commit=base_commit, tip_commit=tip_commit))
-    git_log_output = subprocess.check_output(git_log_cmd)
-
-    log_line_state = LogState.SEPARATOR_LINE
-    commit_sha1 = None
-    merge = None
-    author = None
-    committer = None
-    title = None
-    separator = None
-    body = []
-    git_log_output_lines = git_log_output.splitlines()
-    for idx, line in enumerate(git_log_output_lines, 1):
-        # commit line
-        if (
-                log_line_state == LogState.SEPARATOR_LINE and
-                line.startswith('commit ')):
-            commit_sha1 = line.split(' ')[1]
-            log_line_state = LogState.COMMIT_SHA1_LINE
-            continue
-
-        # Merge: line
-        if (
-                log_line_state == LogState.COMMIT_SHA1_LINE and
-                line.startswith('Merge: ')):
-            merge = line.split(' ', 1)[1]
-            log_line_state = LogState.MERGE_LINE
-            continue
+    # Every check reads the range's commits and diffs from one context,
+    # so each diff is read from git once and the churn and move checks
+    # answer every lookup from an index instead of running git log -S and
+    # git log -G for every changed line
+    base_sha1, tip_sha1 = _resolve_refs([base_commit, tip_commit], git_dir)
+    range_context = _RangeContext(base_sha1, tip_sha1, git_dir, previous)
+    cancel = {
+        'churn': multiprocessing.Value('l', sys.maxint),
+        'move': multiprocessing.Value('l', sys.maxint),
+    }
+    commits = _read_commit_log(base_sha1, tip_sha1, git_dir)
+
+    if range_context.new_sha1s is not None:
+        results = _check_range_commits_incrementally(
+            range_context, cancel, previous)
+    elif validation_pool is not None:
+        results = validation_pool.check(
+            range_context, list(commits), cancelled)
+    else:
+        results = (
+            _check_range_commit(range_context, cancel, position, commit)
+            for position, commit in enumerate(commits))
+
+    # Merge the results in commit order, so they are the same however
+    # the commits were checked
+    range_results = []
+    for commit_sha1, errors, churn_result, move_result in results:
+        if cancelled is not None and cancelled():
+            raise _ValidationCancelled()
+        range_results.append(
+            (commit_sha1, errors, churn_result, move_result))
+        _merge_commit_info(commit_info, {commit_sha1: errors})
+
+        if check_churn:
+            commit_churn_info, branch_churn_sha1s = churn_result
+            _merge_commit_info(commit_info, commit_churn_info)
+            check_churn = bool(branch_churn_sha1s)
+
+        if check_move:
+            commit_move_info, branch_move_sha1s = move_result
+            _merge_commit_info(commit_info, commit_move_info)
+            check_move = bool(branch_move_sha1s)
+
+    range_verdicts.put(
+        base_sha1, _RangeVerdicts(tip_sha1, range_results, commit_info))
+    return commit_info
 
-        # Author: line
-        if (
-                log_line_state in [
-                    LogState.COMMIT_SHA1_LINE, LogState.MERGE_LINE] and
-                line.startswith('Author: ')):
-            author = line.split(' ', 1)[1]
-            log_line_state = LogState.AUTHOR_LINE
-            continue
 
-        # Commit: line
-        if log_line_state == LogState.AUTHOR_LINE and line.startswith('Commit: '):
-            committer = line.split(' ', 1)[1]
-            log_line_state = LogState.COMMITTER_LINE
-            continue
+def _rebase_branch_name(
+        org_name, repo_name, pr_number, base_branch, branch_pointer,
+        rebase_number):
+    """Return the name of a rebase-base or rebase-head branch
 
-        # empty line after Commit: line
-        if log_line_state == LogState.COMMITTER_LINE and line == '':
-            log_line_state = LogState.MIDDLE_SEPARATOR_LINE
-            continue
+    Branch name schema:
+    <org-name>/<repo-name>/PR/<PR-number>/<base-branch>/
+        rebase-<pointer>/<rebase-number>
+    """
+    return (
+        '{org}/{repo}/PR/{pr_number}/{base_branch}/'
+        'rebase-{pointer}/{rebase_number}').format(
+        org=org_name, repo=repo_name, pr_number=pr_number,
+        base_branch=base_branch, pointer=branch_pointer,
+        rebase_number=rebase_number)
+
+
+class _RebaseSnapshot(object):
+    """The rebase branches of one rebase of a pull request
+
+    Attributes:
+        rebase_number: The number of the rebase (0 for the branch as the
+            pull request was opened)
+        base_branch: The base branch of the pull request
+        base_sha1: The commit of the rebase-base branch, the head of the
+            pull request when the rebase was pushed
+        head_sha1: The commit of the rebase-head branch, the latest head
+            of the pull request pushed on top of the rebase
+    """
 
-        # Title line of commit message
-        if (
-                log_line_state == LogState.MIDDLE_SEPARATOR_LINE and
-                line.startswith('    ')):
-            title = line.lstrip('    ')
-            log_line_state = LogState.TITLE_LINE
+    __slots__ = ('rebase_number', 'base_branch', 'base_sha1', 'head_sha1')
 
-            if idx < len(git_log_output_lines):
-                continue
+    def __init__(self, rebase_number, base_branch, base_sha1, head_sha1):
+        self.rebase_number = rebase_number
+        self.base_branch = base_branch
+        self.base_sha1 = base_sha1
+        self.head_sha1 = head_sha1
 
-            commit_status = _validate_commit(
-                commit_sha1, merge, author, committer, title, separator, body)
 
-            if commit_sha1 not in commit_info.keys():
-                commit_info[commit_sha1] = commit_status
-            else:
-                commit_info[commit_sha1].extend(commit_status)
-
-            if check_churn:
-                commit_churn_info, branch_churn_sha1s = _check_diff_add_delete(
-                    commit_sha1, tip_commit)
-
-                for commit_churn_sha1 in commit_churn_info.keys():
-                    if commit_churn_sha1 not in commit_info.keys():
-                        commit_info[commit_churn_sha1] = commit_churn_info[
-                            commit_churn_sha1]
-                    else:
-                        commit_info[commit_churn_sha1].extend(
-                            commit_churn_info[commit_churn_sha1])
-
-                check_churn = bool(branch_churn_sha1s)
-
-            if check_move:
-                commit_move_info, branch_move_sha1s = _check_diff_move(
-                    commit_sha1, tip_commit)
-
-                for commit_move_sha1 in commit_move_info.keys():
-                    if commit_move_sha1 not in commit_info.keys():
-                        commit_info[commit_move_sha1] = commit_move_info[
-                            commit_move_sha1]
-                    else:
-                        commit_info[commit_move_sha1].extend(
-                            commit_move_info[commit_move_sha1])
-
-                check_move = bool(branch_move_sha1s)
-            break
+class _RebaseSnapshotIndex(object):
+    """A sqlite index of the rebase branches of every pull request
 
-        # Blank line between title and body (still contains 4 space prefix)
-        if log_line_state == LogState.TITLE_LINE and line.startswith('    '):
-            separator = line.lstrip('    ')
-            log_line_state = LogState.BLANK_LINE
+    The rebase branches are only written through the index, which
+    updates them in one git update-ref transaction while it records them
+    in a sqlite transaction, so looking up the latest rebase of a pull
+    request does not have to list the branches.  The row is only
+    committed once the branches are updated, and the branches are moved
+    back if the commit fails, so the two never disagree.  The index can
+    always be rebuilt from the branches (see rebuild), which happens when
+    it is first created.
+    """
 
-            if idx < len(git_log_output_lines):
+    def __init__(self, path):
+        self.path = path or ':memory:'
+        self.lock = threading.Lock()
+        self.stats = collections.defaultdict(int)
+        self._db = None
+
+    def _connect(self):
+        if self._db is None:
+            db = sqlite3.connect(self.path, check_same_thread=False)
+            created = db.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'snapshots'"
+            ).fetchone() is None
+            with db:
+                db.execute(
+                    'CREATE TABLE IF NOT EXISTS snapshots ('
+                    'org TEXT NOT NULL, repo TEXT NOT NULL, '
+                    'pr_number INTEGER NOT NULL, '
+                    'rebase_number INTEGER NOT NULL, '
+                    'base_branch TEXT NOT NULL, base_sha1 TEXT NOT NULL, '
+                    'head_sha1 TEXT NOT NULL, '
+                    'PRIMARY KEY (org, repo, pr_number, rebase_number))')
+            self._db = db
+            if created:
+                self._rebuild()
+        return self._db
+
+    def latest(self, org_name, repo_name, pr_number):
+        """Return the latest _RebaseSnapshot of a pull request, or None"""
+        with self.lock:
+            row = self._connect().execute(
+                'SELECT rebase_number, base_branch, base_sha1, head_sha1 '
+                'FROM snapshots WHERE org = ? AND repo = ? AND pr_number = ? '
+                'ORDER BY rebase_number DESC LIMIT 1',
+                (org_name, repo_name, pr_number)).fetchone()
+            self.stats['hits' if row else 'misses'] += 1
+        if row is None:
+            return None
+        rebase_number, base_branch, base_sha1, head_sha1 = row
+        return _RebaseSnapshot(
+            rebase_number, str(base_branch), str(base_sha1), str(head_sha1))
+
+    def latest_heads(self, org_name, repo_name):
+        """Return a dict of pull request number to its latest head sha1"""
+        with self.lock:
+            rows = self._connect().execute(
+                'SELECT snapshots.pr_number, snapshots.head_sha1 '
+                'FROM snapshots JOIN ('
+                'SELECT pr_number, MAX(rebase_number) AS rebase_number '
+                'FROM snapshots WHERE org = ? AND repo = ? '
+                'GROUP BY pr_number) AS latest '
+                'ON snapshots.pr_number = latest.pr_number AND '
+                'snapshots.rebase_number = latest.rebase_number '
+                'WHERE snapshots.org = ? AND snapshots.repo = ?',
+                (org_name, repo_name, org_name, repo_name)).fetchall()
+        return dict(
+            (pr_number, str(head_sha1)) for pr_number, head_sha1 in rows)
+
+    def current_stats(self):
+        """Return a copy of stats"""
+        with self.lock:
+            return dict(self.stats)
+
+    def start_rebase(
+            self, org_name, repo_name, pr_number, base_branch, rebase_number,
+            sha1):
+        """Create the rebase-base and rebase-head branches of a rebase"""
+        with self.lock:
+            self._write(
+                'INSERT OR REPLACE INTO snapshots VALUES '
+                '(?, ?, ?, ?, ?, ?, ?)',
+                (org_name, repo_name, pr_number, rebase_number,
+                 base_branch, sha1, sha1),
+                [(_rebase_branch_name(
+                    org_name, repo_name, pr_number, base_branch,
+                    branch_pointer, rebase_number), sha1)
+                 for branch_pointer in ['base', 'head']],
+                mirrors.git_dir(org_name, repo_name))
+
+    def move_head(self, org_name, repo_name, pr_number, rebase_number, sha1):
+        """Move the rebase-head branch of a rebase to a new commit"""
+        with self.lock:
+            base_branch, = self._connect().execute(
+                'SELECT base_branch FROM snapshots WHERE org = ? AND '
+                'repo = ? AND pr_number = ? AND rebase_number = ?',
+                (org_name, repo_name, pr_number, rebase_number)).fetchone()
+            self._write(
+                'UPDATE snapshots SET head_sha1 = ? WHERE org = ? AND '
+                'repo = ? AND pr_number = ? AND rebase_number = ?',
+                (sha1, org_name, repo_name, pr_number, rebase_number),
+                [(_rebase_branch_name(
+                    org_name, repo_name, pr_number, base_branch, 'head',
+                    rebase_number), sha1)],
+                mirrors.git_dir(org_name, repo_name))
+
+    def _write(self, statement, parameters, refs, git_dir):
+        # Called with the lock held.  Runs statement and updates refs in
+        # one sqlite transaction, which is rolled back if the refs can't
+        # be updated.
+        db = self._connect()
+        old_sha1s = _branch_sha1s(
+            [branch_name for branch_name, _ in refs], git_dir)
+        try:
+            with db:
+                db.execute(statement, parameters)
+                _update_refs(refs, git_dir)
+        except sqlite3.Error:
+            self.stats['rolled_back'] += 1
+            _update_refs(
+                [(branch_name, old_sha1s.get(branch_name))
+                 for branch_name, _ in refs], git_dir)
+            raise
+
+    def rebuild(self):
+        """Replace the index with what the rebase branches say"""
+        with self.lock:
+            self._connect()
+            self._rebuild()
+
+    def _rebuild(self):
+        for_each_ref_cmd = shlex.split(
+            'git for-each-ref --format="%(objectname) %(refname)" '
+            'refs/heads/')
+        ref_lines = [
+            line
+            for git_dir in mirrors.git_dirs()
+            for line in subprocess.check_output(
+                for_each_ref_cmd, cwd=git_dir).splitlines()]
+        snapshots = {}
+        for line in ref_lines:
+            sha1, ref_name = line.split()
+
+            # refs/heads/<org>/<repo>/PR/<PR-number>/<base-branch>/
+            # rebase-<pointer>/<rebase-number>, where the base branch can
+            # contain slashes
+            parts = ref_name.split('/')
+            if (
+                    len(parts) < 9 or parts[4] != 'PR' or
+                    not parts[5].isdigit() or not parts[-1].isdigit() or
+                    parts[-2] not in ['rebase-base', 'rebase-head']):
                 continue
+            key = parts[2], parts[3], int(parts[5]), int(parts[-1])
+            snapshot = snapshots.setdefault(
+                key, ['/'.join(parts[6:-2]), None, None])
+            snapshot[1 if parts[-2] == 'rebase-base' else 2] = sha1
+
+        with self._db:
+            self._db.execute('DELETE FROM snapshots')
+            self._db.executemany(
+                'INSERT OR REPLACE INTO snapshots VALUES '
+                '(?, ?, ?, ?, ?, ?, ?)',
+                [key + tuple(snapshot)
+                 for key, snapshot in snapshots.items()
+                 if None not in snapshot])
+        self.stats['rebuilds'] += 1
+
+
+def _branch_sha1s(branch_names, git_dir=None):
+    """Return a dict of the given branches that exist to their sha1s"""
+    for_each_ref_cmd = [
+        'git', 'for-each-ref', '--format=%(objectname) %(refname)'] + [
+        'refs/heads/' + branch_name for branch_name in branch_names]
+    sha1s = {}
+    for line in subprocess.check_output(
+            for_each_ref_cmd, cwd=git_dir).splitlines():
+        sha1, ref_name = line.split()
+        sha1s[ref_name[len('refs/heads/'):]] = sha1
+    return dict(
+        (branch_name, sha1s[branch_name])
+        for branch_name in branch_names if branch_name in sha1s)
+
+
+def _update_refs(refs, git_dir=None):
+    """Point several branches at new commits in one git transaction
 
-            commit_status = _validate_commit(
-                commit_sha1, merge, author, committer, title, separator, body)
+    Args:
+        refs: A list of (branch name, sha1) tuples.  A branch with a sha1
+            of None is deleted.
+        git_dir: The repository holding the branches (see _RepoMirrors)
+    """
+    update_ref_cmd = ['git', 'update-ref', '--stdin']
+    update_ref = subprocess.Popen(
+        update_ref_cmd, cwd=git_dir, stdin=subprocess.PIPE)
+    update_ref.communicate(''.join(
+        'delete refs/heads/{0}\n'.format(branch_name) if sha1 is None else
+        'update refs/heads/{0} {1}\n'.format(branch_name, sha1)
+        for branch_name, sha1 in refs))
+    if update_ref.returncode:
+        raise subprocess.CalledProcessError(
+            update_ref.returncode, ' '.join(update_ref_cmd))
+
+
+rebase_snapshots = _RebaseSnapshotIndex(REBASE_SNAPSHOT_INDEX)
+
+
+class _PullRequestHeads(object):
+    """The head branch and commit of each open pull request, by repo
+
+    Pull request events keep the index up to date, and the heads of a
+    repo are read from the rebase snapshot index (the head of a pull
+    request's latest rebase follows the pull request) the first time the
+    repo is looked up, so the index survives restarts.  The head branches of
+    pull requests read that way are not known until their next event.
+    A push event uses the index to find its pull request instead of
+    listing every pull request ref of the remote.
+    """
 
-            if commit_sha1 not in commit_info.keys():
-                commit_info[commit_sha1] = commit_status
-            else:
-                commit_info[commit_sha1].extend(commit_status)
-
-            if check_churn:
-                commit_churn_info, branch_churn_sha1s = _check_diff_add_delete(
-                    commit_sha1, tip_commit)
-
-                for commit_churn_sha1 in commit_churn_info.keys():
-                    if commit_churn_sha1 not in commit_info.keys():
-                        commit_info[commit_churn_sha1] = commit_churn_info[
-                            commit_churn_sha1]
-                    else:
-                        commit_info[commit_churn_sha1].extend(
-                            commit_churn_info[commit_churn_sha1])
-
-                check_churn = bool(branch_churn_sha1s)
-
-            if check_move:
-                commit_move_info, branch_move_sha1s = _check_diff_move(
-                    commit_sha1, tip_commit)
-
-                for commit_move_sha1 in commit_move_info.keys():
-                    if commit_move_sha1 not in commit_info.keys():
-                        commit_info[commit_move_sha1] = commit_move_info[
-                            commit_move_sha1]
-                    else:
-                        commit_info[commit_move_sha1].extend(
-                            commit_move_info[commit_move_sha1])
-
-                check_move = bool(branch_move_sha1s)
-            break
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.repos = {}
+        self.stats = collections.defaultdict(int)
+
+    def _heads(self, org_name, repo_name):
+        heads = self.repos.get((org_name, repo_name))
+        if heads is None:
+            heads = self.repos[org_name, repo_name] = dict(
+                (pr_number, (None, head_sha1))
+                for pr_number, head_sha1 in rebase_snapshots.latest_heads(
+                    org_name, repo_name).items())
+        return heads
+
+    def find(self, org_name, repo_name, head_branch, head_sha1):
+        """Return the pull request of a head branch and commit, or None"""
+        with self.lock:
+            for pr_number, (branch, sha1) in sorted(
+                    self._heads(org_name, repo_name).items()):
+                if sha1 == head_sha1 and branch in [None, head_branch]:
+                    self.stats['found'] += 1
+                    return pr_number
+            self.stats['not_found'] += 1
+            return None
+
+    def is_at(self, org_name, repo_name, pr_number, head_sha1):
+        """Check whether the head of a pull request is already head_sha1
+
+        Both the synchronize event of a pull request and the push event
+        of its head branch track a push, so this tells the second one that
+        the push was already handled.
+        """
+        with self.lock:
+            heads = self._heads(org_name, repo_name)
+            if heads.get(pr_number, (None, None))[1] == head_sha1:
+                self.stats['unchanged'] += 1
+                return True
+            return False
+
+    def advance(self, org_name, repo_name, pr_number, head_branch, head_sha1):
+        """Move the head of a pull request to a new commit"""
+        with self.lock:
+            self._heads(org_name, repo_name)[pr_number] = (
+                head_branch, head_sha1)
+
+    def forget(self, org_name, repo_name, pr_number):
+        """Drop a closed pull request"""
+        with self.lock:
+            self._heads(org_name, repo_name).pop(pr_number, None)
+
+
+pull_request_heads = _PullRequestHeads()
+
+
+def _track_pull_request_push(
+        org_name, repo_name, ssh_url, pr_number, sender, url_root,
+        sha_before, sha_after):
+    """Record and validate a push to the head branch of a pull request
+
+    A force push (rebase or amend) starts a new pair of rebase branches
+    and posts a comment linking to the rebase diffs, any other push
+    advances the current rebase-head branch.  Either way a validation of
+    the commits of the pull request is then queued.  When an earlier
+    attempt already moved the rebase branches to the fetched head before
+    failing, only the validation is queued.
 
-        # Body lines
-        if (
-                log_line_state in [LogState.BLANK_LINE, LogState.BODY_LINES] and
-                line.startswith('    ')):
-            body.append(line.lstrip('    '))
-            log_line_state = LogState.BODY_LINES
+    Args:
+        org_name: The organization of the repo
+        repo_name: The name of the repo
+        ssh_url: The ssh URL of the repo
+        pr_number: The number of the pull request
+        sender: The login of the user who pushed
+        url_root: The root URL of this server, for the links in comments
+        sha_before: The head commit of the pull request before the push
+        sha_after: The head commit of the pull request after the push
+    """
+    snapshot = rebase_snapshots.latest(org_name, repo_name, pr_number)
+
+    # The pull request was opened before gitbot was tracking it
+    if snapshot is None:
+        return
+
+    # Fetch the PR branch.  This will allow for creating a local branch
+    # that points to the head of that branch.  If Github doesn't have the
+    # pushed head yet, this fails and the job is retried.
+    fetched_sha1 = _fetch_pull_request_head(
+        org_name, repo_name, pr_number, ssh_url, sha_after)
+
+    # Check to see whether this push was a force push.  If it is,
+    # then this is a rebase or amended commit.  We do this by checking
+    # whether the before sha1 value in the github event is an ancestor of
+    # the after sha1 value.  For a regular push, this will be the case.
+    # For a force push, this may not be the case.
+    merge_base_cmd = shlex.split(
+        'git merge-base --is-ancestor {before} {after}'.format(
+            before=sha_before, after=sha_after))
+
+    is_rebase = subprocess.call(
+        merge_base_cmd, cwd=mirrors.git_dir(org_name, repo_name))
+
+    # The rebase branches already point at the new head
+    if snapshot.head_sha1 == fetched_sha1:
+        pass
+    # Start a new rebase (with new rebase-base and rebase-head branches)
+    elif is_rebase:
+        rebase_snapshots.start_rebase(
+            org_name, repo_name, pr_number, snapshot.base_branch,
+            snapshot.rebase_number + 1, fetched_sha1)
+
+        branch_name = '{org}/{repo}/PR/{pr_number}/{base_branch}'.format(
+            org=org_name, repo=repo_name, pr_number=pr_number,
+            base_branch=snapshot.base_branch)
+        comment = _generate_github_rebase_comment(
+            sender, url_root, branch_name, snapshot.rebase_number)
+
+        # Post the comment on the Github PR
+        outbox.post_comment(org_name, repo_name, pr_number, comment)
+    else: # This is not a rebase/amend
+        # Advance rebase-head of the current rebase to the new commit.
+        # rebase-base will remain at the same commit the head of this
+        # branch was after it was last rebased.
+
+        # We could consider checking whether the commits pushed are
+        # fixup or squash commits and then posting a comment in the
+        # PR that shows who pushed the commits and list their
+        # comment message bodies and titles in the comment.
+        rebase_snapshots.move_head(
+            org_name, repo_name, pr_number, snapshot.rebase_number,
+            fetched_sha1)
+
+    # Check list of commits in branch to see if there are any
+    # fixup or squash commits.  If commits were just added to the
+    # branch, only they need to be validated as long as we remember
+    # validating the rest.
+    _queue_validation(
+        org_name, repo_name, pr_number, snapshot.base_branch, fetched_sha1,
+        sha_after, None if is_rebase else sha_before)
+
+
+class _ValidationCancelled(Exception):
+    """Raised by _parse_commit_log when its validation is cancelled"""
+
+
+def _queue_validation(
+        org_name, repo_name, pr_number, base_branch_name, tip_sha1,
+        head_sha1, previous_head_sha1=None):
+    """Queue a debounced validation of the commits of a pull request
+
+    The validation waits WEBHOOK_DEBOUNCE seconds.  A newer validation of
+    the pull request queued before then replaces it (and waits again), so
+    a burst of pushes is validated once, at the latest head.  A newer
+    validation queued while one is running cancels the running one.
 
-            if idx < len(git_log_output_lines):
-                continue
+    Args:
+        org_name: The organization of the repo
+        repo_name: The name of the repo
+        pr_number: The number of the pull request
+        base_branch_name: The base branch of the pull request
+        tip_sha1: The commit to validate up to
+        head_sha1: The head commit of the pull request to report on
+        previous_head_sha1: The head commit before a push that only added
+            commits, whose validation can be carried on, or None
+    """
+    webhook_workers.submit(
+        (org_name, repo_name, pr_number, 'validate'),
+        _validate_pull_request,
+        (org_name, repo_name, pr_number, base_branch_name, tip_sha1,
+         head_sha1, previous_head_sha1),
+        delay=WEBHOOK_DEBOUNCE, merge=_merge_validations)
 
-            commit_status = _validate_commit(
-                commit_sha1, merge, author, committer, title, separator, body)
 
-            if commit_sha1 not in commit_info.keys():
-                commit_info[commit_sha1] = commit_status
-            else:
-                commit_info[commit_sha1].extend(commit_status)
-
-            if check_churn:
-                commit_churn_info, branch_churn_sha1s = _check_diff_add_delete(
-                    commit_sha1, tip_commit)
-
-                for commit_churn_sha1 in commit_churn_info.keys():
-                    if commit_churn_sha1 not in commit_info.keys():
-                        commit_info[commit_churn_sha1] = commit_churn_info[
-                            commit_churn_sha1]
-                    else:
-                        commit_info[commit_churn_sha1].extend(
-                            commit_churn_info[commit_churn_sha1])
-
-                check_churn = bool(branch_churn_sha1s)
-
-            if check_move:
-                commit_move_info, branch_move_sha1s = _check_diff_move(
-                    commit_sha1, tip_commit)
-
-                for commit_move_sha1 in commit_move_info.keys():
-                    if commit_move_sha1 not in commit_info.keys():
-                        commit_info[commit_move_sha1] = commit_move_info[
-                            commit_move_sha1]
-                    else:
-                        commit_info[commit_move_sha1].extend(
-                            commit_move_info[commit_move_sha1])
-
-                check_move = bool(branch_move_sha1s)
-            break
+def _merge_validations(earlier_args, args):
+    """Merge two queued validations of a pull request into the later one
 
-        # End of commit message
-        if (
-                log_line_state in [
-                    LogState.TITLE_LINE, LogState.BLANK_LINE,
-                    LogState.BODY_LINES] and
-                line == ''):
+    The validation can only be carried on from the earlier validation's
+    previous head if neither push was a rebase.
+    """
+    args = list(args)
+    if earlier_args[-1] is None:
+        args[-1] = None
+    elif args[-1] is not None:
+        args[-1] = earlier_args[-1]
+    return args
+
+
+def _validate_pull_request(
+        org_name, repo_name, pr_number, base_branch_name, tip_sha1,
+        head_sha1, previous_head_sha1):
+    """Validate the commits of a pull request and report the results
 
-            commit_status = _validate_commit(
-                commit_sha1, merge, author, committer, title, separator, body)
+    See _queue_validation for the arguments.
+    """
+    key = org_name, repo_name, pr_number, 'validate'
+    log_start_ref = base_refs.resolve(
+        org_name, repo_name, base_branch_name)
+
+    previous = None
+    previous_commit_info = None
+    if previous_head_sha1 is not None:
+        previous = range_verdicts.get(log_start_ref, previous_head_sha1)
+    if previous is not None:
+        previous_commit_info = previous.commit_info
+
+    try:
+        commit_info = _parse_commit_log(
+            log_start_ref, tip_sha1, previous,
+            functools.partial(webhook_workers.superseded, key),
+            mirrors.git_dir(org_name, repo_name))
+    except _ValidationCancelled:
+        return
+    _report_commit_checks(
+        org_name, repo_name, commit_info, head_sha1, previous_commit_info)
+
+
+class _WebhookWorkers(object):
+    """Background workers that handle webhook events, from a durable queue
+
+    Jobs are queued by key (a pull request, or the validations of one).
+    The jobs of a key run one at a time, in the order they were queued,
+    while the jobs of different keys run in parallel on up to num_workers
+    threads, which are started as jobs are queued.  A job can be delayed,
+    and can replace the job queued before it (see submit); a running job
+    can ask whether it has been superseded by a newer one.
+
+    stats['depth'] is the number of jobs waiting to run.  stats are only
+    updated with the condition held, and current_stats returns a
+    consistent copy of them for the /stats endpoint.
+
+    Every job is written to a sqlite queue before submit returns, and
+    recover queues the jobs left there by the last run, so jobs that were
+    waiting or running when gitbot stopped are not lost.  Before a job
+    runs it is leased for LEASE_TIME seconds (and its attempt counted),
+    and it is deleted once it is done.  The lease is only taken if no
+    other gitbot process sharing the queue holds it, so a job recovered
+    by more than one of them runs only once.  A job leased by another
+    process is tried again every RETRY_DELAY seconds (with the later
+    jobs of its key waiting behind it) until that process is done with
+    it or the lease expires, e.g. because the process stopped.
+    A job that fails is retried after RETRY_DELAY seconds, doubled
+    on every attempt, ahead of the later jobs of its pull request.  After
+    MAX_ATTEMPTS attempts (including runs that never finished because
+    gitbot stopped) it is moved to the dead letters instead, where it
+    stays until retry_dead_letters queues it again.  The /dead_letters
+    endpoint lists the dead letters, and a POST to /dead_letters/retry
+    queues them again.
+
+    The id of the webhook delivery a job comes from is stored in the same
+    transaction as the job, so a delivery Github sends again is ignored
+    exactly when its job was stored.  Delivery ids are kept for
+    delivery_ttl seconds, and the oldest ones are dropped once more than
+    max_deliveries are kept.
+
+    A job is the name of a function in _WEBHOOK_JOBS and its arguments,
+    which must be JSON serializable.
+    """
 
-            if commit_sha1 not in commit_info.keys():
-                commit_info[commit_sha1] = commit_status
+    MAX_ATTEMPTS = 5
+    RETRY_DELAY = 30
+    LEASE_TIME = 600
+
+    def __init__(self, num_workers, path, delivery_ttl, max_deliveries):
+        self.num_workers = num_workers
+        self.path = path or ':memory:'
+        self.delivery_ttl = delivery_ttl
+        self.max_deliveries = max_deliveries
+        self.condition = threading.Condition()
+        self.jobs = {}
+        self.ready = collections.deque()
+        self.sleeping = {}
+        self.running = {}
+        self.threads = []
+        self.stats = collections.defaultdict(int)
+        self.db_lock = threading.Lock()
+        self._db = None
+        self._delivery_count = None
+
+    def _connect(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            with self._db:
+                self._db.execute(
+                    'CREATE TABLE IF NOT EXISTS jobs ('
+                    'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                    'key TEXT NOT NULL, function TEXT NOT NULL, '
+                    'args TEXT NOT NULL, '
+                    'attempts INTEGER NOT NULL DEFAULT 0, '
+                    'leased REAL NOT NULL DEFAULT 0, '
+                    'dead INTEGER NOT NULL DEFAULT 0, error TEXT)')
+                self._db.execute(
+                    'CREATE TABLE IF NOT EXISTS deliveries ('
+                    'id TEXT PRIMARY KEY, seen REAL NOT NULL)')
+                self._db.execute(
+                    'CREATE INDEX IF NOT EXISTS deliveries_seen '
+                    'ON deliveries (seen)')
+            self._delivery_count, = self._db.execute(
+                'SELECT COUNT(*) FROM deliveries').fetchone()
+        return self._db
+
+    def _execute(self, statement, parameters=()):
+        with self.db_lock:
+            db = self._connect()
+            with db:
+                return db.execute(statement, parameters).lastrowid
+
+    def _query(self, statement, parameters=()):
+        with self.db_lock:
+            return self._connect().execute(statement, parameters).fetchall()
+
+    def _claim_delivery(self, db, delivery_id):
+        # Called with db_lock held, in the transaction that stores the
+        # delivery's job.  Returns the number of delivery ids kept once
+        # delivery_id is added, or None if it is already kept.
+        now = time.time()
+        count = self._delivery_count - db.execute(
+            'DELETE FROM deliveries WHERE seen < ?',
+            (now - self.delivery_ttl,)).rowcount
+        if not db.execute(
+                'INSERT OR IGNORE INTO deliveries VALUES (?, ?)',
+                (delivery_id, now)).rowcount:
+            return None
+        count += 1
+        if count > self.max_deliveries:
+            count -= db.execute(
+                'DELETE FROM deliveries WHERE id IN ('
+                'SELECT id FROM deliveries ORDER BY seen LIMIT ?)',
+                (count - self.max_deliveries,)).rowcount
+        return count
+
+    def submit(
+            self, key, function, args, delay=0, merge=None,
+            delivery_id=None):
+        """Store a job and queue it to run after the earlier jobs of key
+
+        Args:
+            key: A tuple of JSON serializable values
+            function: The function in _WEBHOOK_JOBS to run
+            args: The arguments to run it with
+            delay: How many seconds to wait before running the job
+            merge: For a job that makes the earlier ones that run the same
+                function obsolete, a function that takes the arguments of
+                the last waiting job of key (if it runs the same function)
+                and args, and returns the arguments of one job that
+                replaces both.  As the replacing job waits delay seconds
+                again, jobs queued less than delay seconds apart collapse
+                into one.
+            delivery_id: The id of the webhook delivery the job comes
+                from, if any
+
+        Returns:
+            False if the job was not queued because its delivery was
+            already accepted, otherwise True.
+        """
+        # Store the job (and its delivery) first, so the workers (which
+        # need the condition) are not held up by the write
+        with self.db_lock:
+            db = self._connect()
+            with db:
+                delivery_count = self._delivery_count
+                if delivery_id is not None:
+                    delivery_count = self._claim_delivery(db, delivery_id)
+                duplicate = delivery_count is None
+                if not duplicate:
+                    job_id = db.execute(
+                        'INSERT INTO jobs (key, function, args) '
+                        'VALUES (?, ?, ?)',
+                        (json.dumps(key), function.__name__,
+                         json.dumps(args))).lastrowid
+            if not duplicate:
+                self._delivery_count = delivery_count
+
+        if duplicate:
+            with self.condition:
+                self.stats['duplicate_deliveries'] += 1
+            return False
+
+        with self.condition:
+            if delivery_id is not None:
+                self.stats['deliveries'] += 1
+            jobs = self.jobs.get(key)
+            replaced = None
+            if (
+                    merge is not None and jobs and
+                    jobs[-1][1] == function.__name__):
+                replaced = jobs.pop()
+                self.stats['depth'] -= 1
+                self.stats['merged'] += 1
+                args = merge(replaced[2], args)
+            self.stats['queued'] += 1
+            self._queue(
+                key, (job_id, function.__name__, args, time.time() + delay))
+
+        # Store the merged arguments before dropping the job they replace,
+        # so a crash in between leaves both jobs, which run one after the
+        # other
+        if replaced is not None:
+            self._execute(
+                'UPDATE jobs SET args = ? WHERE id = ?',
+                (json.dumps(args), job_id))
+            self._execute('DELETE FROM jobs WHERE id = ?', (replaced[0],))
+        return True
+
+    def current_stats(self):
+        """Return a copy of stats, with the share of duplicate deliveries"""
+        with self.condition:
+            stats = dict(self.stats)
+        deliveries = (
+            stats.get('deliveries', 0) + stats.get('duplicate_deliveries', 0))
+        stats['delivery_hit_rate'] = 0.0
+        if deliveries:
+            stats['delivery_hit_rate'] = float(
+                stats.get('duplicate_deliveries', 0)) / deliveries
+        return stats
+
+    def superseded(self, key):
+        """Check whether a newer job replaces the running job of key"""
+        with self.condition:
+            function_name = self.running.get(key)
+            return any(
+                job[1] == function_name for job in self.jobs.get(key, []))
+
+    def recover(self):
+        """Queue the jobs the last run left in the queue"""
+        rows = self._query(
+            'SELECT id, key, function, args, attempts, leased FROM jobs '
+            'WHERE dead = 0 ORDER BY id')
+        now = time.time()
+        with self.condition:
+            for job_id, key, function_name, args, attempts, leased in rows:
+                if attempts >= self.MAX_ATTEMPTS and leased < now:
+                    self._bury(job_id, 'gitbot stopped while running it')
+                    self.stats['dead'] += 1
+                    continue
+                self.stats['recovered'] += 1
+                self._queue(
+                    tuple(json.loads(key)),
+                    (job_id, function_name, json.loads(args), 0))
+
+    def dead_letters(self):
+        """Return the dead letters, oldest first
+
+        Returns:
+            A list of dicts with the id, key, function, args, attempts and
+            last error of each dead letter.
+        """
+        return [
+            {'id': job_id, 'key': json.loads(key), 'function': function_name,
+             'args': json.loads(args), 'attempts': attempts, 'error': error}
+            for job_id, key, function_name, args, attempts, error in (
+                self._query(
+                    'SELECT id, key, function, args, attempts, error '
+                    'FROM jobs WHERE dead = 1 ORDER BY id'))]
+
+    def retry_dead_letters(self):
+        """Queue the dead letters again, with their attempts reset
+
+        Returns:
+            The number of jobs queued.
+        """
+        with self.db_lock:
+            db = self._connect()
+            with db:
+                rows = db.execute(
+                    'SELECT id, key, function, args FROM jobs '
+                    'WHERE dead = 1 ORDER BY id').fetchall()
+                db.execute(
+                    'UPDATE jobs SET dead = 0, attempts = 0 WHERE dead = 1')
+        with self.condition:
+            for job_id, key, function_name, args in rows:
+                self._queue(
+                    tuple(json.loads(key)),
+                    (job_id, function_name, json.loads(args), 0))
+        return len(rows)
+
+    def _queue(self, key, job):
+        # Called with the condition held.  A key with jobs is waiting in
+        # ready, sleeping until its next job may run, or running, and
+        # is woken again when its running job is done.
+        jobs = self.jobs.setdefault(key, collections.deque())
+        jobs.append(job)
+        self.stats['depth'] += 1
+        if len(jobs) == 1 and key not in self.running:
+            self._wake(key)
+
+        if len(self.threads) < self.num_workers:
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def _wake(self, key):
+        # Called with the condition held, to make key ready when its
+        # next job may run
+        timer = self.sleeping.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        if key in self.ready:
+            self.ready.remove(key)
+
+        delay = self.jobs[key][0][3] - time.time()
+        if delay > 0:
+            timer = self.sleeping[key] = threading.Timer(
+                delay, self._wake_up, [key])
+            timer.daemon = True
+            timer.start()
+        else:
+            self.ready.append(key)
+            self.condition.notify()
+
+    def _wake_up(self, key):
+        with self.condition:
+            # The timer may have fired just as it was cancelled
+            if self.sleeping.get(key) is threading.current_thread():
+                del self.sleeping[key]
+                self.ready.append(key)
+                self.condition.notify()
+
+    def _lease(self, job_id):
+        # Lease a job (and count its attempt) unless it is done, dead or
+        # leased by another process.  Returns None once it is leased,
+        # otherwise when the other lease expires (0 if there is none).
+        now = time.time()
+        with self.db_lock:
+            db = self._connect()
+            with db:
+                if db.execute(
+                        'UPDATE jobs SET leased = ?, attempts = attempts + 1 '
+                        'WHERE id = ? AND dead = 0 AND leased < ?',
+                        (now + self.LEASE_TIME, job_id, now)).rowcount:
+                    return None
+                leased = db.execute(
+                    'SELECT leased FROM jobs WHERE id = ? AND dead = 0',
+                    (job_id,)).fetchone()
+        return leased[0] if leased else 0
+
+    def _bury(self, job_id, error):
+        self._execute(
+            'UPDATE jobs SET dead = 1, leased = 0, error = ? WHERE id = ?',
+            (error, job_id))
+
+    def _run(self, key, job):
+        # Run a leased job.  Returns the stats it counts towards and, if it
+        # is to be retried, when.
+        job_id, function_name, args, _ = job
+        try:
+            _WEBHOOK_JOBS[function_name](*args)
+        except Exception as e:
+            # Never let one bad event stop the worker
+            print 'Webhook job {job} for {key} failed:'.format(
+                job=job_id, key=key)
+            traceback.print_exc()
+
+            (attempts,), = self._query(
+                'SELECT attempts FROM jobs WHERE id = ?', (job_id,))
+            if attempts >= self.MAX_ATTEMPTS:
+                self._bury(job_id, repr(e))
+                return ['failed', 'dead'], None
+            self._execute(
+                'UPDATE jobs SET leased = 0, error = ? WHERE id = ?',
+                (repr(e), job_id))
+            return ['failed', 'retries'], (
+                time.time() + self.RETRY_DELAY * 2 ** (attempts - 1))
+
+        self._execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+        return ['done'], None
+
+    def _work(self):
+        while True:
+            with self.condition:
+                while not self.ready:
+                    self.condition.wait()
+                key = self.ready.popleft()
+                job = self.jobs[key].popleft()
+                self.running[key] = job[1]
+                self.stats['depth'] -= 1
+                self.stats['running'] += 1
+
+            job_id, function_name, args, _ = job
+            retry_at = None
+            leased_until = self._lease(job_id)
+            if leased_until is None:
+                outcomes, retry_at = self._run(key, job)
+            elif leased_until:
+                # Another process is running the job
+                outcomes = ['leased_elsewhere']
+                retry_at = min(leased_until, time.time() + self.RETRY_DELAY)
             else:
-                commit_info[commit_sha1].extend(commit_status)
-
-            if check_churn:
-                commit_churn_info, branch_churn_sha1s = _check_diff_add_delete(
-                    commit_sha1, tip_commit)
-
-                for commit_churn_sha1 in commit_churn_info.keys():
-                    if commit_churn_sha1 not in commit_info.keys():
-                        commit_info[commit_churn_sha1] = commit_churn_info[
-                            commit_churn_sha1]
-                    else:
-                        commit_info[commit_churn_sha1].extend(
-                            commit_churn_info[commit_churn_sha1])
-
-                check_churn = bool(branch_churn_sha1s)
-
-            if check_move:
-                commit_move_info, branch_move_sha1s = _check_diff_move(
-                    commit_sha1, tip_commit)
-
-                for commit_move_sha1 in commit_move_info.keys():
-                    if commit_move_sha1 not in commit_info.keys():
-                        commit_info[commit_move_sha1] = commit_move_info[
-                            commit_move_sha1]
-                    else:
-                        commit_info[commit_move_sha1].extend(
-                            commit_move_info[commit_move_sha1])
-
-                check_move = bool(branch_move_sha1s)
-
-            log_line_state = LogState.SEPARATOR_LINE
-            commit_sha1 = None
-            merge = None
-            author = None
-            committer = None
-            title = None
-            separator = None
-            body = []
+                # Another process has run it (or buried it)
+                outcomes = ['done_elsewhere']
+
+            with self.condition:
+                del self.running[key]
+                self.stats['running'] -= 1
+                for outcome in outcomes:
+                    self.stats[outcome] += 1
+                if retry_at is not None:
+                    self.jobs[key].appendleft(
+                        (job_id, function_name, args, retry_at))
+                    self.stats['depth'] += 1
+                if self.jobs[key]:
+                    self._wake(key)
+                else:
+                    del self.jobs[key]
 
-    return commit_info
+
+webhook_workers = _WebhookWorkers(
+    WEBHOOK_WORKERS, WEBHOOK_QUEUE, WEBHOOK_DELIVERY_TTL,
+    WEBHOOK_REMEMBERED_DELIVERIES)
 
 
 # TODO:
@@ -1295,172 +4731,113 @@ def _parse_commit_log(base_commit, tip_commit):
 # of the inconsistent environments (kitchen vs vagrant).
 
 
-@app.route('/check_rebase',methods=['POST'])
-def check_rebase():
-    url_root = request.url_root
+def _track_opened_pull_request(
+        org_name, repo_name, pr_number, head_branch_name, base_branch_name,
+        head_sha1):
+    """Start tracking a pull request that was just opened
+
+    The pull request's branch is fetched and its first pair of rebase
+    branches is created, and the validation of its commits is queued.
+    """
+    # Fetch the PR branch.  If Github doesn't have its head yet, this fails
+    # and the job is retried.
+    fetched_sha1 = _fetch_pull_request_head(
+        org_name, repo_name, pr_number,
+        'git@{github_hostname}:{org}/{repo}.git'.format(
+            github_hostname=GITHUB_HOSTNAME, org=org_name, repo=repo_name),
+        head_sha1)
+
+    # We want to create a base and head branch pointers
+    # The base branch pointer would be the head of the branch
+    # when the branch is created.
+    # The head of the branch would advance whenever a commit is
+    # added to the branch (not a force-push).  This will allow
+    # us to do a diff if fixup or squash commits are added to
+    # this branch before its rebased.  Otherwise, we won't be
+    # able to get that diff once a rebase takes place.
+    # Proposed branch schema:
+    # <org-name>/<repo-name>/PR/<PR-number>/<base-branch>/rebase-base/<rebase-number>
+    # <org-name>/<repo-name>/PR/<PR-number>/<base-branch>/rebase-head/<rebase-number>
+    rebase_snapshots.start_rebase(
+        org_name, repo_name, pr_number, base_branch_name, 0,
+        fetched_sha1)
+
+    # Check list of commits in branch to see if there are any
+    # fixup or squash commits
+    _queue_validation(
+        org_name, repo_name, pr_number, base_branch_name, fetched_sha1,
+        head_sha1)
+    pull_request_heads.advance(
+        org_name, repo_name, pr_number, head_branch_name, head_sha1)
+
+
+def _track_head_branch_push(
+        org_name, repo_name, ssh_url, pr_number, head_branch_name, sender,
+        url_root, sha_before, sha_after):
+    """Track a push to the head branch of a pull request
+
+    Both the synchronize event of the pull request and the push event of
+    its head branch queue this, and whichever runs second does nothing.
+    The head of the pull request only advances once the push has been
+    tracked, so if tracking fails the retry of the job tracks it again.
+    """
+    if pull_request_heads.is_at(org_name, repo_name, pr_number, sha_after):
+        return
+    _track_pull_request_push(
+        org_name, repo_name, ssh_url, pr_number, sender, url_root,
+        sha_before, sha_after)
+    pull_request_heads.advance(
+        org_name, repo_name, pr_number, head_branch_name, sha_after)
+
+
+def _forget_pull_request(org_name, repo_name, pr_number):
+    """Stop tracking the head of a closed pull request"""
+    pull_request_heads.forget(org_name, repo_name, pr_number)
 
-    request_data = json.loads(flask.request.data)
-    request_header = flask.request.headers
 
-    event_type = request_header['X-Github-Event']
+def _webhook_job(event_type, request_data, url_root):
+    """Turn a webhook event into a job for the webhook workers
 
+    Everything the job needs is read from the payload here, so a payload
+    missing any of it is rejected before anything is queued.
+
+    Returns:
+        A (pull request key, function, args) tuple, or None if there is
+        nothing to do for the event.
+    """
     # The event is a pull request
     if event_type in ['pull_request']:
-        org_repo_name = request_data['repository']['full_name']
+        org_name, repo_name = request_data['repository']['full_name'].split(
+            '/')
         ssh_url = request_data['repository']['ssh_url']
         pr_number = request_data['number']
         action = request_data['action']
         head_branch_name = request_data['pull_request']['head']['ref']
         base_branch_name = request_data['pull_request']['base']['ref']
         head_sha1 = request_data['pull_request']['head']['sha']
+        key = org_name, repo_name, pr_number
 
-
-        # We only want to check for pull requests that have just been
-        # opened so that we can retrieve the PR branch and create a
-        # local pointer to it.
+        # We want to check pull requests that have just been opened so
+        # that we can retrieve the PR branch and create a local pointer
+        # to it
         if action == 'opened':
-            org_name, repo_name = org_repo_name.split('/')
-
-            # Run git fetch to get the objects from the remote
-            fetch_cmd = shlex.split(
-                'git fetch git@{github_hostname}:{org_repo_name}.git '
-                'refs/pull/{pr_number}/head'.format(
-                    github_hostname=GITHUB_HOSTNAME,
-                    org_repo_name=org_repo_name, pr_number=pr_number))
-
-            # Sleep for a second before running the git fetch command
-            time.sleep(1)
-            subprocess.call(fetch_cmd)
-
-            # We want to create a base and head branch pointers
-            # The base branch pointer would be the head of the branch
-            # when the branch is created.
-            # The head of the branch would advance whenever a commit is
-            # added to the branch (not a force-push).  This will allow
-            # us to do a diff if fixup or squash commits are added to
-            # this branch before its rebased.  Otherwise, we won't be
-            # able to get that diff once a rebase takes place.
-            # Proposed branch schema:
-            # <org-name>/<repo-name>/PR/<PR-number>/<base-branch>/rebase-base/<rebase-number>
-            # <org-name>/<repo-name>/PR/<PR-number>/<base-branch>/rebase-head/<rebase-number>
-            for branch_pointer in ['base', 'head']:
-                branch_cmd = shlex.split(
-                    'git branch {org}/{repo}/PR/{pr_number}/'
-                    '{base_branch_name}/rebase-{branch_pointer}/0 '
-                    'FETCH_HEAD'.format(
-                        org=org_name, repo=repo_name, pr_number=pr_number,
-                        base_branch_name=base_branch_name,
-                        branch_pointer=branch_pointer))
-
-                subprocess.call(branch_cmd)
-
-            # Check list of commits in branch to see if there are any
-            # fixup or squash commits
-            fetch_base_cmd = shlex.split(
-                'git fetch git@{github_hostname}:{org_repo_name}.git '
-                'refs/heads/{base_branch_name}'.format(
-                    github_hostname=GITHUB_HOSTNAME,
-                    org_repo_name=org_repo_name,
-                    base_branch_name=base_branch_name))
-
-            # sleep for a second before running the git fetch command
-            time.sleep(1)
-            subprocess.call(fetch_base_cmd)
-
-            log_start_ref = 'FETCH_HEAD'
-            log_end_ref = (
-                'refs/heads/{org}/{repo}/PR/{pr_number}/{base_branch_name}/'
-                'rebase-head/0'.format(
-                    org=org_name, repo=repo_name, pr_number=pr_number,
-                    base_branch_name=base_branch_name))
-            commit_info = _parse_commit_log(log_start_ref, log_end_ref)
-
-            branch_status_set = False
-            for sha1, errors in commit_info.items():
-                # If there are no issues with the commit, then skip it
-                if errors == []:
-                    continue
-
-                # Check the status of the commit
-                status_url = (
-                    '{endpoint}/repos/{org}/{repo}/commits/{sha1}/'
-                    'statuses'.format(
-                        endpoint=GITHUB_API_ENDPOINT, org=org_name,
-                        repo=repo_name, sha1=sha1))
-                http_auth = auth=requests.auth.HTTPBasicAuth(
-                    USERNAME, PERSONAL_ACCESS_TOKEN)
-
-                responses_json = requests.api.get(status_url, auth=http_auth)
-                responses = responses_json.json()
-
-                status_set = False
-                for reponse in responses:
-                    if (
-                            response['context'].startswith('gitbot') and
-                            response['state'] == 'failure'):
-                        status_set = True
-                        branch_status_set = True
-                        break
-
-                # If status is already set, we don't need to set it again
-                if status_set:
-                    continue
-
-                branch_status_set = True
-                post_body = {
-                    'state': 'failure',
-                }
-
-                # If there are a number of issues with the commit, then it's
-                # best to post a separate status for each of them.  If the
-                # description line gets too long, then the status doesn't get
-                # set like it should.
-                for error in errors:
-                    time.sleep(1)
-                    post_body['context'] = 'gitbot-{context}'.format(context=error[0])
-                    post_body['description'] = error[1]
-
-                    # Set the status for this commit
-                    response = requests.api.post(status_url, json=post_body, auth=http_auth)
-
-            # Even if one or more commits are marked as failed in a branch that's
-            # pull requested, Github will still consider the branch to be in a good
-            # state if the head commit is not marked as failed.  To get around
-            # this, if any of the commits in the branch are marked as failed, we
-            # mark the head commit the same way (even if there's nothing else wrong
-            # with it).
-            if branch_status_set:
-                print 'branch status is set'
-                status_url = (
-                    '{endpoint}/repos/{org}/{repo}/commits/{sha1}/'
-                    'statuses'.format(
-                        endpoint=GITHUB_API_ENDPOINT, org=org_name,
-                        repo=repo_name, sha1=head_sha1))
-                http_auth = auth=requests.auth.HTTPBasicAuth(
-                    USERNAME, PERSONAL_ACCESS_TOKEN)
-
-                responses_json = requests.api.get(status_url, auth=http_auth)
-                responses = responses_json.json()
-
-                status_set = False
-                for response in responses:
-                    if (
-                            response['context'].startswith('gitbot') and
-                            response['state'] == 'failure'):
-                        status_set = True
-                        break
-
-                # If status is already set, then we don't need to set it again
-                if not status_set:
-                    post_body = {
-                        'state': 'failure',
-                        'context': 'gitbot-branch-check',
-                        'description': 'Branch contains commits in failure state'
-                    }
-
-                    # Set the status for this commit
-                    response = requests.api.post(
-                        status_url, json=post_body, auth=http_auth)
+            return key, _track_opened_pull_request, (
+                org_name, repo_name, pr_number, head_branch_name,
+                base_branch_name, head_sha1)
+
+        # A push to the head branch of the pull request.  The event has
+        # everything the push event is missing (the pull request number),
+        # so it drives the push tracking; the push event is only a
+        # fallback for when this one is not delivered.
+        if action == 'synchronize':
+            return key, _track_head_branch_push, (
+                org_name, repo_name, ssh_url, pr_number, head_branch_name,
+                request_data['sender']['login'], url_root,
+                request_data['before'], head_sha1)
+
+        if action == 'closed':
+            return key, _forget_pull_request, (
+                org_name, repo_name, pr_number)
 
     # The event type is a push to the remote
     elif event_type in ['push']:
@@ -1471,254 +4848,124 @@ def check_rebase():
         org_name, repo_name = request_data['repository']['full_name'].split(
             '/')
 
-        # List remote branches that correspond to pull requests on the remote
-        # repo.  Github will create a branch named refs/pull/<PR_NUMBER>/head
-        # for each pull request that has been opened on that repo.  We want to
-        # find the sha1 value of that branch and compare it to the event sent
-        # to use by github (the after value).  The branch that matches, if any,
-        # will correspond to the pull request that was just updated.
-
-        # Sleep for a second before calling ls-remote since Github will
-        # sometimes send webhook events before it updates its git remote
-        # endpoint branch head information
-        time.sleep(1)
-        git_ls_remote_cmd = shlex.split(
-            'git ls-remote {url} refs/pull/*/head'.format(url=ssh_url))
-        ls_remote_output = subprocess.check_output(git_ls_remote_cmd)
-
-        target_branch = ''
-        for line in ls_remote_output.splitlines():
-            if not line:
-                continue
+        # A push to a branch of the repo may be a push to the base branch of
+        # some PRs, so make sure the next request using it fetches it again
+        pushed_ref = request_data['ref']
+        if not pushed_ref.startswith('refs/heads/'):
+            return None
+        pushed_branch = pushed_ref[len('refs/heads/'):]
+        base_refs.invalidate(org_name, repo_name, pushed_branch)
 
-            sha1, branch = line.split()
-            
-            # We're looking for the branch that was just pushed to, so
-            # we don't want a branch whose sha1 doesn't match the value
-            # of sha_after
-            if sha1 != sha_after:
-                continue
+        # Find the pull request whose head was the commit the branch was
+        # pushed from.  If its synchronize event was handled first the head
+        # has already moved to the new commit, and there is nothing to do.
+        pr_number = pull_request_heads.find(
+            org_name, repo_name, pushed_branch, sha_before)
+        if pr_number is None:
+            return None
+        return (org_name, repo_name, pr_number), _track_head_branch_push, (
+            org_name, repo_name, ssh_url, pr_number, pushed_branch, sender,
+            url_root, sha_before, sha_after)
 
-            target_branch = branch
-            break
-        
-        # If a PR has not been associated with the branch that was just pushed,
-        # then return.  This can happen when someone is just pushing up
-        # code to Github on a branch that hasn't been pull requested
-        # yet.
-        if not target_branch:
-            return ''
-
-        # Get the PR number for the remote refs/pull/*/head branch
-        _, _, pr_number, _ = target_branch.split('/')
-
-        # Branch name format
-        # AA/shark-github/PR/4/master/rebase-{base,head}/9
-        # Find the branches that correspond to the PR we're working
-        # with.  We use rebase-head here since we can find the latest
-        # rebase number if the branch was amended or rebased.  If not,
-        # then we can just update the rebase-head branch on the current
-        # rebase number
-        branch_cmd = shlex.split(
-            'git branch '
-            '--list {org}/{repo}/PR/{pr_number}/*/rebase-head/*'.format(
-                org=org_name, repo=repo_name, pr_number=pr_number))
-
-        branch_output = subprocess.check_output(branch_cmd)
-
-        # Find the branch that corresponds to the latest rebase
-        latest_rebase = -1
-        for line in branch_output.splitlines():
-            if not line:
-                continue
+    return None
 
-            branch_name, rebase_number = line.rsplit('/', 1)
-            rebase_number = int(rebase_number)
-            if rebase_number > latest_rebase:
-                latest_rebase = rebase_number
-
-        branch_name = branch_name.strip()
-
-        # Fetch the PR branch into FETCH_HEAD.  This will allow for
-        # creating a local branch that points to the head of that branch
-        fetch_cmd = shlex.split('git fetch {url} {target_branch}'.format(
-            url=ssh_url, target_branch=target_branch))
-        time.sleep(1)
-        subprocess.call(fetch_cmd)
-
-        # Check to see whether this push was a force push.  If it is,
-        # then this is a rebase or amended commit.  We do this by checking
-        # whether the before sha1 value in the github event is an ancestor of
-        # the after sha1 value.  For a regular push, this will be the case.
-        # For a force push, this may not be the case.
-        merge_base_cmd = shlex.split(
-            'git merge-base --is-ancestor {before} {after}'.format(
-                before=sha_before, after=sha_after))
-        ref_name = request_data['ref']
-
-        is_rebase = subprocess.call(merge_base_cmd)
-
-        # Create new rebase branches off of FETCH_HEAD (for both
-        # rebase-base and rebase-head)
-        local_branch_name = '{branch_name}/{rebase_number}'
-        if is_rebase:
-            local_branch_name = local_branch_name.format(
-                branch_name=branch_name, rebase_number=latest_rebase + 1)
-            # Remove rebase-head from the end of the branch name (rebase
-            # number was removed earlier)
-            base_branch_name, _ = branch_name.rsplit('/', 1)
-            for branch_pointer in ['base', 'head']:
-                new_branch_cmd = shlex.split(
-                    'git branch {base_branch_name}/rebase-{branch_pointer}/'
-                    '{rebase_number} FETCH_HEAD'.format(
-                        base_branch_name=base_branch_name,
-                        branch_pointer=branch_pointer,
-                        rebase_number=latest_rebase + 1))
-                subprocess.call(new_branch_cmd)
-
-            comment = _generate_github_rebase_comment(
-                sender, url_root, base_branch_name, latest_rebase)
-
-            # Post the comment on the Github PR
-            post_url = (
-                '{endpoint}/repos/{org}/{repo}/issues/{pr_number}/'
-                'comments'.format(
-                    endpoint=GITHUB_API_ENDPOINT, org=org_name, repo=repo_name,
-                    pr_number=pr_number))
-            post_body = {'body': comment}
-            http_auth = auth=requests.auth.HTTPBasicAuth(
-                USERNAME, PERSONAL_ACCESS_TOKEN)
-
-            response = requests.api.post(
-                post_url, json=post_body, auth=http_auth)
-        else: # This is not a rebase/amend
-            # branch_name ends in rebase-head.  We want to update this
-            # branch to point to the new commit. rebase-base will remain
-            # at the same commit the head of this branch was after it
-            # was last rebased.
-
-            # We could consider checking whether the commits pushed are
-            # fixup or squash commits and then posting a comment in the
-            # PR that shows who pushed the commits and list their
-            # comment message bodies and titles in the comment.
-            local_branch_name = local_branch_name.format(
-                branch_name=branch_name, rebase_number=latest_rebase)
-            update_branch_cmd = shlex.split(
-                'git update-ref refs/heads/{branch_name}/{rebase_number} '
-                'FETCH_HEAD'.format(
-                    branch_name=branch_name, rebase_number=latest_rebase))
-            subprocess.call(update_branch_cmd)
-
-        # Determine the base branch of the PR
-        # AA/shark-github/PR/4/master/rebase-{base,head}/9
-        _, _, _, _, base_branch_name, _, _ = local_branch_name.split('/')
-        
-        # Check list of commits in branch to see if there are any
-        # fixup or squash commits
-        fetch_base_cmd = shlex.split(
-            'git fetch git@{github_hostname}:{org_name}/{repo_name}.git '
-            'refs/heads/{base_branch_name}'.format(
-                github_hostname=GITHUB_HOSTNAME,
-                org_name=org_name, repo_name=repo_name,
-                base_branch_name=base_branch_name))
-        # Sleep for a second before issuing the git fetch command
-        time.sleep(1)
-        subprocess.call(fetch_base_cmd)
-
-        log_start_ref = 'FETCH_HEAD'
-        log_end_ref = local_branch_name
-        commit_info = _parse_commit_log(log_start_ref, log_end_ref)
-
-        branch_status_set = False
-        for sha1, errors in commit_info.items():
-
-            # If this commit has no issues, then move onto the next one
-            if errors == []:
-                continue
 
-            # Check the status of the commit
-            status_url = (
-                '{endpoint}/repos/{org}/{repo}/commits/{sha1}/'
-                'statuses'.format(
-                    endpoint=GITHUB_API_ENDPOINT, org=org_name,
-                    repo=repo_name, sha1=sha1))
-            http_auth = auth=requests.auth.HTTPBasicAuth(
-                USERNAME, PERSONAL_ACCESS_TOKEN)
-
-            responses_json = requests.api.get(status_url, auth=http_auth)
-            responses = responses_json.json()
-
-            status_set = False
-            for response in responses:
-                if (
-                        response['context'].startswith('gitbot') and
-                        response['state'] == 'failure'):
-                    status_set = True
-                    branch_status_set = True
-                    break
+# The functions webhook jobs can run, by name
+_WEBHOOK_JOBS = dict(
+    (function.__name__, function)
+    for function in [
+        _track_opened_pull_request, _track_head_branch_push,
+        _forget_pull_request, _validate_pull_request])
 
-            # If status is already set, then we don't need to set it again
-            if status_set:
-                continue
 
-            branch_status_set = True
-            post_body = {
-                'state': 'failure',
-            }
+def _signed_by_webhook_secret():
+    """Check the X-Hub-Signature-256 header of a request
 
-            # If there are a number of issues with the commit, then it's best
-            # to post a separate status for each of them.  If the description
-            # line gets too long, then the status doesn't get set like
-            # it should.
-            for error in errors:
-                time.sleep(1)
-                print error
-                post_body['context'] = 'gitbot-{context}'.format(context=error[0])
-                post_body['description'] = error[1]
-
-                # Set the status for this commit
-                response = requests.api.post(
-                    status_url, json=post_body, auth=http_auth)
-
-        # Even if one or more commits are marked as failed in a branch that's
-        # pull requested, Github will still consider the branch to be in a good
-        # state if the head commit is not marked as failed.  To get around
-        # this, if any of the commits in the branch are marked as failed, we
-        # mark the head commit the same way (even if there's nothing else wrong
-        # with it).
-        if branch_status_set:
-            status_url = (
-                '{endpoint}/repos/{org}/{repo}/commits/{sha1}/'
-                'statuses'.format(
-                    endpoint=GITHUB_API_ENDPOINT, org=org_name,
-                    repo=repo_name, sha1=sha_after))
-            http_auth = auth=requests.auth.HTTPBasicAuth(
-                USERNAME, PERSONAL_ACCESS_TOKEN)
-
-            responses_json = requests.api.get(status_url, auth=http_auth)
-            responses = responses_json.json()
-
-            status_set = False
-            for response in responses:
-                if (
-                        response['context'].startswith('gitbot') and
-                        response['state'] == 'failure'):
-                    status_set = True
-                    break
+    Returns:
+        Whether the header holds the HMAC-SHA256 of the request body with
+        WEBHOOK_SECRET as the key.  Nothing is signed while WEBHOOK_SECRET
+        is empty.
+    """
+    if not WEBHOOK_SECRET:
+        return False
+    signature = 'sha256=' + hmac.new(
+        WEBHOOK_SECRET, flask.request.get_data(), hashlib.sha256).hexdigest()
+    return hmac.compare_digest(
+        signature, str(flask.request.headers.get('X-Hub-Signature-256', '')))
+
+
+@app.route('/check_rebase',methods=['POST'])
+def check_rebase():
+    url_root = request.url_root
+
+    if WEBHOOK_SECRET and not _signed_by_webhook_secret():
+        return 'Invalid webhook signature\n', 403
+
+    # Github gives up on a webhook delivery after 10 seconds, so the
+    # event is only checked and stored in the queue here and handled by
+    # the webhook workers
+    try:
+        request_data = json.loads(flask.request.data)
+        event_type = flask.request.headers['X-Github-Event']
+        job = _webhook_job(event_type, request_data, url_root)
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        return 'Invalid webhook event: {error}\n'.format(error=e), 400
+
+    # Github sends a delivery again when it times out waiting for it, so
+    # ignore the deliveries whose job is already queued
+    delivery_id = flask.request.headers.get('X-Github-Delivery')
+    if job is not None and not webhook_workers.submit(
+            *job, delivery_id=delivery_id):
+        return 'Delivery already accepted\n', 200
+    return '', 202
+
+
+def _endpoint_git_dir(org_name, repo_name):
+    """Return the mirror of a repo for a page, or respond with a 404
+
+    Pages only read from mirrors, so a repo without one (or an invalid
+    name) is not found.
+    """
+    try:
+        return mirrors.git_dir(org_name, repo_name)
+    except (ValueError, _MissingMirror):
+        flask.abort(404)
+
+
+@app.route('/stats', methods=['GET'])
+def show_stats():
+    stats = {
+        'base_refs': base_refs.current_stats(),
+        'commit_rules': commit_rules.current_stats(),
+        'github': github.current_stats(),
+        'outbox': outbox.current_stats(),
+        'range_verdicts': range_verdicts.current_stats(),
+        'rebase_snapshots': rebase_snapshots.current_stats(),
+        'verdict_store': verdict_store.current_stats(),
+        'render_cache': render_cache.current_stats(),
+        'webhook_workers': webhook_workers.current_stats(),
+    }
+    return Response(
+        response=json.dumps(stats, indent=2, sort_keys=True), status=200,
+        mimetype='application/json')
 
-            # If status is already set, then we don't need to set it again
-            if not status_set:
-                post_body = {
-                    'state': 'failure',
-                    'context': 'gitbot-branch-check',
-                    'description': 'Branch contains commits in failure state'
-                }
 
-                # Set the status for this commit
-                response = requests.api.post(
-                    status_url, json=post_body, auth=http_auth)
+@app.route('/dead_letters', methods=['GET'])
+def show_dead_letters():
+    return Response(
+        response=json.dumps(
+            webhook_workers.dead_letters(), indent=2, sort_keys=True),
+        status=200, mimetype='application/json')
 
-    return ''
+
+@app.route('/dead_letters/retry', methods=['POST'])
+def retry_dead_letters():
+    # This reruns jobs, so it has to be signed like a webhook delivery
+    if not _signed_by_webhook_secret():
+        return 'Invalid signature\n', 403
+    return Response(
+        response=json.dumps({'queued': webhook_workers.retry_dead_letters()}),
+        status=200, mimetype='application/json')
 
 
 @app.route('/rebase_diff',methods=['GET'])
@@ -1731,100 +4978,78 @@ def show_rebase_diff():
     side_by_side = side_by_side == '1'
 
     org, repo, _, _, base_branch = branch_name.split('/')
+    git_dir = _endpoint_git_dir(org, repo)
     start_branch, start_number = rebase_start.split('-')
     end_branch, end_number = rebase_end.split('-')
 
+    start_ref = (
+        'refs/heads/{branch_name}/rebase-{start_branch}/'
+        '{start_number}'.format(
+            branch_name=branch_name, start_branch=start_branch,
+            start_number=start_number))
+    end_ref = (
+        'refs/heads/{branch_name}/rebase-{end_branch}/'
+        '{end_number}'.format(
+            branch_name=branch_name, end_branch=end_branch,
+            end_number=end_number))
+
+    # Use a recently fetched copy of the base branch so we have a local
+    # copy of its objects and its sha1
+    base_sha1 = None
     if side_by_side:
-        # fetch the base branch from the remote so we can have a local
-        # copy of the objects and its sha1 stored in FETCH_HEAD
-        git_fetch_base_branch_cmd = shlex.split(
-            'git fetch git@{github_hostname}:{org}/{repo}.git '
-            # 'git fetch ../git-rebase.git '
-            'refs/heads/{base_branch}'.format(
-                github_hostname=GITHUB_HOSTNAME, org=org, repo=repo,
-                base_branch=base_branch))
-        time.sleep(1)
-        subprocess.call(git_fetch_base_branch_cmd)
-
-        git_diff_rebase_start_cmd = shlex.split(
-            'git diff '
-            'FETCH_HEAD..'
-            'refs/heads/{branch_name}/'
-            'rebase-{start_branch}/{start_number}'.format(
-                branch_name=branch_name, start_branch=start_branch,
-                start_number=start_number))
-        git_diff_rebase_start_output = subprocess.check_output(
-            git_diff_rebase_start_cmd)
-
-        git_diff_rebase_end_cmd = shlex.split(
-            'git diff '
-            'FETCH_HEAD..'
-            'refs/heads/{branch_name}/'
-            'rebase-{end_branch}/{end_number}'.format(
-                branch_name=branch_name, end_branch=end_branch,
-                end_number=end_number))
-        git_diff_rebase_end_output = subprocess.check_output(
-            git_diff_rebase_end_cmd)
-
-        side_by_side_html_output = _generate_side_by_side_html_diff(
-            git_diff_rebase_start_output, git_diff_rebase_end_output)
-
-        # Update the table header titles for each side to match the
-        # branch name diffs
-        titles = [
-            'git diff '
-            'refs/heads/{base_branch}..'
-            'refs/heads/{branch_name}/rebase-{start_branch}/'
-            '{start_number}'.format(
-                base_branch=base_branch, branch_name=branch_name,
-                start_branch=start_branch, start_number=start_number),
-            'git diff '
-            'refs/heads/{base_branch}..'
-            'refs/heads/{branch_name}/rebase-{end_branch}/'
-            '{end_number}'.format(
-                base_branch=base_branch, branch_name=branch_name,
-                end_branch=end_branch, end_number=end_number),
-        ]
-        html_parser = BeautifulSoup(side_by_side_html_output, 'html.parser')
-        for title, th_element in zip(titles, html_parser.find_all('th')):
-            th_element.string = title
+        base_sha1 = base_refs.resolve(org, repo, base_branch)
+    start_sha1, end_sha1 = _resolve_refs([start_ref, end_ref], git_dir)
+
+    def render():
+        if side_by_side:
+            git_diff_rebase_start_cmd = shlex.split(
+                'git diff {base_sha1}..{start_sha1}'.format(
+                    base_sha1=base_sha1, start_sha1=start_sha1))
+            git_diff_rebase_start_output = subprocess.check_output(
+                git_diff_rebase_start_cmd, cwd=git_dir)
+
+            git_diff_rebase_end_cmd = shlex.split(
+                'git diff {base_sha1}..{end_sha1}'.format(
+                    base_sha1=base_sha1, end_sha1=end_sha1))
+            git_diff_rebase_end_output = subprocess.check_output(
+                git_diff_rebase_end_cmd, cwd=git_dir)
+
+            # Title the table header for each side with the branch name
+            # diffs
+            titles = [
+                'git diff refs/heads/{base_branch}..{start_ref}'.format(
+                    base_branch=base_branch, start_ref=start_ref),
+                'git diff refs/heads/{base_branch}..{end_ref}'.format(
+                    base_branch=base_branch, end_ref=end_ref),
+            ]
+            return _generate_side_by_side_html_diff(
+                [git_diff_rebase_start_output, git_diff_rebase_end_output],
+                titles, 'Rebase Diff')
 
-        # Update the page title to say Rebase Diff
-        html_parser.title.string = 'Rebase Diff'
-
-        return_str = str(html_parser)
-    else:
         git_diff_cmd = shlex.split(
             'git diff '
-            '--src-prefix='
-            '"refs/heads/{branch_name}/rebase-{start_branch}/{start_number}:" '
-            '--dst-prefix='
-            '"refs/heads/{branch_name}/rebase-{end_branch}/{end_number}:" '
-            'refs/heads/{branch_name}/rebase-{start_branch}/{start_number}..'
-            'refs/heads/{branch_name}/rebase-{end_branch}/{end_number}'.format(
-                branch_name=branch_name, start_branch=start_branch,
-                start_number=start_number, end_branch=end_branch,
-                end_number=end_number))
-
-        git_diff_output = subprocess.check_output(git_diff_cmd)
+            '--src-prefix="{start_ref}:" '
+            '--dst-prefix="{end_ref}:" '
+            '{start_sha1}..{end_sha1}'.format(
+                start_ref=start_ref, end_ref=end_ref,
+                start_sha1=start_sha1, end_sha1=end_sha1))
 
-        return_str = ''
+        git_diff_output = subprocess.check_output(git_diff_cmd, cwd=git_dir)
 
         # There was no diff, then just return a message stating that
         if not git_diff_output:
-            return_str = (
+            return (
                 '<html>'
                 '<title>Rebase Diff</title>'
                 '<body>No code changed in rebase</body>'
                 '</html>')
-            return Response(response=return_str, status=200)
 
-        html_diff_output = _generate_html_diff(git_diff_output)
+        return _generate_html_diff(git_diff_output, 'Rebase Diff')
 
-        # Set the title to Rebase Diff
-        html_parser = BeautifulSoup(html_diff_output, 'html.parser')
-        html_parser.title.string = 'Rebase Diff'
-        return_str = str(html_parser)
+    return_str = render_cache.get_or_render(
+        _render_cache_key(
+            'rebase_diff', request.args, [base_sha1, start_sha1, end_sha1]),
+        render)
 
     return Response(response=return_str, status=200)
 
@@ -1845,64 +5070,56 @@ def show_rebase_commit_log_diff():
 
     # AA/shark-github/PR/6/master
     org, repo, _, _, base_branch = branch_name.split('/')
+    git_dir = _endpoint_git_dir(org, repo)
+
+    # Use a recently fetched copy of the base branch so we have a local
+    # copy of its objects and its sha1
+    base_sha1 = base_refs.resolve(org, repo, base_branch)
+
+    start_ref = (
+        'refs/heads/{branch_name}/rebase-{start_branch}/'
+        '{start_number}'.format(
+            branch_name=branch_name, start_branch=start_branch,
+            start_number=start_number))
+    end_ref = (
+        'refs/heads/{branch_name}/rebase-{end_branch}/'
+        '{end_number}'.format(
+            branch_name=branch_name, end_branch=end_branch,
+            end_number=end_number))
+    start_sha1, end_sha1 = _resolve_refs([start_ref, end_ref], git_dir)
+
+    def render():
+        rebase_start_cmd = shlex.split(
+            'git log {patch} {base_sha1}..{start_sha1}'.format(
+                patch='-p' if show_diffs else '', base_sha1=base_sha1,
+                start_sha1=start_sha1))
+        rebase_start_output = subprocess.check_output(
+            rebase_start_cmd, cwd=git_dir)
+
+        rebase_end_cmd = shlex.split(
+            'git log {patch} {base_sha1}..{end_sha1}'.format(
+                patch='-p' if show_diffs else '', base_sha1=base_sha1,
+                end_sha1=end_sha1))
+        rebase_end_output = subprocess.check_output(
+            rebase_end_cmd, cwd=git_dir)
+
+        if side_by_side:
+            # Title the table header for each side with the branch name
+            # diffs
+            titles = [
+                'git log {patch} '
+                'refs/heads/{base_branch}..{start_ref}'.format(
+                    patch='-p' if show_diffs else '',
+                    base_branch=base_branch, start_ref=start_ref),
+                'git log {patch} '
+                'refs/heads/{base_branch}..{end_ref}'.format(
+                    patch='-p' if show_diffs else '',
+                    base_branch=base_branch, end_ref=end_ref),
+            ]
+            return _generate_side_by_side_html_diff(
+                [rebase_start_output, rebase_end_output], titles,
+                'Commit Log Diff')
 
-    # fetch the base branch from the remote so we can have a local copy of
-    # the objects and its sha1 stored in FETCH_HEAD
-    git_fetch_base_branch_cmd = shlex.split(
-        'git fetch git@{github_hostname}:{org}/{repo}.git '
-        'refs/heads/{base_branch}'.format(
-            github_hostname=GITHUB_HOSTNAME, org=org, repo=repo,
-            base_branch=base_branch))
-    time.sleep(1)
-    subprocess.call(git_fetch_base_branch_cmd)
-
-    rebase_start_cmd = shlex.split(
-        'git log {patch} '
-        'FETCH_HEAD..'
-        'refs/heads/{branch_name}/rebase-{start_branch}/{start_number}'.format(
-            patch='-p' if show_diffs else '', branch_name=branch_name,
-            start_branch=start_branch, start_number=start_number))
-    rebase_start_output = subprocess.check_output(rebase_start_cmd)
-
-    rebase_end_cmd = shlex.split(
-        'git log {patch} '
-        'FETCH_HEAD..'
-        'refs/heads/{branch_name}/rebase-{end_branch}/{end_number}'.format(
-            patch='-p' if show_diffs else '', branch_name=branch_name,
-            end_branch=end_branch, end_number=end_number))
-    rebase_end_output = subprocess.check_output(rebase_end_cmd)
-
-    if side_by_side:
-        side_by_side_html_output = _generate_side_by_side_html_diff(
-            rebase_start_output, rebase_end_output)
-
-        # Update the table header titles for each side to match the
-        # branch name diffs
-        titles = [
-            'git log {patch} '
-            'refs/heads/{base_branch}..'
-            'refs/heads/{branch_name}/rebase-{start_branch}/'
-            '{start_number}'.format(
-                patch='-p' if show_diffs else '',
-                base_branch=base_branch, branch_name=branch_name,
-                start_branch=start_branch, start_number=start_number),
-            'git log {patch} '
-            'refs/heads/{base_branch}..'
-            'refs/heads/{branch_name}/rebase-{end_branch}/'
-            '{end_number}'.format(
-                patch='-p' if show_diffs else '',
-                base_branch=base_branch, branch_name=branch_name,
-                end_branch=end_branch, end_number=end_number),
-        ]
-        html_parser = BeautifulSoup(side_by_side_html_output, 'html.parser')
-        for title, th_element in zip(titles, html_parser.find_all('th')):
-            th_element.string = title
-
-        # Update the page title to say Commit Log Diff
-        html_parser.title.string = 'Commit Log Diff'
-
-        return_str = str(html_parser)
-    else:
         # Create temporary files for the diff command
         rebase_start_temp_file = tempfile.NamedTemporaryFile(delete=False)
         with open(rebase_start_temp_file.name, 'w') as s:
@@ -1940,43 +5157,56 @@ def show_rebase_commit_log_diff():
         os.unlink(rebase_start_temp_file.name)
         os.unlink(rebase_end_temp_file.name)
 
-        return_str = ''
         if not rebase_log_diff_output:
-            return_str = (
+            return (
                 '<html><title>Commit Log Diff</title>'
                 '<body>Commit logs have not changed</body>'
                 '</html>')
-            return Response(response=return_str, status=200)
 
-        html_diff_output = _generate_html_diff(rebase_log_diff_output)
+        return _generate_html_diff(
+            rebase_log_diff_output, 'Rebase Commit Log Diff')
 
-        # Set the title to Rebase Commit Log Diff
-        html_parser = BeautifulSoup(html_diff_output, 'html.parser')
-        html_parser.title.string = 'Rebase Commit Log Diff'
+    return_str = render_cache.get_or_render(
+        _render_cache_key(
+            'rebase_commit_log_diff', request.args,
+            [base_sha1, start_sha1, end_sha1]),
+        render)
 
-        return_str = str(html_parser)
     return Response(response=return_str, status=200)
 
 
+def _parse_rebase_series_args():
+    """Return the rebase branches named by a series request
+
+    The rebase_first to rebase_fourth query parameters are read in order
+    until one is missing.
+
+    Returns:
+        A list of [branch pointer, rebase number] lists.
+    """
+    rebase_branches = []
+    for rebase_branch in [
+            request.args.get('rebase_first'),
+            request.args.get('rebase_second'),
+            request.args.get('rebase_third'),
+            request.args.get('rebase_fourth')]:
+        if not rebase_branch:
+            break
+        rebase_branches.append(rebase_branch.split('-'))
+
+    return rebase_branches
+
+
 @app.route('/rebase_diff_series', methods=['GET'])
 def show_rebase_diff_series():
     branch_name = request.args.get('branch_name')
-    rebase_first = request.args.get('rebase_first')
-    rebase_second = request.args.get('rebase_second')
-    rebase_third = request.args.get('rebase_third')
-    rebase_fourth = request.args.get('rebase_fourth')
 
     org, repo, _, _, base_branch = branch_name.split('/')
+    git_dir = _endpoint_git_dir(org, repo)
 
     # Loop through the rebase branches until we get to an undefined
     # value
-    rebase_branches = []
-    for rebase_branch in [
-            rebase_first, rebase_second, rebase_third,
-            rebase_fourth]:
-        if not rebase_branch:
-            break
-        rebase_branches.append(rebase_branch.split('-'))
+    rebase_branches = _parse_rebase_series_args()
 
     if len(rebase_branches) < 2:
         return_str = (
@@ -1984,55 +5214,39 @@ def show_rebase_diff_series():
             'branches to show a series diff</body></html>')
         return Response(response=return_str, status=200)
 
-    # fetch the base branch from the remote so we can have a local
-    # copy of the objects and its sha1 stored in FETCH_HEAD
-    git_fetch_base_branch_cmd = shlex.split(
-        'git fetch git@{github_hostname}:{org}/{repo}.git '
-        #'git fetch ../git-rebase.git '
-        'refs/heads/{base_branch}'.format(
-            github_hostname=GITHUB_HOSTNAME, org=org, repo=repo,
-            base_branch=base_branch))
-    time.sleep(1)
-    subprocess.call(git_fetch_base_branch_cmd)
-
-    # Generate the rebase commands
-    git_diff_rebase_cmds = []
-    for rebase_branch in rebase_branches:
-        git_diff_rebase_cmd = shlex.split(
-            'git diff '
-            'FETCH_HEAD..'
-            'refs/heads/{branch_name}/rebase-{branch}/{number}'.format(
-                branch_name=branch_name, branch=rebase_branch[0],
-                number=rebase_branch[1]))
-        git_diff_rebase_cmds.append(git_diff_rebase_cmd)
-
-    # Get the rebase diff outputs
-    git_diff_rebase_outputs = []
-    for git_diff_rebase_cmd in git_diff_rebase_cmds:
-        git_diff_rebase_output = subprocess.check_output(git_diff_rebase_cmd)
-        git_diff_rebase_outputs.append(git_diff_rebase_output)
-
-    series_html_output = _generate_side_by_side_html_diff(
-        *git_diff_rebase_outputs)
-
-    titles = []
-    for rebase_branch in rebase_branches:
-        title = (
-            'git diff '
-            'refs/heads/{base_branch}..'
-            'refs/heads/{branch_name}/rebase-{branch}/{number}'.format(
-                base_branch=base_branch, branch_name=branch_name,
-                branch=rebase_branch[0], number=rebase_branch[1]))
-        titles.append(title)
-    
-    html_parser = BeautifulSoup(series_html_output, 'html.parser')
-    for title, th_element in zip(titles, html_parser.find_all('th')):
-        th_element.string = title
-
-    # Update the page title to say Rebase Series Diff
-    html_parser.title.string = 'Rebase Series Diff'
-
-    return_str = str(html_parser)
+    # Use a recently fetched copy of the base branch so we have a local
+    # copy of its objects and its sha1
+    base_sha1 = base_refs.resolve(org, repo, base_branch)
+
+    rebase_refs = [
+        'refs/heads/{branch_name}/rebase-{branch}/{number}'.format(
+            branch_name=branch_name, branch=rebase_branch[0],
+            number=rebase_branch[1])
+        for rebase_branch in rebase_branches]
+    rebase_sha1s = _resolve_refs(rebase_refs, git_dir)
+    sha1s = [base_sha1] + rebase_sha1s
+
+    def render():
+        # Get the rebase diff outputs
+        git_diff_rebase_outputs = []
+        for rebase_sha1 in rebase_sha1s:
+            git_diff_rebase_cmd = shlex.split(
+                'git diff {base_sha1}..{rebase_sha1}'.format(
+                    base_sha1=base_sha1, rebase_sha1=rebase_sha1))
+            git_diff_rebase_outputs.append(
+                subprocess.check_output(git_diff_rebase_cmd, cwd=git_dir))
+
+        titles = []
+        for rebase_ref in rebase_refs:
+            title = 'git diff refs/heads/{base_branch}..{rebase_ref}'.format(
+                base_branch=base_branch, rebase_ref=rebase_ref)
+            titles.append(title)
+
+        return _generate_side_by_side_html_diff(
+            git_diff_rebase_outputs, titles, 'Rebase Series Diff')
+
+    return_str = render_cache.get_or_render(
+        _render_cache_key('rebase_diff_series', request.args, sha1s), render)
 
     return Response(response=return_str, status=200)
 
@@ -2040,25 +5254,16 @@ def show_rebase_diff_series():
 @app.route('/rebase_commit_log_series', methods=['GET'])
 def show_rebase_commit_log_series():
     branch_name = request.args.get('branch_name')
-    rebase_first = request.args.get('rebase_first')
-    rebase_second = request.args.get('rebase_second')
-    rebase_third = request.args.get('rebase_third')
-    rebase_fourth = request.args.get('rebase_fourth')
     show_diffs = request.args.get('show_diffs')
 
     show_diffs = show_diffs == '1'
 
     org, repo, _, _, base_branch = branch_name.split('/')
+    git_dir = _endpoint_git_dir(org, repo)
 
     # Loop through the rebase branches until we get to an undefined
     # value
-    rebase_branches = []
-    for rebase_branch in [
-            rebase_first, rebase_second, rebase_third,
-            rebase_fourth]:
-        if not rebase_branch:
-            break
-        rebase_branches.append(rebase_branch.split('-'))
+    rebase_branches = _parse_rebase_series_args()
 
     if len(rebase_branches) < 2:
         return_str = (
@@ -2066,60 +5271,59 @@ def show_rebase_commit_log_series():
             'branches to show a series log</body></html>')
         return Response(response=return_str, status=200)
 
-    # fetch the base branch from the remote so we can have a local
-    # copy of the objects and its sha1 stored in FETCH_HEAD
-    git_fetch_base_branch_cmd = shlex.split(
-        'git fetch git@{github_hostname}:{org}/{repo}.git '
-        #'git fetch ../git-rebase.git '
-        'refs/heads/{base_branch}'.format(
-            github_hostname=GITHUB_HOSTNAME, org=org, repo=repo,
-            base_branch=base_branch))
-    time.sleep(1)
-    subprocess.call(git_fetch_base_branch_cmd)
-
-    # Generate the rebase commands
-    git_log_rebase_cmds = []
-    for rebase_branch in rebase_branches:
-        git_log_rebase_cmd = shlex.split(
-            'git log {patch} '
-            'FETCH_HEAD..'
-            'refs/heads/{branch_name}/rebase-{branch}/{number}'.format(
-                patch='-p' if show_diffs else '',
-                branch_name=branch_name, branch=rebase_branch[0],
-                number=rebase_branch[1]))
-        git_log_rebase_cmds.append(git_log_rebase_cmd)
-
-    # Get the rebase log outputs
-    git_log_rebase_outputs = []
-    for git_log_rebase_cmd in git_log_rebase_cmds:
-        git_log_rebase_output = subprocess.check_output(git_log_rebase_cmd)
-        git_log_rebase_outputs.append(git_log_rebase_output)
-
-    series_html_output = _generate_side_by_side_html_diff(
-        *git_log_rebase_outputs)
-
-    titles = []
-    for rebase_branch in rebase_branches:
-        title = (
-            'git log {patch} '
-            'refs/heads/{base_branch}..'
-            'refs/heads/{branch_name}/rebase-{branch}/{number}'.format(
-                patch = '-p' if show_diffs else '',
-                base_branch=base_branch, branch_name=branch_name,
-                branch=rebase_branch[0], number=rebase_branch[1]))
-        titles.append(title)
-    
-    html_parser = BeautifulSoup(series_html_output, 'html.parser')
-    for title, th_element in zip(titles, html_parser.find_all('th')):
-        th_element.string = title
+    # Use a recently fetched copy of the base branch so we have a local
+    # copy of its objects and its sha1
+    base_sha1 = base_refs.resolve(org, repo, base_branch)
+
+    rebase_refs = [
+        'refs/heads/{branch_name}/rebase-{branch}/{number}'.format(
+            branch_name=branch_name, branch=rebase_branch[0],
+            number=rebase_branch[1])
+        for rebase_branch in rebase_branches]
+    rebase_sha1s = _resolve_refs(rebase_refs, git_dir)
+    sha1s = [base_sha1] + rebase_sha1s
+
+    def render():
+        # Get the rebase log outputs
+        git_log_rebase_outputs = []
+        for rebase_sha1 in rebase_sha1s:
+            git_log_rebase_cmd = shlex.split(
+                'git log {patch} {base_sha1}..{rebase_sha1}'.format(
+                    patch='-p' if show_diffs else '',
+                    base_sha1=base_sha1, rebase_sha1=rebase_sha1))
+            git_log_rebase_outputs.append(
+                subprocess.check_output(git_log_rebase_cmd, cwd=git_dir))
+
+        titles = []
+        for rebase_ref in rebase_refs:
+            title = (
+                'git log {patch} '
+                'refs/heads/{base_branch}..{rebase_ref}'.format(
+                    patch='-p' if show_diffs else '',
+                    base_branch=base_branch, rebase_ref=rebase_ref))
+            titles.append(title)
+
+        return _generate_side_by_side_html_diff(
+            git_log_rebase_outputs, titles, 'Rebase Log Series Diff')
+
+    return_str = render_cache.get_or_render(
+        _render_cache_key('rebase_commit_log_series', request.args, sha1s),
+        render)
 
-    # Update the page title to say Rebase Series Diff
-    html_parser.title.string = 'Rebase Log Series Diff'
+    return Response(response=return_str, status=200)
 
-    return_str = str(html_parser)
 
-    return Response(response=return_str, status=200)
+# Fork the validation workers now that every function they run is
+# defined, and before any threads are started
+if VALIDATE_WORKERS > 1:
+    validation_pool = _ValidationPool(
+        VALIDATE_POOL, VALIDATE_WORKERS, WEBHOOK_WORKERS)
+
+# Start the webhook workers on the jobs the last run left (and send the
+# Github writes it left), however the app is served
+outbox.recover()
+webhook_workers.recover()
 
 
 if __name__ == '__main__':
-    app.run(ADDRESS, PORT)
+    app.run(ADDRESS, PORT, threaded=True)
@@ -0,0 +1,98 @@
+"""Check that overlapping fetches for different repos read their own refs
+
+Usage: python tests/check_concurrent_fetches.py [num_rounds]
+
+Sets up local stand-ins for the Github remotes of two repos, each with
+its own base branch and pull request head.  Every round adds new commits
+to all four refs and then resolves both base branches and fetches both
+pull request heads at the same time.  Each of the four has to come back
+with the sha1 its own remote ref points to, not one fetched for the
+other repo.
+"""
+import os
+import subprocess
+import sys
+import threading
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'benchmarks'))
+import synthetic
+
+REPOS = ['a', 'b']
+
+
+def add_commit(remote, ref, message):
+    """Add an empty commit on top of a ref of a bare remote"""
+    parent = subprocess.check_output(
+        ['git', '--git-dir', remote, 'rev-parse', ref]).strip()
+    sha1 = subprocess.check_output([
+        'git', '--git-dir', remote, '-c', 'user.name=Bench Mark',
+        '-c', 'user.email=bench.mark@example.com',
+        'commit-tree', parent + '^{tree}', '-p', parent,
+        '-m', message]).strip()
+    subprocess.check_call(
+        ['git', '--git-dir', remote, 'update-ref', ref, sha1])
+    return sha1
+
+
+def main():
+    num_rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    workdir = synthetic.make_workdir()
+    try:
+        base, tip = synthetic.make_branch(3)
+        remotes = {}
+        for repo in REPOS:
+            remote = os.path.join(workdir, 'remote', 'org', repo + '.git')
+            subprocess.check_call(['git', 'init', '-q', '--bare', remote])
+            subprocess.check_call([
+                'git', 'push', '-q', remote, base + ':refs/heads/master',
+                tip + ':refs/pull/1/head'])
+            remotes[repo] = remote
+        subprocess.check_call([
+            'git', 'config', 'url.{0}/remote/.insteadOf'.format(workdir),
+            'git@github.invalid:'])
+
+        gitbot = synthetic.import_gitbot()
+        for number in range(num_rounds):
+            expected = {}
+            for repo in REPOS:
+                expected['base', repo] = add_commit(
+                    remotes[repo], 'refs/heads/master',
+                    'Add {0} base {1}'.format(repo, number))
+                expected['head', repo] = add_commit(
+                    remotes[repo], 'refs/pull/1/head',
+                    'Add {0} head {1}'.format(repo, number))
+                gitbot.base_refs.invalidate('org', repo, 'master')
+
+            results = {}
+            start = threading.Event()
+
+            def fetch(kind, repo):
+                start.wait()
+                if kind == 'base':
+                    results[kind, repo] = gitbot.base_refs.resolve(
+                        'org', repo, 'master')
+                else:
+                    results[kind, repo] = gitbot._fetch_pull_request_head(
+                        'org', repo, 1,
+                        'git@github.invalid:org/{0}.git'.format(repo))
+            threads = [
+                threading.Thread(target=fetch, args=key) for key in expected]
+            for thread in threads:
+                thread.start()
+            start.set()
+            for thread in threads:
+                thread.join()
+            assert results == expected, (number, results, expected)
+
+        stats = gitbot.base_refs.current_stats()
+        assert stats['fetches'] == num_rounds * len(REPOS), stats
+        print 'ok: {0} rounds of {1} overlapping fetches'.format(
+            num_rounds, len(REPOS) * 2)
+    finally:
+        synthetic.remove_workdir(workdir)
+
+
+if __name__ == '__main__':
+    main()
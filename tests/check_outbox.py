@@ -0,0 +1,134 @@
+"""Check that Github writes outlive gitbot and honour Retry-After dates
+
+Usage: python tests/check_outbox.py
+
+Parses Retry-After headers given in seconds and as HTTP dates.  Then
+queues writes on an outbox whose client never finishes sending them, as
+if gitbot stopped, and recovers them on a second outbox sharing its
+sqlite file.  Every write has to be sent once, in order, with the check
+run carrying on from the progress it had made.
+"""
+import email.utils
+import os
+import sys
+import threading
+import time
+
+import requests
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'benchmarks'))
+import synthetic
+
+
+def response(status_code, headers=None):
+    result = requests.Response()
+    result.status_code = status_code
+    result.headers.update(headers or {})
+    return result
+
+
+def wait_for(condition, timeout=30):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise AssertionError('timed out')
+        time.sleep(0.05)
+
+
+class StoppedClient(object):
+    """A client that never gets a write through, as if gitbot stopped"""
+
+    def __init__(self):
+        self.stopped = threading.Event()
+
+    def rate_limit_wait(self):
+        return 0
+
+    def post_check_run(self, *args):
+        args[-1]['run_id'] = 7
+        # Github is back in a minute, but gitbot stops before then
+        self.stopped.set()
+        return response(503, {'Retry-After': email.utils.formatdate(
+            time.time() + 60, usegmt=True)})
+
+
+class RecordingClient(object):
+    def __init__(self):
+        self.writes = []
+
+    def rate_limit_wait(self):
+        return 0
+
+    def _record(self, name, args):
+        self.writes.append((name, ) + tuple(args))
+        return response(201)
+
+    def post_status(self, *args):
+        return self._record('post_status', args)
+
+    def post_comment(self, *args):
+        return self._record('post_comment', args)
+
+    def post_check_run(self, *args):
+        return self._record('post_check_run', args)
+
+
+def main():
+    workdir = synthetic.make_workdir()
+    try:
+        gitbot = synthetic.import_gitbot()
+        outbox = gitbot._GitHubOutbox(RecordingClient(), '')
+        date = email.utils.formatdate(time.time() + 30, usegmt=True)
+        for headers, low, high in [
+                ({'Retry-After': '12'}, 12, 12),
+                ({'Retry-After': date}, 28, 30),
+                ({'Retry-After': email.utils.formatdate(
+                    time.time() - 30, usegmt=True)}, 0, 0),
+                ({'Retry-After': email.utils.formatdate(
+                    time.time() + 86400, usegmt=True)},
+                 outbox.MAX_RETRY_AFTER, outbox.MAX_RETRY_AFTER)]:
+            delay = outbox._retry_after(response(429, headers))
+            assert low <= delay <= high, (headers, delay)
+        assert outbox._retry_after(response(429)) is None
+        assert outbox._retry_after(
+            response(429, {'Retry-After': 'soon'})) is None
+        print 'ok: Retry-After parsed in seconds and as HTTP dates'
+
+        path = os.path.join(workdir, 'outbox.sqlite')
+        stopped = StoppedClient()
+        outbox = gitbot._GitHubOutbox(stopped, path)
+        outbox.post_check_run(
+            'org', 'repo', 'a' * 40, 'gitbot', 'failure', {}, [])
+        stopped.stopped.wait()
+        wait_for(lambda: outbox.current_stats().get('retries'))
+        outbox.post_status(
+            'org', 'repo', 'b' * 40, 'failure', 'gitbot-a', 'old')
+        outbox.post_comment('org', 'repo', 1, 'Same comment')
+        outbox.post_comment('org', 'repo', 1, 'Same comment')
+        outbox.post_status(
+            'org', 'repo', 'b' * 40, 'failure', 'gitbot-a', 'new')
+
+        recording = RecordingClient()
+        recovered = gitbot._GitHubOutbox(recording, path)
+        recovered.recover()
+        wait_for(lambda: recovered.current_stats().get('written') == 4)
+        assert recording.writes == [
+            ('post_check_run', 'org', 'repo', 'a' * 40, 'gitbot', 'failure',
+             {}, [], {'run_id': 7}),
+            ('post_comment', 'org', 'repo', 1, 'Same comment'),
+            ('post_comment', 'org', 'repo', 1, 'Same comment'),
+            ('post_status', 'org', 'repo', 'b' * 40, 'failure', 'gitbot-a',
+             'new'),
+        ], recording.writes
+        wait_for(lambda: not recovered._connect().execute(
+            'SELECT COUNT(*) FROM writes').fetchone()[0])
+        print 'ok: {0} writes recovered and sent once'.format(
+            len(recording.writes))
+    finally:
+        synthetic.remove_workdir(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+"""Check that a push whose tracking fails is tracked again on retry
+
+Usage: python tests/check_push_retry.py
+
+Opens a pull request against a local stand-in for the Github remote and
+force pushes to it.  The webhook job tracking the push fails once, after
+it has started the new rebase but before it queues the validation.  The
+retry of the job has to queue the validation and advance the pull
+request's head, without starting a second rebase.
+
+Then it pushes another commit while the remote is missing the pull
+request's head ref, so the first fetch of the head fails.  The retry,
+once the ref is back, has to fetch the new head and track the push.
+"""
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'benchmarks'))
+import synthetic
+
+
+def wait_for(condition, timeout=30):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise AssertionError('timed out')
+        time.sleep(0.1)
+
+
+def main():
+    workdir = synthetic.make_workdir()
+    try:
+        base, tip = synthetic.make_branch(3)
+        remote = os.path.join(workdir, 'remote', 'org', 'repo.git')
+        subprocess.check_call(['git', 'init', '-q', '--bare', remote])
+        subprocess.check_call([
+            'git', 'push', '-q', remote, base + ':refs/heads/master',
+            tip + ':refs/pull/7/head'])
+        subprocess.check_call([
+            'git', 'config', 'url.{0}/remote/.insteadOf'.format(workdir),
+            'git@github.invalid:'])
+
+        gitbot = synthetic.import_gitbot()
+        gitbot.webhook_workers.RETRY_DELAY = 0.1
+        comments = []
+        gitbot.outbox.post_comment = lambda *args: comments.append(args)
+        queued = []
+        failures = []
+
+        def queue_validation(*args):
+            if failures:
+                raise failures.pop()
+            queued.append(args)
+        gitbot._queue_validation = queue_validation
+
+        gitbot._track_opened_pull_request(
+            'org', 'repo', 7, 'feature', 'master', tip)
+        del queued[:]
+
+        subprocess.check_call([
+            'git', 'commit', '-q', '--amend', '-m', 'Add block again'])
+        new_tip = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD']).strip()
+        subprocess.check_call([
+            'git', 'push', '-q', remote, '+' + new_tip + ':refs/pull/7/head'])
+
+        failures.append(RuntimeError('validation queue unavailable'))
+        gitbot.webhook_workers.submit(
+            ('org', 'repo', 7), gitbot._track_head_branch_push,
+            ('org', 'repo', 'git@github.invalid:org/repo.git', 7, 'feature',
+             'someone', 'http://gitbot/', tip, new_tip))
+        wait_for(lambda: gitbot.webhook_workers.current_stats().get('done'))
+
+        stats = gitbot.webhook_workers.current_stats()
+        assert stats['failed'] == 1 and stats['retries'] == 1, stats
+        assert [args[4] for args in queued] == [new_tip], queued
+        snapshot = gitbot.rebase_snapshots.latest('org', 'repo', 7)
+        assert snapshot.rebase_number == 1, snapshot.rebase_number
+        assert snapshot.head_sha1 == new_tip, snapshot.head_sha1
+        assert len(comments) == 1, comments
+        assert gitbot.pull_request_heads.is_at('org', 'repo', 7, new_tip)
+        print 'ok: the failed push was tracked again on retry'
+
+        subprocess.check_call([
+            'git', 'commit', '-q', '--allow-empty', '-m', 'Add nothing'])
+        last_tip = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD']).strip()
+        subprocess.check_call([
+            'git', 'push', '-q', remote, ':refs/pull/7/head'])
+
+        gitbot.webhook_workers.RETRY_DELAY = 1
+        gitbot.webhook_workers.submit(
+            ('org', 'repo', 7), gitbot._track_head_branch_push,
+            ('org', 'repo', 'git@github.invalid:org/repo.git', 7, 'feature',
+             'someone', 'http://gitbot/', new_tip, last_tip))
+        wait_for(lambda: gitbot.webhook_workers.current_stats()['failed'] > 1)
+        assert not gitbot.pull_request_heads.is_at(
+            'org', 'repo', 7, last_tip)
+        subprocess.check_call([
+            'git', 'push', '-q', remote, last_tip + ':refs/pull/7/head'])
+        wait_for(lambda: gitbot.webhook_workers.current_stats()['done'] > 1)
+
+        assert [args[4] for args in queued] == [new_tip, last_tip], queued
+        snapshot = gitbot.rebase_snapshots.latest('org', 'repo', 7)
+        assert snapshot.rebase_number == 1, snapshot.rebase_number
+        assert snapshot.head_sha1 == last_tip, snapshot.head_sha1
+        assert gitbot.pull_request_heads.is_at('org', 'repo', 7, last_tip)
+        print 'ok: the failed fetch was retried'
+    finally:
+        synthetic.remove_workdir(workdir)
+
+
+if __name__ == '__main__':
+    main()
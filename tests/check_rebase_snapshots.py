@@ -0,0 +1,103 @@
+"""Check that the rebase snapshot index and the rebase branches agree
+
+Usage: python tests/check_rebase_snapshots.py
+
+Records a few rebases of two pull requests and checks the latest head
+of each.  Then makes the git update of the rebase branches fail, and the
+sqlite commit of the index fail, and checks that neither leaves the
+index and the branches disagreeing.
+"""
+import os
+import sqlite3
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'benchmarks'))
+import synthetic
+
+
+class FailingCommit(object):
+    """A sqlite connection whose transactions fail to commit"""
+
+    def __init__(self, db):
+        self.db = db
+
+    def execute(self, *args):
+        return self.db.execute(*args)
+
+    def __enter__(self):
+        return self.db.__enter__()
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        if exc_type is None:
+            self.db.rollback()
+            raise sqlite3.OperationalError('disk I/O error')
+        return self.db.__exit__(exc_type, exc_value, exc_traceback)
+
+
+def main():
+    workdir = synthetic.make_workdir()
+    try:
+        base, tip = synthetic.make_branch(4)
+        middle = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD~2']).strip()
+        gitbot = synthetic.import_gitbot()
+        index = gitbot._RebaseSnapshotIndex('')
+
+        def branches(pr_number, rebase_number):
+            names = [
+                gitbot._rebase_branch_name(
+                    'org', 'repo', pr_number, 'master', pointer,
+                    rebase_number)
+                for pointer in ['base', 'head']]
+            sha1s = gitbot._branch_sha1s(names)
+            return tuple(sha1s.get(name) for name in names)
+
+        index.start_rebase('org', 'repo', 1, 'master', 0, base)
+        index.move_head('org', 'repo', 1, 0, tip)
+        index.start_rebase('org', 'repo', 1, 'master', 1, middle)
+        index.start_rebase('org', 'repo', 2, 'master', 0, tip)
+        index.start_rebase('org', 'repo', 2, 'master', 1, base)
+        index.move_head('org', 'repo', 2, 1, middle)
+        index.start_rebase('org', 'repo', 3, 'master', 0, base)
+        index.start_rebase('other', 'repo', 1, 'master', 0, base)
+        heads = index.latest_heads('org', 'repo')
+        assert heads == {1: middle, 2: middle, 3: base}, heads
+        print 'ok: the latest heads of {0} pull requests'.format(len(heads))
+
+        try:
+            index.start_rebase('org', 'repo', 1, 'master', 2, '1' * 40)
+        except subprocess.CalledProcessError:
+            pass
+        else:
+            raise AssertionError('the branches were updated')
+        assert index.latest('org', 'repo', 1).rebase_number == 1
+        assert branches(1, 2) == (None, None), branches(1, 2)
+        print 'ok: a failed branch update was not recorded'
+
+        index._db = FailingCommit(index._db)
+        for record in [
+                lambda: index.move_head('org', 'repo', 1, 1, tip),
+                lambda: index.start_rebase(
+                    'org', 'repo', 1, 'master', 2, tip)]:
+            try:
+                record()
+            except sqlite3.OperationalError:
+                pass
+            else:
+                raise AssertionError('the index was committed')
+        index._db = index._db.db
+        snapshot = index.latest('org', 'repo', 1)
+        assert (snapshot.rebase_number, snapshot.head_sha1) == (1, middle)
+        assert branches(1, 1) == (middle, middle), branches(1, 1)
+        assert branches(1, 2) == (None, None), branches(1, 2)
+        assert index.current_stats()['rolled_back'] == 2
+        print 'ok: the branches were moved back when the commit failed'
+    finally:
+        synthetic.remove_workdir(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+"""Check what both report modes send to the Github API
+
+Usage: python tests/check_report_modes.py
+
+Validates a synthetic branch with message, churn, move and whitespace
+errors, then reports it to a local fake Github API server, once in
+status mode and once in check run mode.  Status mode has to set one
+status per error plus the branch check on the head.  Check run mode has
+to create one check run and add the rest of its annotations 50 at a
+time, with each annotation on a line the commit's diff changes and the
+message errors in the summary of the run.
+"""
+import BaseHTTPServer
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'benchmarks'))
+import synthetic
+
+
+class FakeGitHub(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Records every API request and answers it like Github would"""
+
+    requests = []
+
+    def _answer(self, status, body):
+        content_length = int(self.headers.get('Content-Length') or 0)
+        request_body = self.rfile.read(content_length)
+        self.requests.append((
+            self.command, self.path,
+            json.loads(request_body) if request_body else None))
+        response_body = json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response_body)))
+        self.end_headers()
+        self.wfile.write(response_body)
+
+    def do_GET(self):
+        self._answer(200, [])
+
+    def do_POST(self):
+        self._answer(201, {'id': 1})
+
+    def do_PATCH(self):
+        self._answer(200, {'id': 1})
+
+    def log_message(self, *args):
+        pass
+
+
+def wait_for(condition, timeout=30):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise AssertionError('timed out')
+        time.sleep(0.05)
+
+
+def report(gitbot, commit_info, tip, written):
+    del FakeGitHub.requests[:]
+    gitbot._report_commit_checks('org', 'repo', commit_info, tip)
+    wait_for(
+        lambda: gitbot.outbox.current_stats().get('written', 0) >= written)
+    return [
+        (method, path, body) for method, path, body in FakeGitHub.requests
+        if method != 'GET']
+
+
+def changed_lines(gitbot, sha1):
+    diff = subprocess.check_output(['git', 'show', '--format=', sha1])
+    return set(
+        (path, line_number)
+        for path, _, _, line_number in gitbot._parse_diff_output(diff))
+
+
+def main():
+    workdir = synthetic.make_workdir()
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), FakeGitHub)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        base, _ = synthetic.make_branch(20)
+        for number in range(100):
+            with open('spaces.txt', 'a') as f:
+                f.write('line {0} \n'.format(number))
+            subprocess.check_call(['git', 'add', 'spaces.txt'])
+            subprocess.check_call([
+                'git', 'commit', '-q', '-m', 'Add spaces {0}'.format(number)])
+        tip = subprocess.check_output(['git', 'rev-parse', 'HEAD']).strip()
+
+        gitbot = synthetic.import_gitbot()
+        gitbot.github.endpoint = 'http://127.0.0.1:{0}'.format(
+            server.server_port)
+        commit_info = gitbot._parse_commit_log(base, tip)
+        errors = [
+            (sha1, error)
+            for sha1, commit_errors in commit_info.items()
+            for error in commit_errors]
+        located = [
+            (sha1, error) for sha1, error in errors if error[2] is not None]
+        contexts = set(error[0] for _, error in located)
+        assert contexts == set([
+            'diff-add-delete-check', 'diff-move-check',
+            'diff-whitespace-check']), contexts
+
+        writes = report(gitbot, commit_info, tip, len(errors) + 1)
+        statuses = sorted(
+            (path.split('/')[5], body['context'])
+            for method, path, body in writes)
+        assert statuses == sorted(
+            [(sha1, 'gitbot-' + error[0]) for sha1, error in errors] +
+            [(tip, 'gitbot-branch-check')]), statuses
+        print 'ok: status mode set {0} statuses'.format(len(statuses))
+
+        gitbot.config.add_section('repo org/repo')
+        gitbot.config.set('repo org/repo', 'report_mode', 'checks')
+        written = gitbot.outbox.current_stats()['written']
+        writes = report(gitbot, commit_info, tip, written + 1)
+        batches = [len(body['output']['annotations']) for _, _, body in writes]
+        expected_batches = [50] * (len(located) // 50)
+        if len(located) % 50:
+            expected_batches.append(len(located) % 50)
+        assert [method for method, _, _ in writes] == (
+            ['POST'] + ['PATCH'] * (len(expected_batches) - 1)), writes
+        assert batches == expected_batches, batches
+        assert writes[0][1] == '/repos/org/repo/check-runs', writes[0]
+        assert writes[0][2]['head_sha'] == tip
+        assert writes[0][2]['conclusion'] == 'failure'
+
+        annotations = [
+            annotation
+            for _, _, body in writes
+            for annotation in body['output']['annotations']]
+        for annotation in annotations:
+            sha1 = [
+                sha1 for sha1 in commit_info
+                if annotation['message'].startswith(sha1[:12])][0]
+            assert annotation['start_line'] == annotation['end_line']
+            assert (annotation['path'], annotation['start_line']) in (
+                changed_lines(gitbot, sha1)), annotation
+
+        summary = writes[0][2]['output']['summary']
+        unattached = len(errors) - len(located)
+        assert unattached and summary.count('\n* gitbot-') == unattached, (
+            summary)
+        print 'ok: check run mode sent {0} annotations in {1} requests'.format(
+            len(annotations), len(writes))
+    finally:
+        server.shutdown()
+        synthetic.remove_workdir(workdir)
+
+
+if __name__ == '__main__':
+    main()
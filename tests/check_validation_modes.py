@@ -0,0 +1,64 @@
+"""Check that every validation mode finds the same errors
+
+Usage: python tests/check_validation_modes.py [num_commits]
+
+Validates a synthetic branch (40 commits by default) one commit at a
+time, with a pool of threads and with a pool of forked processes, and
+checks that the merged commit_info is identical in all three modes.
+Each mode starts with an empty verdict store, so every commit is
+validated again, and in process mode the commits have to be validated
+by the forked workers.
+"""
+import os
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'benchmarks'))
+import synthetic
+
+
+def main():
+    num_commits = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+    workdir = synthetic.make_workdir()
+    try:
+        base, tip = synthetic.make_branch(num_commits)
+        with open('spaces.txt', 'w') as f:
+            f.write('trailing \n\n')
+        subprocess.check_call(['git', 'add', 'spaces.txt'])
+        subprocess.check_call(
+            ['git', 'commit', '-q', '-m', 'Add trailing whitespace'])
+        tip = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD']).strip()
+
+        gitbot = synthetic.import_gitbot()
+        commit_infos = {}
+        for kind in [None, 'thread', 'process']:
+            gitbot.verdict_store = gitbot._VerdictStore('', 100000)
+            gitbot.validation_pool = None
+            if kind is not None:
+                gitbot.validation_pool = gitbot._ValidationPool(kind, 4, 1)
+            calls = gitbot.commit_rules.current_stats()['body-check']['calls']
+            commit_infos[kind] = gitbot._parse_commit_log(base, tip)
+            assert not gitbot.verdict_store.current_stats().get('hits')
+
+            # Forked workers count their rule calls in the workers
+            calls = gitbot.commit_rules.current_stats()['body-check'][
+                'calls'] - calls
+            assert calls == (0 if kind == 'process' else num_commits + 1), (
+                kind, calls)
+
+        sequential = commit_infos[None]
+        assert any(sequential.values()), sequential
+        for kind in ['thread', 'process']:
+            assert commit_infos[kind] == sequential, (
+                kind, commit_infos[kind], sequential)
+        print 'ok: {0} commits, {1} errors, the same in every mode'.format(
+            len(sequential), sum(map(len, sequential.values())))
+    finally:
+        synthetic.remove_workdir(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""Check that webhook jobs shared by several processes run once
+
+Usage: python tests/check_webhook_queue.py
+
+Stores jobs in a webhook queue without running them, then has two more
+sets of workers recover the same queue, as two gitbot processes sharing
+it would.  Every job has to run exactly once.  A job whose lease has not
+expired yet (its process may still be running it) has to wait for the
+lease to expire.  Finally the endpoints that queue or rerun jobs have to
+refuse requests without a valid signature.
+"""
+import hashlib
+import hmac
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'benchmarks'))
+import synthetic
+
+
+def wait_for(condition, timeout=30):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise AssertionError('timed out')
+        time.sleep(0.05)
+
+
+def main():
+    workdir = synthetic.make_workdir()
+    try:
+        gitbot = synthetic.import_gitbot()
+        runs = []
+        lock = threading.Lock()
+
+        def record_run(number):
+            time.sleep(0.01)
+            with lock:
+                runs.append(number)
+        gitbot._WEBHOOK_JOBS['record_run'] = record_run
+
+        path = os.path.join(workdir, 'shared-queue.sqlite')
+
+        def workers(num_workers):
+            queue = gitbot._WebhookWorkers(num_workers, path, 3600, 1000)
+            queue.RETRY_DELAY = 0.1
+            return queue
+
+        # Without workers the jobs are only stored
+        stored = workers(0)
+        for number in range(40):
+            stored.submit(('org', 'repo', number % 4), record_run, [number])
+
+        recovering = [workers(2), workers(2)]
+        for queue in recovering:
+            queue.recover()
+        wait_for(lambda: sum(
+            queue.current_stats().get('done', 0) +
+            queue.current_stats().get('done_elsewhere', 0)
+            for queue in recovering) == 80)
+        assert sorted(runs) == range(40), sorted(runs)
+        print 'ok: 40 jobs recovered twice ran once, {0} and {1}'.format(
+            *[queue.current_stats().get('done', 0) for queue in recovering])
+
+        # A job still leased by a process that has stopped
+        del runs[:]
+        stored.submit(('org', 'repo', 0), record_run, [40])
+        db = sqlite3.connect(path)
+        with db:
+            db.execute('UPDATE jobs SET leased = ?', (time.time() + 1,))
+        started = time.time()
+        recovering = workers(1)
+        recovering.recover()
+        wait_for(lambda: runs)
+        assert time.time() - started > 0.9, time.time() - started
+        assert runs == [40], runs
+        print 'ok: the leased job ran once its lease expired'
+
+        client = gitbot.app.test_client()
+        assert client.post('/dead_letters/retry').status_code == 403
+        gitbot.WEBHOOK_SECRET = 'secret'
+        assert client.post('/dead_letters/retry').status_code == 403
+        assert client.post(
+            '/check_rebase', data='{}',
+            headers={'X-Github-Event': 'ping',
+                     'X-Hub-Signature-256': 'sha256=0'}).status_code == 403
+        signature = 'sha256=' + hmac.new(
+            'secret', '', hashlib.sha256).hexdigest()
+        response = client.post(
+            '/dead_letters/retry', headers={'X-Hub-Signature-256': signature})
+        assert response.status_code == 200, response.status_code
+        print 'ok: unsigned requests were refused'
+    finally:
+        synthetic.remove_workdir(workdir)
+
+
+if __name__ == '__main__':
+    main()